@@ -1,3 +1,4 @@
+import asyncio
 import dataclasses
 import io
 import json
@@ -6,37 +7,30 @@ import mimetypes
 import os
 import time
 from collections.abc import AsyncGenerator
+from datetime import timedelta
 from pathlib import Path
-from typing import Any, Union, cast
-
-from azure.cognitiveservices.speech import (
-    ResultReason,
-    SpeechConfig,
-    SpeechSynthesisOutputFormat,
-    SpeechSynthesisResult,
-    SpeechSynthesizer,
-)
-from azure.core.exceptions import ResourceNotFoundError
+from typing import TYPE_CHECKING, Any, Optional, Union, cast
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.identity.aio import (
     AzureDeveloperCliCredential,
     ManagedIdentityCredential,
     get_bearer_token_provider,
 )
-from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import ContainerClient
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from azure.storage.blob.aio import StorageStreamDownloader as BlobDownloader
 from azure.storage.filedatalake.aio import FileSystemClient
 from azure.storage.filedatalake.aio import StorageStreamDownloader as DatalakeDownloader
-from openai import AsyncAzureOpenAI, AsyncOpenAI
-from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
-from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
-from opentelemetry.instrumentation.httpx import (
-    HTTPXClientInstrumentor,
+from openai import (
+    DEFAULT_MAX_RETRIES,
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
 )
-from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from quart import (
     Blueprint,
     Quart,
@@ -45,12 +39,12 @@ from quart import (
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.http import http_date
 
-from approaches.approach import Approach
+from approaches.approach import Approach, Document, estimate_documents_size
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.promptmanager import PromptyManager
@@ -58,26 +52,40 @@ from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from chat_history.cosmosdb import chat_history_cosmosdb_bp
 from config import (
+    CONFIG_ADMISSION_CONTROLLERS,
     CONFIG_AGENT_CLIENT,
     CONFIG_AGENTIC_RETRIEVAL_ENABLED,
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
     CONFIG_BLOB_CONTAINER_CLIENT,
+    CONFIG_BLOCKING_EXECUTOR,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_HISTORY_BROWSER_ENABLED,
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CONTENT_SAS_GENERATOR,
     CONFIG_CREDENTIAL,
     CONFIG_DEFAULT_REASONING_EFFORT,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HISTORY_SUMMARY_CACHE,
+    CONFIG_HTTP_SESSIONS,
+    CONFIG_IMAGE_CACHE,
     CONFIG_INGESTER,
     CONFIG_LANGUAGE_PICKER_ENABLED,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_OPENAI_ROUTER,
     CONFIG_QUERY_REWRITING_ENABLED,
     CONFIG_REASONING_EFFORT_ENABLED,
+    CONFIG_RETRIEVAL_CACHE,
     CONFIG_SEARCH_CLIENT,
+    CONFIG_SEARCH_HEDGING,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
+    CONFIG_SHOW_STAGE_TIMINGS,
+    CONFIG_SINGLE_FLIGHT,
+    CONFIG_SPEECH_AUDIO_CACHE,
     CONFIG_SPEECH_INPUT_ENABLED,
     CONFIG_SPEECH_OUTPUT_AZURE_ENABLED,
     CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED,
@@ -86,22 +94,38 @@ from config import (
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
     CONFIG_STREAMING_ENABLED,
+    CONFIG_TOKEN_SCHEDULERS,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.admission import UPSTREAM_OPENAI, UPSTREAM_SEARCH, AdmissionController
+from core.answercache import SemanticAnswerCache
+from core.audiocache import AudioCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.executor import BlockingExecutor
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry
+from core.imageshelper import ImageCache, ImagePreparer
+from core.metrics import STREAMS_IN_FLIGHT, UPSTREAM_BLOB, measure_upstream
+from core.openairouter import OpenAIEndpoint, OpenAIRouter
+from core.sas import UserDelegationSasGenerator
 from core.sessionhelper import create_session_id
+from core.singleflight import SingleFlight
+from core.timings import start_stage_timings
+from core.tokenbudget import TokenBudgetScheduler
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
-from prepdocs import (
-    clean_key_if_exists,
-    setup_embeddings_service,
-    setup_file_processors,
-    setup_search_info,
-)
-from prepdocslib.filestrategy import UploadUserFileStrategy
-from prepdocslib.listfilestrategy import File
+from metrics import metrics_bp
+
+# The Speech SDK, Azure Monitor, OpenTelemetry and the ingestion libraries (Document Intelligence, PyMuPDF, Pillow, pypdf)
+# are slow to import, so they're only imported when the features that use them are enabled,
+# which keeps the start of each worker fast
+if TYPE_CHECKING:
+    from azure.cognitiveservices.speech import SpeechSynthesisResult, SpeechSynthesizer
+
+    from prepdocslib.filestrategy import UploadUserFileStrategy
 
 bp = Blueprint("routes", __name__, static_folder="static")
 # Fix Windows registry issue with mimetypes
@@ -131,26 +155,29 @@ async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
 
-@bp.route("/content/<path>")
-@authenticated_path
-async def content_file(path: str, auth_claims: dict[str, Any]):
+def get_requested_byte_range() -> Optional[tuple[int, Optional[int]]]:
     """
-    Serve content files from blob storage from within the app to keep the example self-contained.
-    *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
-    if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
-    if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    Returns the offset and length (None for the rest of the file) of the byte range requested by the client, if any.
+    Only a single range with a known start is supported, other range requests are answered with the complete file.
     """
-    # Remove page number from path, filename-1.txt -> filename.txt
-    # This shouldn't typically be necessary as browsers don't send hash fragments to servers
-    if path.find("#page=") > 0:
-        path_parts = path.rsplit("#page=", 1)
-        path = path_parts[0]
-    current_app.logger.info("Opening file %s", path)
+    # If-Range would require comparing the validator before downloading, so send the complete file instead
+    if request.range is None or request.range.units != "bytes" or "If-Range" in request.headers:
+        return None
+    if len(request.range.ranges) != 1:
+        return None
+    start, stop = request.range.ranges[0]
+    if start < 0:
+        return None
+    return start, (stop - start if stop is not None else None)
+
+
+async def download_content_file(
+    path: str, auth_claims: dict[str, Any], download_options: dict[str, Any]
+) -> Union[BlobDownloader, DatalakeDownloader]:
     blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
-    blob: Union[BlobDownloader, DatalakeDownloader]
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        async with measure_upstream(UPSTREAM_BLOB):
+            return await blob_container_client.get_blob_client(path).download_blob(**download_options)
     except ResourceNotFoundError:
         current_app.logger.info("Path not found in general Blob container: %s", path)
         if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
@@ -159,21 +186,103 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
                 user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
                 user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
                 file_client = user_directory_client.get_file_client(path)
-                blob = await file_client.download_file()
+                async with measure_upstream(UPSTREAM_BLOB):
+                    return await file_client.download_file(**download_options)
             except ResourceNotFoundError:
                 current_app.logger.exception("Path not found in DataLake: %s", path)
                 abort(404)
         else:
             abort(404)
+
+
+@bp.route("/content/<path>")
+@authenticated_path
+async def content_file(path: str, auth_claims: dict[str, Any]):
+    """
+    Serve content files from blob storage from within the app to keep the example self-contained.
+    *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
+    if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
+    if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
+    The file is streamed to the client as it is downloaded, and supports range requests and conditional requests.
+    """
+    # Remove page number from path, filename-1.txt -> filename.txt
+    # This shouldn't typically be necessary as browsers don't send hash fragments to servers
+    if path.find("#page=") > 0:
+        path_parts = path.rsplit("#page=", 1)
+        path = path_parts[0]
+    current_app.logger.info("Opening file %s", path)
+
+    # Access has already been checked, so let the client download the file directly from storage
+    sas_generator: Optional[UserDelegationSasGenerator] = current_app.config.get(CONFIG_CONTENT_SAS_GENERATOR)
+    if sas_generator:
+        blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+        # Files uploaded by users live in DataLake, which is only reachable through the app
+        if (
+            not current_app.config[CONFIG_USER_UPLOAD_ENABLED]
+            or await blob_container_client.get_blob_client(path).exists()
+        ):
+            sas_url = await sas_generator.generate_blob_url(
+                path, content_type=mimetypes.guess_type(path)[0], content_disposition="inline"
+            )
+            return "", 302, {"Location": sas_url}
+
+    # Let storage evaluate conditional requests, so that unchanged files aren't downloaded again
+    download_options: dict[str, Any] = {}
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        # Lists of ETags can't be passed to storage, so those are answered with the complete file
+        if "," not in if_none_match:
+            download_options.update(etag=if_none_match, match_condition=MatchConditions.IfModified)
+    elif request.if_modified_since:
+        download_options["if_modified_since"] = request.if_modified_since
+    byte_range = get_requested_byte_range()
+    if byte_range:
+        download_options.update(offset=byte_range[0], length=byte_range[1])
+
+    blob: Union[BlobDownloader, DatalakeDownloader]
+    try:
+        blob = await download_content_file(path, auth_claims, download_options)
+    except HttpResponseError as error:
+        # Storage reports an unchanged file and an unsatisfiable range as errors
+        if error.status_code == 304:
+            return "", 304, {"ETag": if_none_match} if if_none_match else {}
+        if error.status_code == 416:
+            return "", 416
+        raise
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
     mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(blob.size)}
+    if blob.properties.etag:
+        headers["ETag"] = blob.properties.etag
+    if blob.properties.last_modified:
+        headers["Last-Modified"] = http_date(blob.properties.last_modified)
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        content_range = blob.properties.content_range or ""
+        file_size = content_range.rsplit("/", 1)[-1] if "/" in content_range else "*"
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[0] + blob.size - 1}/{file_size}"
+
+    async def stream_blob() -> AsyncGenerator[bytes, None]:
+        async for chunk in blob.chunks():
+            yield chunk
+
+    response = await make_response(stream_blob(), status_code, headers)
+    response.timeout = None  # type: ignore
+    response.mimetype = mime_type
+    return response
+
+
+def check_upstream_admission():
+    # Shed requests right away when calls to an upstream service are already queueing at capacity,
+    # rather than letting them wait and slow down every other request
+    admission_controllers: dict[str, AdmissionController] = current_app.config[CONFIG_ADMISSION_CONTROLLERS]
+    for admission_controller in admission_controllers.values():
+        admission_controller.check()
 
 
 @bp.route("/ask", methods=["POST"])
@@ -191,10 +300,15 @@ async def ask(auth_claims: dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
+        check_upstream_admission()
+        timings = start_stage_timings(current_app.config[CONFIG_SHOW_STAGE_TIMINGS])
         r = await approach.run(
             request_json["messages"], context=context, session_state=request_json.get("session_state")
         )
-        return jsonify(r)
+        timings.record_total()
+        response = jsonify(r)
+        response.headers["Server-Timing"] = timings.server_timing()
+        return response
     except Exception as error:
         return error_response(error, "/ask")
 
@@ -207,12 +321,41 @@ class JSONEncoder(json.JSONEncoder):
 
 
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+    STREAMS_IN_FLIGHT.inc()
     try:
         async for event in r:
             yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
+    finally:
+        STREAMS_IN_FLIGHT.dec()
+
+
+async def prefetch_first_event(r: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    """
+    Runs the stream until its first event, which is sent once the sources are retrieved,
+    so that the headers of the streamed response can include the timings of the retrieval stages.
+    An error is raised again when the stream is read, so that it's reported in the stream like later errors.
+    """
+    first_events: list[dict] = []
+    error: Optional[Exception] = None
+    try:
+        first_events.append(await r.__anext__())
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        error = e
+
+    async def events() -> AsyncGenerator[dict, None]:
+        if error is not None:
+            raise error
+        for event in first_events:
+            yield event
+        async for event in r:
+            yield event
+
+    return events()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -230,6 +373,7 @@ async def chat(auth_claims: dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
+        check_upstream_admission()
 
         # If session state is provided, persists the session state,
         # else creates a new session_id depending on the chat history options enabled.
@@ -239,12 +383,16 @@ async def chat(auth_claims: dict[str, Any]):
                 current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
                 current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
             )
+        timings = start_stage_timings(current_app.config[CONFIG_SHOW_STAGE_TIMINGS])
         result = await approach.run(
             request_json["messages"],
             context=context,
             session_state=session_state,
         )
-        return jsonify(result)
+        timings.record_total()
+        response = jsonify(result)
+        response.headers["Server-Timing"] = timings.server_timing()
+        return response
     except Exception as error:
         return error_response(error, "/chat")
 
@@ -264,6 +412,7 @@ async def chat_stream(auth_claims: dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
+        check_upstream_admission()
 
         # If session state is provided, persists the session state,
         # else creates a new session_id depending on the chat history options enabled.
@@ -273,12 +422,17 @@ async def chat_stream(auth_claims: dict[str, Any]):
                 current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
                 current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
             )
+        timings = start_stage_timings(current_app.config[CONFIG_SHOW_STAGE_TIMINGS])
         result = await approach.run_stream(
             request_json["messages"],
             context=context,
             session_state=session_state,
         )
+        result = await prefetch_first_event(result)
+        # The total only covers the time until the first event, the generation is reported in the thought process
+        timings.record_total()
         response = await make_response(format_as_ndjson(result))
+        response.headers["Server-Timing"] = timings.server_timing()
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
         return response
@@ -316,10 +470,17 @@ def config():
     )
 
 
-@bp.route("/speech", methods=["POST"])
-async def speech():
-    if not request.is_json:
-        return jsonify({"error": "request must be json"}), 415
+# Name of a SpeechSynthesisOutputFormat
+SPEECH_OUTPUT_FORMAT = "Audio16Khz32KBitRateMonoMp3"
+SPEECH_STREAM_CHUNK_SIZE = 16 * 1024
+
+
+async def create_speech_synthesizer() -> "SpeechSynthesizer":
+    from azure.cognitiveservices.speech import (
+        SpeechConfig,
+        SpeechSynthesisOutputFormat,
+        SpeechSynthesizer,
+    )
 
     speech_token = current_app.config.get(CONFIG_SPEECH_SERVICE_TOKEN)
     if speech_token is None or speech_token.expires_on < time.time() + 60:
@@ -328,38 +489,141 @@ async def speech():
         )
         current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = speech_token
 
+    # Construct a token as described in documentation:
+    # https://learn.microsoft.com/azure/ai-services/speech-service/how-to-configure-azure-ad-auth?pivots=programming-language-python
+    auth_token = (
+        "aad#"
+        + current_app.config[CONFIG_SPEECH_SERVICE_ID]
+        + "#"
+        + current_app.config[CONFIG_SPEECH_SERVICE_TOKEN].token
+    )
+    speech_config = SpeechConfig(auth_token=auth_token, region=current_app.config[CONFIG_SPEECH_SERVICE_LOCATION])
+    speech_config.speech_synthesis_voice_name = current_app.config[CONFIG_SPEECH_SERVICE_VOICE]
+    speech_config.speech_synthesis_output_format = SpeechSynthesisOutputFormat[SPEECH_OUTPUT_FORMAT]
+    return SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+
+
+def get_speech_cache_key(text: str) -> str:
+    return AudioCache.make_key(current_app.config.get(CONFIG_SPEECH_SERVICE_VOICE) or "", SPEECH_OUTPUT_FORMAT, text)
+
+
+def get_synthesized_audio(result: "SpeechSynthesisResult") -> bytes:
+    from azure.cognitiveservices.speech import ResultReason
+
+    if result.reason == ResultReason.SynthesizingAudioCompleted:
+        return result.audio_data
+    elif result.reason == ResultReason.Canceled:
+        cancellation_details = result.cancellation_details
+        current_app.logger.error(
+            "Speech synthesis canceled: %s %s", cancellation_details.reason, cancellation_details.error_details
+        )
+        raise Exception("Speech synthesis canceled. Check logs for details.")
+    else:
+        current_app.logger.error("Unexpected result reason: %s", result.reason)
+        raise Exception("Speech synthesis failed. Check logs for details.")
+
+
+@bp.route("/speech", methods=["POST"])
+async def speech():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+
     request_json = await request.get_json()
     text = request_json["text"]
+    audio_cache: Optional[AudioCache] = current_app.config.get(CONFIG_SPEECH_AUDIO_CACHE)
+    cache_key = get_speech_cache_key(text)
+    if audio_cache and (cached_audio := await audio_cache.get(cache_key)) is not None:
+        return cached_audio, 200, {"Content-Type": "audio/mp3"}
+
     try:
-        # Construct a token as described in documentation:
-        # https://learn.microsoft.com/azure/ai-services/speech-service/how-to-configure-azure-ad-auth?pivots=programming-language-python
-        auth_token = (
-            "aad#"
-            + current_app.config[CONFIG_SPEECH_SERVICE_ID]
-            + "#"
-            + current_app.config[CONFIG_SPEECH_SERVICE_TOKEN].token
-        )
-        speech_config = SpeechConfig(auth_token=auth_token, region=current_app.config[CONFIG_SPEECH_SERVICE_LOCATION])
-        speech_config.speech_synthesis_voice_name = current_app.config[CONFIG_SPEECH_SERVICE_VOICE]
-        speech_config.speech_synthesis_output_format = SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
-        synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-        result: SpeechSynthesisResult = synthesizer.speak_text_async(text).get()
-        if result.reason == ResultReason.SynthesizingAudioCompleted:
-            return result.audio_data, 200, {"Content-Type": "audio/mp3"}
-        elif result.reason == ResultReason.Canceled:
-            cancellation_details = result.cancellation_details
-            current_app.logger.error(
-                "Speech synthesis canceled: %s %s", cancellation_details.reason, cancellation_details.error_details
-            )
-            raise Exception("Speech synthesis canceled. Check logs for details.")
-        else:
-            current_app.logger.error("Unexpected result reason: %s", result.reason)
-            raise Exception("Speech synthesis failed. Check logs for details.")
+        synthesizer = await create_speech_synthesizer()
+        # The Speech SDK blocks until synthesis completes, so wait for it on a thread
+        blocking_executor: BlockingExecutor = current_app.config[CONFIG_BLOCKING_EXECUTOR]
+        result: SpeechSynthesisResult = await blocking_executor.run(lambda: synthesizer.speak_text_async(text).get())
+        audio_data = get_synthesized_audio(result)
+        if audio_cache:
+            await audio_cache.set(cache_key, audio_data)
+        return audio_data, 200, {"Content-Type": "audio/mp3"}
     except Exception as e:
         current_app.logger.exception("Exception in /speech")
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/speech/stream", methods=["POST"])
+async def speech_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+
+    request_json = await request.get_json()
+    text = request_json["text"]
+    audio_cache: Optional[AudioCache] = current_app.config.get(CONFIG_SPEECH_AUDIO_CACHE)
+    cache_key = get_speech_cache_key(text)
+    if audio_cache and (cached_audio := await audio_cache.get(cache_key)) is not None:
+
+        async def stream_cached_audio(audio_data: bytes) -> AsyncGenerator[bytes, None]:
+            for start in range(0, len(audio_data), SPEECH_STREAM_CHUNK_SIZE):
+                yield audio_data[start : start + SPEECH_STREAM_CHUNK_SIZE]
+
+        response = await make_response(stream_cached_audio(cached_audio))
+        response.mimetype = "audio/mp3"
+        return response
+
+    try:
+        synthesizer = await create_speech_synthesizer()
+    except Exception as e:
+        current_app.logger.exception("Exception in /speech/stream")
+        return jsonify({"error": str(e)}), 500
+    # The Speech SDK reports each chunk of audio from one of its own threads as soon as it is synthesized,
+    # followed by None once synthesis has finished
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+    synthesizer.synthesizing.connect(lambda evt: loop.call_soon_threadsafe(chunks.put_nowait, evt.result.audio_data))
+
+    blocking_executor: BlockingExecutor = current_app.config[CONFIG_BLOCKING_EXECUTOR]
+
+    async def synthesize() -> "SpeechSynthesisResult":
+        from azure.cognitiveservices.speech import ResultReason
+
+        result = await blocking_executor.run(lambda: synthesizer.speak_text_async(text).get())
+        # Cache the audio even if the client stopped listening before the end
+        if audio_cache and result.reason == ResultReason.SynthesizingAudioCompleted:
+            await audio_cache.set(cache_key, result.audio_data)
+        return result
+
+    synthesis = asyncio.create_task(synthesize())
+    synthesis.add_done_callback(lambda _: chunks.put_nowait(None))
+
+    first_chunk = await chunks.get()
+    if first_chunk is None:
+        # Synthesis finished without reporting any chunks, so respond with the complete result (or error)
+        try:
+            return get_synthesized_audio(synthesis.result()), 200, {"Content-Type": "audio/mp3"}
+        except Exception as e:
+            current_app.logger.exception("Exception in /speech/stream")
+            return jsonify({"error": str(e)}), 500
+
+    async def stream_audio(chunk: Optional[bytes]) -> AsyncGenerator[bytes, None]:
+        sent = 0
+        while chunk is not None:
+            yield chunk
+            sent += len(chunk)
+            chunk = await chunks.get()
+        try:
+            audio_data = get_synthesized_audio(synthesis.result())
+        except Exception:
+            # The response has already started, so the error can only be logged
+            current_app.logger.exception("Exception in /speech/stream")
+            return
+        # Send any audio that wasn't reported as a chunk
+        if len(audio_data) > sent:
+            yield audio_data[sent:]
+
+    response = await make_response(stream_audio(first_chunk))
+    response.timeout = None  # type: ignore
+    response.mimetype = "audio/mp3"
+    return response
+
+
 @bp.post("/upload")
 @authenticated
 async def upload(auth_claims: dict[str, Any]):
@@ -384,8 +648,16 @@ async def upload(auth_claims: dict[str, Any]):
     file_io = io.BufferedReader(file_io)
     await file_client.upload_data(file_io, overwrite=True, metadata={"UploadedBy": user_oid})
     file_io.seek(0)
+    from prepdocslib.listfilestrategy import File
+
     ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
     await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
+    # The uploaded file changes which documents the user can access, and so the results and answers for their questions
+    current_app.config[CONFIG_AUTH_CLIENT].invalidate_path_auth_cache()
+    if (retrieval_cache := current_app.config.get(CONFIG_RETRIEVAL_CACHE)) is not None:
+        retrieval_cache.clear()
+    if (answer_cache := current_app.config.get(CONFIG_ANSWER_CACHE)) is not None:
+        answer_cache.clear()
     return jsonify({"message": "File uploaded successfully"}), 200
 
 
@@ -401,6 +673,11 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     await file_client.delete_file()
     ingester = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
+    current_app.config[CONFIG_AUTH_CLIENT].invalidate_path_auth_cache()
+    if (retrieval_cache := current_app.config.get(CONFIG_RETRIEVAL_CACHE)) is not None:
+        retrieval_cache.clear()
+    if (answer_cache := current_app.config.get(CONFIG_ANSWER_CACHE)) is not None:
+        answer_cache.clear()
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
@@ -439,6 +716,26 @@ async def setup_clients():
     OPENAI_EMB_MODEL = os.getenv("AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-ada-002")
     OPENAI_EMB_DIMENSIONS = int(os.getenv("AZURE_OPENAI_EMB_DIMENSIONS") or 1536)
     OPENAI_REASONING_EFFORT = os.getenv("AZURE_OPENAI_REASONING_EFFORT")
+    # Query embeddings are cached in memory, set EMBEDDING_CACHE_MAX_ENTRIES to 0 to disable the cache
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES") or 1000)
+    EMBEDDING_CACHE_TTL_SECONDS = int(os.getenv("EMBEDDING_CACHE_TTL_SECONDS") or 3600)
+    # Search results are cached in memory when RETRIEVAL_CACHE_MAX_BYTES is set, the cache is disabled by default
+    RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES") or 0)
+    RETRIEVAL_CACHE_TTL_SECONDS = int(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS") or 60)
+    # Answers to similar questions are reused when ANSWER_CACHE_MAX_ENTRIES is set, the cache is disabled by default
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES") or 0)
+    ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS") or 3600)
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD") or 0.95)
+    # Page images sent to GPT-4V are cached in memory, set IMAGE_CACHE_MAX_BYTES to 0 to disable the cache
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES") or 64 * 1024 * 1024)
+    IMAGE_CACHE_REVALIDATE_SECONDS = int(os.getenv("IMAGE_CACHE_REVALIDATE_SECONDS") or 300)
+    IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY") or 8)
+    # Page images are sent to GPT-4V as rendered unless they're downscaled to IMAGE_MAX_LONG_EDGE pixels,
+    # re-encoded to IMAGE_FORMAT (png, jpeg or webp) at IMAGE_QUALITY, or sent with an IMAGE_DETAIL of auto, low or high
+    IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE") or 0)
+    IMAGE_FORMAT = os.getenv("IMAGE_FORMAT") or "png"
+    IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY") or 85)
+    IMAGE_DETAIL = os.getenv("IMAGE_DETAIL") or None
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_GPT4V_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT4V_DEPLOYMENT")
@@ -448,6 +745,10 @@ async def setup_clients():
     )
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST.startswith("azure") else None
     AZURE_OPENAI_CUSTOM_URL = os.getenv("AZURE_OPENAI_CUSTOM_URL")
+    # Calls are routed between several Azure OpenAI endpoints with the same deployments when AZURE_OPENAI_ENDPOINTS is set
+    AZURE_OPENAI_ENDPOINTS = [
+        endpoint.strip() for endpoint in os.getenv("AZURE_OPENAI_ENDPOINTS", "").split(",") if endpoint.strip()
+    ]
     # https://learn.microsoft.com/azure/ai-services/openai/api-version-deprecation#latest-ga-api-release
     AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-10-21"
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
@@ -460,6 +761,17 @@ async def setup_clients():
     AZURE_ENFORCE_ACCESS_CONTROL = os.getenv("AZURE_ENFORCE_ACCESS_CONTROL", "").lower() == "true"
     AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS = os.getenv("AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS", "").lower() == "true"
     AZURE_ENABLE_UNAUTHENTICATED_ACCESS = os.getenv("AZURE_ENABLE_UNAUTHENTICATED_ACCESS", "").lower() == "true"
+    # Claims resolved from access tokens are cached in memory, set AUTH_CLAIMS_CACHE_MAX_ENTRIES to 0 to disable the cache
+    AUTH_CLAIMS_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CLAIMS_CACHE_MAX_ENTRIES") or 1000)
+    # Access decisions for /content are cached in memory, set PATH_AUTH_CACHE_MAX_ENTRIES to 0 to disable the cache
+    PATH_AUTH_CACHE_MAX_ENTRIES = int(os.getenv("PATH_AUTH_CACHE_MAX_ENTRIES") or 1000)
+    PATH_AUTH_CACHE_TTL_SECONDS = int(os.getenv("PATH_AUTH_CACHE_TTL_SECONDS") or 120)
+    PATH_AUTH_CACHE_NEGATIVE_TTL_SECONDS = int(os.getenv("PATH_AUTH_CACHE_NEGATIVE_TTL_SECONDS") or 30)
+    # Blocking SDK calls (MSAL and the Speech SDK) run on a dedicated pool of threads
+    BLOCKING_EXECUTOR_MAX_WORKERS = int(os.getenv("BLOCKING_EXECUTOR_MAX_WORKERS") or 16)
+    # Calls made with aiohttp (Microsoft Graph, Entra signing keys, AI Vision) share a pool of connections per host
+    HTTP_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_CONNECTIONS_PER_HOST") or 100)
+    HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS") or 60)
     AZURE_SERVER_APP_ID = os.getenv("AZURE_SERVER_APP_ID")
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
@@ -478,9 +790,16 @@ async def setup_clients():
     AZURE_SPEECH_SERVICE_ID = os.getenv("AZURE_SPEECH_SERVICE_ID")
     AZURE_SPEECH_SERVICE_LOCATION = os.getenv("AZURE_SPEECH_SERVICE_LOCATION")
     AZURE_SPEECH_SERVICE_VOICE = os.getenv("AZURE_SPEECH_SERVICE_VOICE") or "en-US-AndrewMultilingualNeural"
+    # Synthesized speech is cached in memory and spilled to local disk, set the memory limit to 0 to disable the cache
+    SPEECH_AUDIO_CACHE_MAX_MEMORY_BYTES = int(os.getenv("SPEECH_AUDIO_CACHE_MAX_MEMORY_BYTES") or 50 * 1024 * 1024)
+    SPEECH_AUDIO_CACHE_MAX_DISK_BYTES = int(os.getenv("SPEECH_AUDIO_CACHE_MAX_DISK_BYTES") or 500 * 1024 * 1024)
+    SPEECH_AUDIO_CACHE_DIR = os.getenv("SPEECH_AUDIO_CACHE_DIR")
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
     USE_USER_UPLOAD = os.getenv("USE_USER_UPLOAD", "").lower() == "true"
+    # Redirect /content requests to short-lived SAS URLs, for storage accounts that are reachable by clients
+    USE_CONTENT_SAS_REDIRECT = os.getenv("USE_CONTENT_SAS_REDIRECT", "").lower() == "true"
+    CONTENT_SAS_EXPIRY_SECONDS = int(os.getenv("CONTENT_SAS_EXPIRY_SECONDS") or 300)
     ENABLE_LANGUAGE_PICKER = os.getenv("ENABLE_LANGUAGE_PICKER", "").lower() == "true"
     USE_SPEECH_INPUT_BROWSER = os.getenv("USE_SPEECH_INPUT_BROWSER", "").lower() == "true"
     USE_SPEECH_OUTPUT_BROWSER = os.getenv("USE_SPEECH_OUTPUT_BROWSER", "").lower() == "true"
@@ -488,6 +807,38 @@ async def setup_clients():
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
     USE_AGENTIC_RETRIEVAL = os.getenv("USE_AGENTIC_RETRIEVAL", "").lower() == "true"
+    USE_SPECULATIVE_SEARCH = os.getenv("USE_SPECULATIVE_SEARCH", "").lower() == "true"
+    USE_REQUEST_COALESCING = os.getenv("USE_REQUEST_COALESCING", "").lower() == "true"
+    # Concurrent calls to each upstream service are only limited when its maximum concurrency is set
+    OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY") or 0)
+    OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE") or 100)
+    SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY") or 0)
+    SEARCH_MAX_QUEUE = int(os.getenv("SEARCH_MAX_QUEUE") or 100)
+    UPSTREAM_RETRY_AFTER_SECONDS = int(os.getenv("UPSTREAM_RETRY_AFTER_SECONDS") or 1)
+    # Slow searches are duplicated when USE_SEARCH_HEDGING is true, within a budget of extra searches
+    USE_SEARCH_HEDGING = os.getenv("USE_SEARCH_HEDGING", "").lower() == "true"
+    SEARCH_HEDGING_PERCENTILE = float(os.getenv("SEARCH_HEDGING_PERCENTILE") or 95)
+    SEARCH_HEDGING_MAX_EXTRA_RATIO = float(os.getenv("SEARCH_HEDGING_MAX_EXTRA_RATIO") or 0.05)
+    # The sources of the answer prompts are packed into SOURCES_TOKEN_BUDGET tokens when it's set, in rank order
+    SOURCES_TOKEN_BUDGET = int(os.getenv("SOURCES_TOKEN_BUDGET") or 0)
+    # The past messages of a chat are trimmed to HISTORY_TOKEN_BUDGET tokens when it's set, newest first,
+    # and the older messages are replaced by a summary when USE_HISTORY_SUMMARY is true
+    HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET") or 0)
+    USE_HISTORY_SUMMARY = os.getenv("USE_HISTORY_SUMMARY", "").lower() == "true"
+    HISTORY_SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_SUMMARY_CACHE_MAX_ENTRIES") or 1000)
+    HISTORY_SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("HISTORY_SUMMARY_CACHE_TTL_SECONDS") or 3600)
+    # Stage timings are always sent in the Server-Timing header, and also in the thought process when this is true
+    SHOW_STAGE_TIMINGS = os.getenv("SHOW_STAGE_TIMINGS", "").lower() == "true"
+    # Calls to each OpenAI deployment are paced to stay under its quota when its tokens per minute quota is set.
+    # Azure OpenAI allows 6 requests per minute for every 1000 tokens per minute by default.
+    OPENAI_CHATGPT_TOKENS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_CHATGPT_TOKENS_PER_MINUTE") or 0)
+    OPENAI_CHATGPT_REQUESTS_PER_MINUTE = int(
+        os.getenv("AZURE_OPENAI_CHATGPT_REQUESTS_PER_MINUTE") or OPENAI_CHATGPT_TOKENS_PER_MINUTE * 6 // 1000
+    )
+    OPENAI_EMB_TOKENS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_EMB_TOKENS_PER_MINUTE") or 0)
+    OPENAI_EMB_REQUESTS_PER_MINUTE = int(
+        os.getenv("AZURE_OPENAI_EMB_REQUESTS_PER_MINUTE") or OPENAI_EMB_TOKENS_PER_MINUTE * 6 // 1000
+    )
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
@@ -533,6 +884,13 @@ async def setup_clients():
     blob_container_client = ContainerClient(
         f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
     )
+    if USE_CONTENT_SAS_REDIRECT:
+        current_app.logger.info("USE_CONTENT_SAS_REDIRECT is true, redirecting content requests to SAS URLs")
+        current_app.config[CONFIG_CONTENT_SAS_GENERATOR] = UserDelegationSasGenerator(
+            BlobServiceClient(f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential),
+            AZURE_STORAGE_CONTAINER,
+            sas_expiry=timedelta(seconds=CONTENT_SAS_EXPIRY_SECONDS),
+        )
 
     # Set up authentication helper
     search_index = None
@@ -544,6 +902,13 @@ async def setup_clients():
         )
         search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
         await search_index_client.close()
+    blocking_executor = BlockingExecutor(max_workers=BLOCKING_EXECUTOR_MAX_WORKERS)
+    current_app.config[CONFIG_BLOCKING_EXECUTOR] = blocking_executor
+    http_sessions = HTTPSessionRegistry(
+        limit_per_host=HTTP_CONNECTIONS_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+    )
+    current_app.config[CONFIG_HTTP_SESSIONS] = http_sessions
+
     auth_helper = AuthenticationHelper(
         search_index=search_index,
         use_authentication=AZURE_USE_AUTHENTICATION,
@@ -554,6 +919,12 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        auth_claims_cache_max_entries=AUTH_CLAIMS_CACHE_MAX_ENTRIES,
+        path_auth_cache_max_entries=PATH_AUTH_CACHE_MAX_ENTRIES,
+        path_auth_cache_ttl=PATH_AUTH_CACHE_TTL_SECONDS,
+        path_auth_cache_negative_ttl=PATH_AUTH_CACHE_NEGATIVE_TTL_SECONDS,
+        blocking_executor=blocking_executor,
+        http_sessions=http_sessions,
     )
 
     if USE_USER_UPLOAD:
@@ -570,12 +941,21 @@ async def setup_clients():
         current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
 
         # Set up ingester
+        from prepdocs import (
+            clean_key_if_exists,
+            setup_embeddings_service,
+            setup_file_processors,
+            setup_search_info,
+        )
+        from prepdocslib.filestrategy import UploadUserFileStrategy
+
         file_processors = setup_file_processors(
             azure_credential=azure_credential,
             document_intelligence_service=os.getenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE"),
             local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER", "").lower() == "true",
             local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER", "").lower() == "true",
             search_images=USE_GPT4V,
+            http_sessions=http_sessions,
         )
         search_info = await setup_search_info(
             search_service=AZURE_SEARCH_SERVICE, index_name=AZURE_SEARCH_INDEX, azure_credential=azure_credential
@@ -615,31 +995,70 @@ async def setup_clients():
         current_app.config[CONFIG_SPEECH_SERVICE_VOICE] = AZURE_SPEECH_SERVICE_VOICE
         # Wait until token is needed to fetch for the first time
         current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
+        current_app.config[CONFIG_SPEECH_AUDIO_CACHE] = (
+            AudioCache(
+                max_memory_bytes=SPEECH_AUDIO_CACHE_MAX_MEMORY_BYTES,
+                max_disk_bytes=SPEECH_AUDIO_CACHE_MAX_DISK_BYTES,
+                directory=SPEECH_AUDIO_CACHE_DIR,
+                blocking_executor=blocking_executor,
+            )
+            if SPEECH_AUDIO_CACHE_MAX_MEMORY_BYTES > 0
+            else None
+        )
 
+    openai_router: Optional[OpenAIRouter] = None
     if OPENAI_HOST.startswith("azure"):
         if OPENAI_HOST == "azure_custom":
             current_app.logger.info("OPENAI_HOST is azure_custom, setting up Azure OpenAI custom client")
             if not AZURE_OPENAI_CUSTOM_URL:
                 raise ValueError("AZURE_OPENAI_CUSTOM_URL must be set when OPENAI_HOST is azure_custom")
-            endpoint = AZURE_OPENAI_CUSTOM_URL
+            endpoints = [AZURE_OPENAI_CUSTOM_URL]
+        elif AZURE_OPENAI_ENDPOINTS:
+            current_app.logger.info(
+                "AZURE_OPENAI_ENDPOINTS is set, setting up an Azure OpenAI client for each endpoint"
+            )
+            endpoints = AZURE_OPENAI_ENDPOINTS
         else:
             current_app.logger.info("OPENAI_HOST is azure, setting up Azure OpenAI client")
             if not AZURE_OPENAI_SERVICE:
                 raise ValueError("AZURE_OPENAI_SERVICE must be set when OPENAI_HOST is azure")
-            endpoint = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+            endpoints = [f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"]
+        azure_openai_auth: dict[str, Any]
         if api_key := os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"):
             current_app.logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
-            openai_client = AsyncAzureOpenAI(
-                api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=endpoint, api_key=api_key
-            )
+            if len(endpoints) > 1:
+                raise ValueError("AZURE_OPENAI_API_KEY_OVERRIDE can't be used with several AZURE_OPENAI_ENDPOINTS")
+            azure_openai_auth = {"api_key": api_key}
         else:
             current_app.logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
             token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+            azure_openai_auth = {"azure_ad_token_provider": token_provider}
+        if len(endpoints) == 1:
             openai_client = AsyncAzureOpenAI(
-                api_version=AZURE_OPENAI_API_VERSION,
-                azure_endpoint=endpoint,
-                azure_ad_token_provider=token_provider,
+                api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=endpoints[0], **azure_openai_auth
             )
+        else:
+            openai_endpoints = []
+            for endpoint in endpoints:
+                http_client = DefaultAsyncHttpxClient()
+                # Failed calls are sent to another endpoint by the router, instead of being retried on the same endpoint
+                endpoint_client = AsyncAzureOpenAI(
+                    api_version=AZURE_OPENAI_API_VERSION,
+                    azure_endpoint=endpoint,
+                    max_retries=0,
+                    http_client=http_client,
+                    **azure_openai_auth,
+                )
+                # When no other endpoint is left, failed calls are retried on the same endpoint like with a single endpoint
+                openai_endpoint = OpenAIEndpoint(
+                    endpoint,
+                    endpoint_client,
+                    last_resort_client=endpoint_client.with_options(max_retries=DEFAULT_MAX_RETRIES),
+                )
+                http_client.event_hooks = {"response": [openai_endpoint.observe_response]}
+                openai_endpoints.append(openai_endpoint)
+            openai_router = OpenAIRouter(openai_endpoints)
+            openai_client = openai_endpoints[0].client
     elif OPENAI_HOST == "local":
         current_app.logger.info("OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key")
         openai_client = AsyncOpenAI(
@@ -656,6 +1075,7 @@ async def setup_clients():
         )
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
+    current_app.config[CONFIG_OPENAI_ROUTER] = openai_router
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_AGENT_CLIENT] = agent_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
@@ -683,6 +1103,78 @@ async def setup_clients():
     current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED] = USE_CHAT_HISTORY_COSMOS
     current_app.config[CONFIG_AGENTIC_RETRIEVAL_ENABLED] = USE_AGENTIC_RETRIEVAL
 
+    embedding_cache: Optional[TTLCache[list[float]]] = None
+    if EMBEDDING_CACHE_MAX_ENTRIES > 0:
+        embedding_cache = TTLCache(max_entries=EMBEDDING_CACHE_MAX_ENTRIES, ttl=EMBEDDING_CACHE_TTL_SECONDS)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    retrieval_cache: Optional[TTLCache[list[Document]]] = None
+    if RETRIEVAL_CACHE_MAX_BYTES > 0:
+        retrieval_cache = TTLCache(
+            max_entries=10000,
+            ttl=RETRIEVAL_CACHE_TTL_SECONDS,
+            max_bytes=RETRIEVAL_CACHE_MAX_BYTES,
+            size_of=estimate_documents_size,
+        )
+    current_app.config[CONFIG_RETRIEVAL_CACHE] = retrieval_cache
+
+    answer_cache: Optional[SemanticAnswerCache] = None
+    if ANSWER_CACHE_MAX_ENTRIES > 0:
+        if not current_app.config[CONFIG_VECTOR_SEARCH_ENABLED]:
+            raise ValueError("ANSWER_CACHE_MAX_ENTRIES requires an embedding model, so USE_VECTORS must not be false")
+        answer_cache = SemanticAnswerCache(
+            max_entries=ANSWER_CACHE_MAX_ENTRIES,
+            ttl=ANSWER_CACHE_TTL_SECONDS,
+            similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+    history_summary_cache: Optional[TTLCache[str]] = None
+    if USE_HISTORY_SUMMARY:
+        if not HISTORY_TOKEN_BUDGET:
+            raise ValueError("USE_HISTORY_SUMMARY requires HISTORY_TOKEN_BUDGET to be set")
+        history_summary_cache = TTLCache(
+            max_entries=HISTORY_SUMMARY_CACHE_MAX_ENTRIES, ttl=HISTORY_SUMMARY_CACHE_TTL_SECONDS
+        )
+    current_app.config[CONFIG_HISTORY_SUMMARY_CACHE] = history_summary_cache
+
+    # Identical requests, searches, embeddings and deterministic completions that run concurrently are only sent once
+    single_flight = SingleFlight() if USE_REQUEST_COALESCING else None
+    current_app.config[CONFIG_SINGLE_FLIGHT] = single_flight
+
+    admission_controllers: dict[str, AdmissionController] = {}
+    if OPENAI_MAX_CONCURRENCY > 0:
+        admission_controllers[UPSTREAM_OPENAI] = AdmissionController(
+            UPSTREAM_OPENAI, OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE, retry_after=UPSTREAM_RETRY_AFTER_SECONDS
+        )
+    if SEARCH_MAX_CONCURRENCY > 0:
+        admission_controllers[UPSTREAM_SEARCH] = AdmissionController(
+            UPSTREAM_SEARCH, SEARCH_MAX_CONCURRENCY, SEARCH_MAX_QUEUE, retry_after=UPSTREAM_RETRY_AFTER_SECONDS
+        )
+    current_app.config[CONFIG_ADMISSION_CONTROLLERS] = admission_controllers
+
+    hedging_policy = (
+        HedgingPolicy(percentile=SEARCH_HEDGING_PERCENTILE, max_extra_ratio=SEARCH_HEDGING_MAX_EXTRA_RATIO)
+        if USE_SEARCH_HEDGING
+        else None
+    )
+    current_app.config[CONFIG_SEARCH_HEDGING] = hedging_policy
+    current_app.config[CONFIG_SHOW_STAGE_TIMINGS] = SHOW_STAGE_TIMINGS
+
+    # Schedulers are keyed by the model name passed to the OpenAI client, which is the deployment name for Azure OpenAI
+    token_schedulers: dict[str, TokenBudgetScheduler] = {}
+    if OPENAI_CHATGPT_TOKENS_PER_MINUTE > 0:
+        chatgpt_deployment = AZURE_OPENAI_CHATGPT_DEPLOYMENT or OPENAI_CHATGPT_MODEL
+        token_schedulers[chatgpt_deployment] = TokenBudgetScheduler(
+            chatgpt_deployment, OPENAI_CHATGPT_TOKENS_PER_MINUTE, max(OPENAI_CHATGPT_REQUESTS_PER_MINUTE, 1)
+        )
+    if OPENAI_EMB_TOKENS_PER_MINUTE > 0:
+        emb_deployment = AZURE_OPENAI_EMB_DEPLOYMENT or OPENAI_EMB_MODEL
+        token_schedulers[emb_deployment] = TokenBudgetScheduler(
+            emb_deployment, OPENAI_EMB_TOKENS_PER_MINUTE, max(OPENAI_EMB_REQUESTS_PER_MINUTE, 1)
+        )
+    current_app.config[CONFIG_TOKEN_SCHEDULERS] = token_schedulers
+
     prompt_manager = PromptyManager()
 
     # Set up the two default RAG approaches for /ask and /chat
@@ -694,6 +1186,9 @@ async def setup_clients():
         agent_deployment=AZURE_OPENAI_SEARCHAGENT_DEPLOYMENT,
         agent_client=agent_client,
         openai_client=openai_client,
+        openai_router=openai_router,
+        http_sessions=http_sessions,
+        hedging_policy=hedging_policy,
         auth_helper=auth_helper,
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
@@ -707,6 +1202,13 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        embedding_cache=embedding_cache,
+        retrieval_cache=retrieval_cache,
+        answer_cache=answer_cache,
+        single_flight=single_flight,
+        admission_controllers=admission_controllers,
+        token_schedulers=token_schedulers,
+        sources_token_budget=SOURCES_TOKEN_BUDGET or None,
     )
 
     # ChatReadRetrieveReadApproach is used by /chat for multi-turn conversation
@@ -717,6 +1219,9 @@ async def setup_clients():
         agent_deployment=AZURE_OPENAI_SEARCHAGENT_DEPLOYMENT,
         agent_client=agent_client,
         openai_client=openai_client,
+        openai_router=openai_router,
+        http_sessions=http_sessions,
+        hedging_policy=hedging_policy,
         auth_helper=auth_helper,
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
@@ -730,6 +1235,16 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        embedding_cache=embedding_cache,
+        retrieval_cache=retrieval_cache,
+        answer_cache=answer_cache,
+        single_flight=single_flight,
+        admission_controllers=admission_controllers,
+        token_schedulers=token_schedulers,
+        sources_token_budget=SOURCES_TOKEN_BUDGET or None,
+        history_token_budget=HISTORY_TOKEN_BUDGET or None,
+        history_summary_cache=history_summary_cache,
+        use_speculative_search=USE_SPECULATIVE_SEARCH,
     )
 
     if USE_GPT4V:
@@ -750,10 +1265,26 @@ async def setup_clients():
             )
 
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+        image_cache: Optional[ImageCache] = None
+        if IMAGE_CACHE_MAX_BYTES > 0:
+            image_cache = ImageCache(max_bytes=IMAGE_CACHE_MAX_BYTES, revalidate_after=IMAGE_CACHE_REVALIDATE_SECONDS)
+        current_app.config[CONFIG_IMAGE_CACHE] = image_cache
+        image_preparer: Optional[ImagePreparer] = None
+        if IMAGE_MAX_LONG_EDGE or IMAGE_FORMAT != "png" or IMAGE_DETAIL:
+            image_preparer = ImagePreparer(
+                max_long_edge=IMAGE_MAX_LONG_EDGE or None,
+                image_format=IMAGE_FORMAT,
+                quality=IMAGE_QUALITY,
+                detail=cast(Any, IMAGE_DETAIL),
+                blocking_executor=blocking_executor,
+            )
 
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
             openai_client=openai_client,
+            openai_router=openai_router,
+            http_sessions=http_sessions,
+            hedging_policy=hedging_policy,
             blob_container_client=blob_container_client,
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
@@ -769,11 +1300,24 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            retrieval_cache=retrieval_cache,
+            answer_cache=answer_cache,
+            single_flight=single_flight,
+            admission_controllers=admission_controllers,
+            token_schedulers=token_schedulers,
+            sources_token_budget=SOURCES_TOKEN_BUDGET or None,
+            image_cache=image_cache,
+            image_fetch_concurrency=IMAGE_FETCH_CONCURRENCY,
+            image_preparer=image_preparer,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
             search_client=search_client,
             openai_client=openai_client,
+            openai_router=openai_router,
+            http_sessions=http_sessions,
+            hedging_policy=hedging_policy,
             blob_container_client=blob_container_client,
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
@@ -791,6 +1335,16 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            retrieval_cache=retrieval_cache,
+            answer_cache=answer_cache,
+            single_flight=single_flight,
+            admission_controllers=admission_controllers,
+            token_schedulers=token_schedulers,
+            sources_token_budget=SOURCES_TOKEN_BUDGET or None,
+            image_cache=image_cache,
+            image_fetch_concurrency=IMAGE_FETCH_CONCURRENCY,
+            image_preparer=image_preparer,
         )
 
 
@@ -800,15 +1354,30 @@ async def close_clients():
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_CONTENT_SAS_GENERATOR):
+        await current_app.config[CONFIG_CONTENT_SAS_GENERATOR].close()
+    if current_app.config.get(CONFIG_BLOCKING_EXECUTOR):
+        current_app.config[CONFIG_BLOCKING_EXECUTOR].shutdown()
+    if current_app.config.get(CONFIG_HTTP_SESSIONS):
+        await current_app.config[CONFIG_HTTP_SESSIONS].close()
 
 
 def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.register_blueprint(chat_history_cosmosdb_bp)
+    app.register_blueprint(metrics_bp)
 
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
         app.logger.info("APPLICATIONINSIGHTS_CONNECTION_STRING is set, enabling Azure Monitor")
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        from opentelemetry.instrumentation.aiohttp_client import (
+            AioHttpClientInstrumentor,
+        )
+        from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+        from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+        from opentelemetry.instrumentation.openai import OpenAIInstrumentor
+
         configure_azure_monitor()
         # This tracks HTTP requests made by aiohttp:
         AioHttpClientInstrumentor().instrument()
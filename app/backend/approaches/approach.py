@@ -1,11 +1,14 @@
+import asyncio
+import copy
+import json
 import os
 from abc import ABC
-from collections.abc import AsyncGenerator, Awaitable
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Hashable
+from contextlib import AbstractAsyncContextManager, AsyncExitStack, nullcontext
 from dataclasses import dataclass
-from typing import Any, Callable, Optional, TypedDict, Union, cast
+from typing import Any, Callable, Optional, TypedDict, TypeVar, Union, cast
 from urllib.parse import urljoin
 
-import aiohttp
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.agent.models import (
     KnowledgeAgentAzureSearchDocReference,
@@ -23,7 +26,7 @@ from azure.search.documents.models import (
     VectorizedQuery,
     VectorQuery,
 )
-from openai import AsyncOpenAI, AsyncStream
+from openai import AsyncOpenAI, AsyncStream, RateLimitError
 from openai.types import CompletionUsage
 from openai.types.chat import (
     ChatCompletion,
@@ -34,7 +37,40 @@ from openai.types.chat import (
 )
 
 from approaches.promptmanager import PromptManager
+from core.admission import (
+    UPSTREAM_OPENAI,
+    UPSTREAM_SEARCH,
+    AdmissionController,
+    admitted,
+)
+from core.answercache import CachedAnswer, SemanticAnswerCache, SemanticCacheHit
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry, http_session
+from core.metrics import measure_upstream, record_token_usage
+from core.openairouter import OPERATION_CHAT, OPERATION_EMBEDDINGS, OpenAIRouter
+from core.singleflight import SingleFlight
+from core.timings import (
+    STAGE_COALESCED,
+    STAGE_EMBEDDING,
+    STAGE_IMAGE_EMBEDDING,
+    STAGE_QUERY_VECTORS,
+    STAGE_SEARCH,
+    StageTimings,
+    get_stage_timings,
+    measure_stage,
+)
+from core.tokenbudget import (
+    PRIORITIES,
+    PRIORITY_INTERACTIVE,
+    TokenBudgetScheduler,
+    estimate_messages_tokens,
+    estimate_text_tokens,
+    pack_sources,
+)
+
+T = TypeVar("T")
 
 
 @dataclass
@@ -79,6 +115,37 @@ class Document:
         return result_dict
 
 
+def estimate_documents_size(documents: list[Document]) -> int:
+    """Roughly estimates the memory used by a list of search results, for the retrieval cache size limit"""
+    size = 0
+    for document in documents:
+        # Fixed overhead for the object and its short fields, plus the variable length text fields
+        size += 500 + len(document.content or "")
+        size += sum(len(caption.text or "") for caption in document.captions or [])
+    return size
+
+
+async def gather_or_cancel(*calls: Awaitable[T]) -> list[T]:
+    """Runs the calls concurrently like asyncio.gather, but cancels the other calls as soon as one of them fails"""
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def release_after_stream(stream: AsyncIterator[T], resources: AsyncExitStack) -> AsyncGenerator[T, None]:
+    """Yields the items of the stream, then releases the resources once the stream is fully read or closed"""
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        await resources.aclose()
+
+
 @dataclass
 class ThoughtStep:
     title: str
@@ -87,7 +154,13 @@ class ThoughtStep:
 
     def update_token_usage(self, usage: CompletionUsage) -> None:
         if self.props:
-            self.props["token_usage"] = TokenUsageProps.from_completion_usage(usage)
+            token_usage = TokenUsageProps.from_completion_usage(usage)
+            token_usage.record(self.props.get("model", ""))
+            self.props["token_usage"] = token_usage
+
+    def update_timings(self, timings: StageTimings) -> None:
+        if self.props is not None:
+            self.props["timings"] = timings.as_props()
 
 
 @dataclass
@@ -121,6 +194,18 @@ class TokenUsageProps:
             total_tokens=usage.total_tokens,
         )
 
+    def record(self, model: str) -> None:
+        """Adds the usage to the token counters of the metrics endpoint"""
+        record_token_usage(model, self.prompt_tokens, self.completion_tokens, self.reasoning_tokens)
+
+
+@dataclass
+class AnswerCacheLookup:
+    partition_key: Hashable
+    question: str
+    embedding: list[float]
+    hit: Optional[SemanticCacheHit] = None
+
 
 # GPT reasoning models don't support the same set of parameters as other models
 # https://learn.microsoft.com/azure/ai-services/openai/how-to/reasoning
@@ -155,6 +240,16 @@ class Approach(ABC):
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        embedding_cache: Optional[TTLCache[list[float]]] = None,
+        retrieval_cache: Optional[TTLCache[list[Document]]] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission_controllers: Optional[dict[str, AdmissionController]] = None,
+        token_schedulers: Optional[dict[str, TokenBudgetScheduler]] = None,
+        openai_router: Optional[OpenAIRouter] = None,
+        hedging_policy: Optional[HedgingPolicy] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        sources_token_budget: Optional[int] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -170,6 +265,16 @@ class Approach(ABC):
         self.vision_token_provider = vision_token_provider
         self.prompt_manager = prompt_manager
         self.reasoning_effort = reasoning_effort
+        self.embedding_cache = embedding_cache
+        self.retrieval_cache = retrieval_cache
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.admission_controllers = admission_controllers
+        self.token_schedulers = token_schedulers
+        self.openai_router = openai_router
+        self.hedging_policy = hedging_policy
+        self.http_sessions = http_sessions
+        self.sources_token_budget = sources_token_budget
         self.include_token_usage = True
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
@@ -198,59 +303,90 @@ class Approach(ABC):
         minimum_search_score: Optional[float] = None,
         minimum_reranker_score: Optional[float] = None,
         use_query_rewriting: Optional[bool] = None,
+        bypass_cache: bool = False,
     ) -> list[Document]:
         search_text = query_text if use_text_search else ""
         search_vectors = vectors if use_vector_search else []
-        if use_semantic_ranker:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                query_rewrites="generative" if use_query_rewriting else None,
-                vector_queries=search_vectors,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                semantic_query=query_text,
-            )
-        else:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                vector_queries=search_vectors,
-            )
-
-        documents = []
-        async for page in results.by_page():
-            async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        oids=document.get("oids"),
-                        groups=document.get("groups"),
-                        captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
+        # The key includes every parameter that affects the results, notably the filter,
+        # so that results retrieved for one user are never returned to a user with different access.
+        cache_key = (
+            search_text,
+            query_text if use_semantic_ranker else None,
+            filter,
+            tuple(json.dumps(vector.as_dict(), sort_keys=True) for vector in search_vectors),
+            top,
+            use_semantic_ranker,
+            use_semantic_captions,
+            bool(use_query_rewriting),
+            minimum_search_score or 0,
+            minimum_reranker_score or 0,
+            self.query_language,
+            self.query_speller,
+        )
+        if self.retrieval_cache is not None and not bypass_cache:
+            cached_documents = self.retrieval_cache.get(cache_key)
+            if cached_documents is not None:
+                return list(cached_documents)
+
+        async def search_index() -> list[Document]:
+            async with self.admit(UPSTREAM_SEARCH), measure_upstream(UPSTREAM_SEARCH):
+                if use_semantic_ranker:
+                    results = await self.search_client.search(
+                        search_text=search_text,
+                        filter=filter,
+                        top=top,
+                        query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                        query_rewrites="generative" if use_query_rewriting else None,
+                        vector_queries=search_vectors,
+                        query_type=QueryType.SEMANTIC,
+                        query_language=self.query_language,
+                        query_speller=self.query_speller,
+                        semantic_configuration_name="default",
+                        semantic_query=query_text,
+                    )
+                else:
+                    results = await self.search_client.search(
+                        search_text=search_text,
+                        filter=filter,
+                        top=top,
+                        vector_queries=search_vectors,
                     )
-                )
 
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
-                )
-            ]
+                documents = []
+                async for page in results.by_page():
+                    async for document in page:
+                        documents.append(
+                            Document(
+                                id=document.get("id"),
+                                content=document.get("content"),
+                                category=document.get("category"),
+                                sourcepage=document.get("sourcepage"),
+                                sourcefile=document.get("sourcefile"),
+                                oids=document.get("oids"),
+                                groups=document.get("groups"),
+                                captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
+                                score=document.get("@search.score"),
+                                reranker_score=document.get("@search.reranker_score"),
+                            )
+                        )
 
-        return qualified_documents
+                return [
+                    doc
+                    for doc in documents
+                    if (
+                        (doc.score or 0) >= (minimum_search_score or 0)
+                        and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
+                    )
+                ]
+
+        # Identical searches that are already in flight for other requests are awaited instead of being sent again
+        with measure_stage(STAGE_SEARCH):
+            qualified_documents = await self.run_single_flight(
+                ("search", cache_key), lambda: self.run_hedged("search", search_index)
+            )
+        if self.retrieval_cache is not None and not bypass_cache:
+            self.retrieval_cache.set(cache_key, list(qualified_documents))
+        return list(qualified_documents)
 
     async def run_agentic_retrieval(
         self,
@@ -264,26 +400,32 @@ class Approach(ABC):
         results_merge_strategy: Optional[str] = None,
     ) -> tuple[KnowledgeAgentRetrievalResponse, list[Document]]:
         # STEP 1: Invoke agentic retrieval
-        response = await agent_client.retrieve(
-            retrieval_request=KnowledgeAgentRetrievalRequest(
-                messages=[
-                    KnowledgeAgentMessage(
-                        role=str(msg["role"]), content=[KnowledgeAgentMessageTextContent(text=str(msg["content"]))]
+        async def retrieve() -> KnowledgeAgentRetrievalResponse:
+            async with self.admit(UPSTREAM_SEARCH), measure_upstream(UPSTREAM_SEARCH):
+                return await agent_client.retrieve(
+                    retrieval_request=KnowledgeAgentRetrievalRequest(
+                        messages=[
+                            KnowledgeAgentMessage(
+                                role=str(msg["role"]),
+                                content=[KnowledgeAgentMessageTextContent(text=str(msg["content"]))],
+                            )
+                            for msg in messages
+                            if msg["role"] != "system"
+                        ],
+                        target_index_params=[
+                            KnowledgeAgentIndexParams(
+                                index_name=search_index_name,
+                                reranker_threshold=minimum_reranker_score,
+                                max_docs_for_reranker=max_docs_for_reranker,
+                                filter_add_on=filter_add_on,
+                                include_reference_source_data=True,
+                            )
+                        ],
                     )
-                    for msg in messages
-                    if msg["role"] != "system"
-                ],
-                target_index_params=[
-                    KnowledgeAgentIndexParams(
-                        index_name=search_index_name,
-                        reranker_threshold=minimum_reranker_score,
-                        max_docs_for_reranker=max_docs_for_reranker,
-                        filter_add_on=filter_add_on,
-                        include_reference_source_data=True,
-                    )
-                ],
-            )
-        )
+                )
+
+        with measure_stage(STAGE_SEARCH):
+            response = await self.run_hedged("agentic_retrieval", retrieve)
 
         # STEP 2: Generate a contextual and content specific answer using the search results and chat history
         activities = response.activity
@@ -340,6 +482,15 @@ class Approach(ABC):
                 for doc in results
             ]
 
+    def pack_sources_content(self, sources: list[str], model: str) -> tuple[list[str], Optional[dict[str, int]]]:
+        """
+        Fits the sources into the token budget of the sources, when it's set, so that long chunks like large tables
+        don't make the prompt longer than expected. Returns the packed sources with the packing stats.
+        """
+        if not self.sources_token_budget:
+            return sources, None
+        return pack_sources(model, sources, self.sources_token_budget)
+
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
             return sourcepage
@@ -352,7 +503,153 @@ class Approach(ABC):
 
             return sourcepage
 
-    async def compute_text_embedding(self, q: str):
+    def admit(self, upstream: str) -> AbstractAsyncContextManager[None]:
+        controller = self.admission_controllers.get(upstream) if self.admission_controllers else None
+        return admitted(controller)
+
+    def get_priority(self, overrides: dict[str, Any]) -> int:
+        return PRIORITIES.get(overrides.get("priority") or "", PRIORITY_INTERACTIVE)
+
+    def get_token_scheduler(self, deployment: str) -> Optional[TokenBudgetScheduler]:
+        return self.token_schedulers.get(deployment) if self.token_schedulers else None
+
+    async def call_openai(self, fn: Callable[[AsyncOpenAI], Awaitable[T]], operation: str = OPERATION_CHAT) -> T:
+        """Calls fn with the OpenAI client, or with the client of the endpoint chosen by the router if there is one"""
+        async with measure_upstream(UPSTREAM_OPENAI):
+            if self.openai_router is None:
+                return await fn(self.openai_client)
+            return await self.openai_router.call(fn, operation)
+
+    async def create_with_token_budget(self, scheduler: Optional[TokenBudgetScheduler], resource: Any, **kwargs) -> Any:
+        # The quota reported by one endpoint of the router doesn't apply to its other endpoints, so it isn't used
+        if scheduler is None or self.openai_router is not None:
+            return await resource.create(**kwargs)
+        # The raw response gives access to the headers reporting the remaining quota of the deployment
+        try:
+            response = await resource.with_raw_response.create(**kwargs)
+        except RateLimitError as error:
+            scheduler.record_rate_limit(error.response.headers)
+            raise
+        scheduler.update_from_headers(response.headers)
+        return response.parse()
+
+    async def run_hedged(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        if self.hedging_policy is None:
+            return await fn()
+        return await self.hedging_policy.run(key, fn)
+
+    async def run_single_flight(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        if self.single_flight is None:
+            return await fn()
+        return await self.single_flight.do(key, fn)
+
+    async def run_coalesced(
+        self, key: Hashable, fn: Callable[[], Awaitable[dict[str, Any]]], session_state: Any
+    ) -> dict[str, Any]:
+        """
+        Runs fn once for identical concurrent requests, each request receiving its own copy of the response
+        with its own session state. The requests that joined a response in flight report the wait as the
+        coalesced stage, instead of the stage timings of the request that generated the response.
+        """
+        if self.single_flight is None:
+            raise ValueError("Request coalescing is not enabled")
+        coalesced = self.single_flight.is_in_flight(key)
+        with measure_stage(STAGE_COALESCED) if coalesced else nullcontext():
+            response = await self.single_flight.do(key, fn)
+        context: ExtraInfo = copy.deepcopy(response["context"])
+        if coalesced:
+            for thought in context.thoughts or []:
+                if thought.props:
+                    thought.props.pop("timings", None)
+            self.attach_stage_timings(context, get_stage_timings())
+        return response | {"context": context, "session_state": session_state}
+
+    def get_single_flight_key(
+        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Hashable:
+        # Identical requests are the same conversation with the same options, from users with the same access
+        return (
+            type(self).__name__,
+            self.build_filter(overrides, auth_claims),
+            json.dumps([messages, overrides], sort_keys=True, default=str),
+        )
+
+    async def lookup_answer_cache(
+        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[AnswerCacheLookup]:
+        """
+        Looks for the answer to a question similar to the user question in the semantic answer cache.
+        Returns None when the answer can't be cached, otherwise the lookup is passed to save_answer_to_cache on a miss.
+        """
+        if self.answer_cache is None or overrides.get("bypass_answer_cache"):
+            return None
+        # Follow-up questions depend on the conversation, so only the first question of a conversation is cached
+        if len(messages) != 1:
+            return None
+        question = messages[-1]["content"]
+        if not isinstance(question, str):
+            return None
+        # Answers depend on the approach, the documents that the user can access, and every other option of the request
+        options = {
+            key: value for key, value in overrides.items() if not key.startswith("bypass_") and key != "priority"
+        }
+        partition_key = (
+            type(self).__name__,
+            self.build_filter(overrides, auth_claims),
+            json.dumps(options, sort_keys=True, default=str),
+        )
+        embedding = (await self.compute_text_embedding(question, self.get_priority(overrides))).vector
+        return AnswerCacheLookup(
+            partition_key=partition_key,
+            question=question,
+            embedding=embedding,
+            hit=self.answer_cache.get(partition_key, embedding),
+        )
+
+    def save_answer_to_cache(
+        self,
+        lookup: AnswerCacheLookup,
+        content: Optional[str],
+        role: str,
+        extra_info: ExtraInfo,
+        followup_questions: Optional[list[Any]] = None,
+    ) -> None:
+        if self.answer_cache is None:
+            return
+        self.answer_cache.set(
+            lookup.partition_key,
+            " ".join(lookup.question.split()),
+            lookup.embedding,
+            CachedAnswer(
+                question=lookup.question,
+                content=content,
+                role=role,
+                context=extra_info,
+                followup_questions=followup_questions,
+            ),
+        )
+
+    def attach_stage_timings(self, extra_info: ExtraInfo, timings: Optional[StageTimings]) -> None:
+        # The timings of every stage of the request are reported with the last step, which generates the answer
+        if timings is not None and timings.show_in_thoughts and extra_info.thoughts:
+            extra_info.thoughts[-1].update_timings(timings)
+
+    def get_cached_answer_extra_info(self, hit: SemanticCacheHit) -> ExtraInfo:
+        cached_extra_info: ExtraInfo = hit.answer.context
+        return ExtraInfo(
+            cached_extra_info.data_points,
+            thoughts=[
+                ThoughtStep(
+                    "Answer reused from semantic cache",
+                    hit.answer.question,
+                    {"similarity": round(hit.similarity, 3)},
+                ),
+                *(cached_extra_info.thoughts or []),
+            ],
+            followup_questions=hit.answer.followup_questions,
+        )
+
+    async def compute_text_embedding(self, q: str, priority: int = PRIORITY_INTERACTIVE):
         SUPPORTED_DIMENSIONS_MODEL = {
             "text-embedding-ada-002": False,
             "text-embedding-3-small": True,
@@ -365,13 +662,32 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
+        # Identical questions are very common, so reuse the embedding computed for an earlier request if possible.
+        # Only whitespace is normalized, as casing and punctuation can change the embedding.
+        cache_key = (self.embedding_model, self.embedding_deployment, self.embedding_dimensions, " ".join(q.split()))
+        query_vector = self.embedding_cache.get(cache_key) if self.embedding_cache is not None else None
+        if query_vector is None:
+
             # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+            model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+            scheduler = self.get_token_scheduler(model)
+
+            async def create_embedding() -> list[float]:
+                if scheduler is not None:
+                    await scheduler.acquire(estimate_text_tokens(self.embedding_model, q), priority)
+                async with self.admit(UPSTREAM_OPENAI):
+                    embedding = await self.call_openai(
+                        lambda client: self.create_with_token_budget(
+                            scheduler, client.embeddings, model=model, input=q, **dimensions_args
+                        ),
+                        OPERATION_EMBEDDINGS,
+                    )
+                return embedding.data[0].embedding
+
+            with measure_stage(STAGE_EMBEDDING):
+                query_vector = await self.run_single_flight(("embedding", cache_key), create_embedding)
+            if self.embedding_cache is not None:
+                self.embedding_cache.set(cache_key, query_vector)
         # This performs an oversampling due to how the search index was setup,
         # so we do not need to explicitly pass in an oversampling parameter here
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields=self.embedding_field)
@@ -384,14 +700,29 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        with measure_stage(STAGE_IMAGE_EMBEDDING):
+            async with http_session(self.http_sessions, endpoint) as session:
+                async with session.post(
+                    url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                ) as response:
+                    json = await response.json()
+                    image_query_vector = json["vector"]
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
+    async def compute_query_vectors(self, q: str, vector_fields: str, priority: int) -> list[VectorQuery]:
+        """
+        Computes the embeddings of the query for the vector fields of the vision index.
+        The text embedding comes from OpenAI and the image embedding from AI Vision, so both are requested at once,
+        and if one of them fails, the other is cancelled.
+        """
+        embeddings: list[Awaitable[VectorizedQuery]] = []
+        if vector_fields in ["textEmbeddingOnly", "textAndImageEmbeddings"]:
+            embeddings.append(self.compute_text_embedding(q, priority))
+        if vector_fields in ["imageEmbeddingOnly", "textAndImageEmbeddings"]:
+            embeddings.append(self.compute_image_embedding(q))
+        with measure_stage(STAGE_QUERY_VECTORS):
+            return await gather_or_cancel(*embeddings)
+
     def get_system_prompt_variables(self, override_prompt: Optional[str]) -> dict[str, str]:
         # Allows client to replace the entire prompt, or to inject into the existing prompt using >>>
         if override_prompt is None:
@@ -437,7 +768,7 @@ class Approach(ABC):
             # Include parameters that may not be supported for reasoning models
             params = {
                 "max_tokens": response_token_limit,
-                "temperature": temperature or overrides.get("temperature", 0.3),
+                "temperature": temperature if temperature is not None else overrides.get("temperature", 0.3),
             }
         if should_stream:
             params["stream"] = True
@@ -446,13 +777,47 @@ class Approach(ABC):
         params["tools"] = tools
 
         # Azure OpenAI takes the deployment name as the model name
-        return self.openai_client.chat.completions.create(
-            model=chatgpt_deployment if chatgpt_deployment else chatgpt_model,
-            messages=messages,
-            seed=overrides.get("seed", None),
-            n=n or 1,
-            **params,
-        )
+        model = chatgpt_deployment if chatgpt_deployment else chatgpt_model
+        scheduler = self.get_token_scheduler(model)
+
+        async def create() -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+            if scheduler is not None:
+                # The quota of the deployment is consumed by the prompt and by the maximum number of response tokens
+                tokens = estimate_messages_tokens(chatgpt_model, messages, tools) + response_token_limit * (n or 1)
+                await scheduler.acquire(tokens, self.get_priority(overrides))
+            admission = AsyncExitStack()
+            await admission.enter_async_context(self.admit(UPSTREAM_OPENAI))
+            try:
+                completion = await self.call_openai(
+                    lambda client: self.create_with_token_budget(
+                        scheduler,
+                        client.chat.completions,
+                        model=model,
+                        messages=messages,
+                        seed=overrides.get("seed", None),
+                        n=n or 1,
+                        **params,
+                    )
+                )
+            except BaseException:
+                await admission.aclose()
+                raise
+            if should_stream:
+                # The answer is generated while the stream is read, so the call stays admitted until then
+                return release_after_stream(completion, admission)
+            await admission.aclose()
+            return completion
+
+        # Completions with a temperature of 0 and a seed are meant to be reproducible,
+        # so identical completions that are already in flight can be shared
+        if self.single_flight is not None and not should_stream and params.get("temperature") == 0:
+            seed = overrides.get("seed")
+            if seed is not None:
+                key = json.dumps(
+                    [chatgpt_deployment, chatgpt_model, messages, seed, n, params], sort_keys=True, default=str
+                )
+                return cast(Awaitable[ChatCompletion], self.single_flight.do(("chat_completion", key), create))
+        return cast(Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]], create())
 
     def format_thought_step_for_chatcompletion(
         self,
@@ -473,7 +838,9 @@ class Approach(ABC):
                 "reasoning_effort", self.reasoning_effort
             )
         if usage:
-            properties["token_usage"] = TokenUsageProps.from_completion_usage(usage)
+            token_usage = TokenUsageProps.from_completion_usage(usage)
+            token_usage.record(model)
+            properties["token_usage"] = token_usage
         return ThoughtStep(title, messages, properties)
 
     async def run(
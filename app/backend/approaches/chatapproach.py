@@ -15,6 +15,12 @@ from approaches.approach import (
     Approach,
     ExtraInfo,
 )
+from core.timings import (
+    STAGE_GENERATION,
+    STAGE_TIME_TO_FIRST_TOKEN,
+    get_stage_timings,
+    measure_stage,
+)
 
 
 class ChatApproach(Approach, ABC):
@@ -57,10 +63,37 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
+        if self.single_flight is None:
+            return await self.generate_response(messages, overrides, auth_claims, session_state)
+        # Identical concurrent requests share one response
+        return await self.run_coalesced(
+            ("run", self.get_single_flight_key(messages, overrides, auth_claims)),
+            lambda: self.generate_response(messages, overrides, auth_claims),
+            session_state,
+        )
+
+    async def generate_response(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> dict[str, Any]:
+        answer_cache_lookup = await self.lookup_answer_cache(messages, overrides, auth_claims)
+        if answer_cache_lookup and answer_cache_lookup.hit:
+            return {
+                "message": {
+                    "content": answer_cache_lookup.hit.answer.content,
+                    "role": answer_cache_lookup.hit.answer.role,
+                },
+                "context": self.get_cached_answer_extra_info(answer_cache_lookup.hit),
+                "session_state": session_state,
+            }
         extra_info, chat_coroutine = await self.run_until_final_call(
             messages, overrides, auth_claims, should_stream=False
         )
-        chat_completion_response: ChatCompletion = await cast(Awaitable[ChatCompletion], chat_coroutine)
+        with measure_stage(STAGE_GENERATION):
+            chat_completion_response: ChatCompletion = await cast(Awaitable[ChatCompletion], chat_coroutine)
         content = chat_completion_response.choices[0].message.content
         role = chat_completion_response.choices[0].message.role
         if overrides.get("suggest_followup_questions"):
@@ -69,6 +102,9 @@ class ChatApproach(Approach, ABC):
         # Assume last thought is for generating answer
         if self.include_token_usage and extra_info.thoughts and chat_completion_response.usage:
             extra_info.thoughts[-1].update_token_usage(chat_completion_response.usage)
+        self.attach_stage_timings(extra_info, get_stage_timings())
+        if answer_cache_lookup:
+            self.save_answer_to_cache(answer_cache_lookup, content, role, extra_info, extra_info.followup_questions)
         chat_app_response = {
             "message": {"content": content, "role": role},
             "context": extra_info,
@@ -83,14 +119,53 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
+        if self.single_flight is None:
+            async for event in self.generate_response_stream(messages, overrides, auth_claims, session_state):
+                yield event
+            return
+        # Identical concurrent requests are fanned out from one upstream stream,
+        # with the session state of each request
+        async for event in self.single_flight.stream(
+            ("run_stream", self.get_single_flight_key(messages, overrides, auth_claims)),
+            lambda: self.generate_response_stream(messages, overrides, auth_claims),
+        ):
+            yield event | {"session_state": session_state} if "session_state" in event else event
+
+    async def generate_response_stream(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict, None]:
+        # The stream is consumed after the request handler returns, so the timings are kept from the start
+        timings = get_stage_timings()
+        answer_cache_lookup = await self.lookup_answer_cache(messages, overrides, auth_claims)
+        if answer_cache_lookup and answer_cache_lookup.hit:
+            # Replay the cached answer in the same format as a streamed answer
+            cached_answer = answer_cache_lookup.hit.answer
+            cached_extra_info = self.get_cached_answer_extra_info(answer_cache_lookup.hit)
+            yield {"delta": {"role": "assistant"}, "context": cached_extra_info, "session_state": session_state}
+            yield {"delta": {"content": cached_answer.content, "role": cached_answer.role}}
+            if cached_answer.followup_questions:
+                yield {
+                    "delta": {"role": "assistant"},
+                    "context": {"context": cached_extra_info, "followup_questions": cached_answer.followup_questions},
+                }
+            return
+
         extra_info, chat_coroutine = await self.run_until_final_call(
             messages, overrides, auth_claims, should_stream=True
         )
         chat_coroutine = cast(Awaitable[AsyncStream[ChatCompletionChunk]], chat_coroutine)
+        self.attach_stage_timings(extra_info, timings)
         yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
         followup_questions_started = False
         followup_content = ""
+        answer_content = ""
+        generation_started = timings.timer() if timings else 0.0
+        first_token_received = False
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
             event = event_chunk.model_dump()  # Convert pydantic model to dict
@@ -105,30 +180,41 @@ class ChatApproach(Approach, ABC):
                 # if event contains << and not >>, it is start of follow-up question, truncate
                 content = completion["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
+                if content and timings and not first_token_received:
+                    first_token_received = True
+                    timings.record(STAGE_TIME_TO_FIRST_TOKEN, timings.timer() - generation_started)
                 if overrides.get("suggest_followup_questions") and "<<" in content:
                     followup_questions_started = True
                     earlier_content = content[: content.index("<<")]
                     if earlier_content:
                         completion["delta"]["content"] = earlier_content
+                        answer_content += earlier_content
                         yield completion
                     followup_content += content[content.index("<<") :]
                 elif followup_questions_started:
                     followup_content += content
                 else:
+                    answer_content += content
                     yield completion
             else:
                 # Final chunk at end of streaming should contain usage
                 # https://cookbook.openai.com/examples/how_to_stream_completions#4-how-to-get-token-usage-data-for-streamed-chat-completion-response
                 if event_chunk.usage and extra_info.thoughts and self.include_token_usage:
                     extra_info.thoughts[-1].update_token_usage(event_chunk.usage)
+                    if timings:
+                        timings.record(STAGE_GENERATION, timings.timer() - generation_started)
+                        self.attach_stage_timings(extra_info, timings)
                     yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
+        followup_questions = None
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {
                 "delta": {"role": "assistant"},
                 "context": {"context": extra_info, "followup_questions": followup_questions},
             }
+        if answer_cache_lookup:
+            self.save_answer_to_cache(answer_cache_lookup, answer_content, "assistant", extra_info, followup_questions)
 
     async def run(
         self,
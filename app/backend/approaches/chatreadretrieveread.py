@@ -1,3 +1,9 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
 from collections.abc import Awaitable
 from typing import Any, Optional, Union, cast
 
@@ -12,10 +18,19 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
+from approaches.approach import DataPoints, Document, ExtraInfo, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from approaches.promptmanager import PromptManager
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry
+from core.openairouter import OpenAIRouter
+from core.singleflight import SingleFlight
+from core.timings import STAGE_HISTORY_SUMMARY, STAGE_REWRITE, measure_stage
+from core.tokenbudget import TokenBudgetScheduler, trim_messages
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -25,6 +40,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    # Minimum word overlap between the user question and the generated search query
+    # for the results of a speculative search on the user question to be used
+    SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD = 0.8
+
+    # Maximum number of tokens of the summary of the past messages that don't fit in the history token budget
+    HISTORY_SUMMARY_TOKEN_LIMIT = 300
+
     def __init__(
         self,
         *,
@@ -47,6 +69,19 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        embedding_cache: Optional[TTLCache[list[float]]] = None,
+        retrieval_cache: Optional[TTLCache[list[Document]]] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission_controllers: Optional[dict[str, AdmissionController]] = None,
+        token_schedulers: Optional[dict[str, TokenBudgetScheduler]] = None,
+        openai_router: Optional[OpenAIRouter] = None,
+        hedging_policy: Optional[HedgingPolicy] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        use_speculative_search: bool = False,
+        sources_token_budget: Optional[int] = None,
+        history_token_budget: Optional[int] = None,
+        history_summary_cache: Optional[TTLCache[str]] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -61,6 +96,19 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
         self.embedding_field = embedding_field
+        self.embedding_cache = embedding_cache
+        self.retrieval_cache = retrieval_cache
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.admission_controllers = admission_controllers
+        self.token_schedulers = token_schedulers
+        self.openai_router = openai_router
+        self.hedging_policy = hedging_policy
+        self.http_sessions = http_sessions
+        self.sources_token_budget = sources_token_budget
+        self.history_token_budget = history_token_budget
+        # Older messages are summarized only when there's a cache for the summaries
+        self.history_summary_cache = history_summary_cache
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
@@ -69,7 +117,11 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_rewrite_prompt = self.prompt_manager.load_prompt("chat_query_rewrite.prompty")
         self.query_rewrite_tools = self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
         self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question.prompty")
+        self.history_summary_prompt = self.prompt_manager.load_prompt("chat_summarize_history.prompty")
         self.reasoning_effort = reasoning_effort
+        self.use_speculative_search = use_speculative_search
+        self.speculative_search_attempts = 0
+        self.speculative_search_hits = 0
         self.include_token_usage = True
 
     async def run_until_final_call(
@@ -87,10 +139,14 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             raise Exception(
                 f"{self.chatgpt_model} does not support streaming. Please use a different model or disable streaming."
             )
+        past_messages, history_thought = await self.fit_past_messages(messages[:-1], overrides)
+        messages = past_messages + messages[-1:]
         if use_agentic_retrieval:
             extra_info = await self.run_agentic_retrieval_approach(messages, overrides, auth_claims)
         else:
             extra_info = await self.run_search_approach(messages, overrides, auth_claims)
+        if history_thought:
+            extra_info.thoughts.insert(0, history_thought)
 
         messages = self.prompt_manager.render_prompt(
             self.answer_prompt,
@@ -126,6 +182,85 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
         return (extra_info, chat_coroutine)
 
+    async def fit_past_messages(
+        self, past_messages: list[ChatCompletionMessageParam], overrides: dict[str, Any]
+    ) -> tuple[list[ChatCompletionMessageParam], Optional[ThoughtStep]]:
+        """
+        Keeps the newest past messages that fit in the history token budget, when it's set,
+        so that long conversations don't make every turn slower and more expensive.
+        The older messages are replaced by a summary when there's a summary cache.
+        """
+        if not self.history_token_budget:
+            return past_messages, None
+        kept, dropped = trim_messages(self.chatgpt_model, past_messages, self.history_token_budget)
+        props: dict[str, Any] = {
+            "token_budget": self.history_token_budget,
+            "kept_messages": len(kept),
+            "dropped_messages": len(dropped),
+        }
+        summary: Optional[str] = None
+        if dropped and self.history_summary_cache is not None:
+            # Also reported as the history_summary stage of the Server-Timing header
+            with measure_stage(STAGE_HISTORY_SUMMARY) as measurement:
+                try:
+                    summary, props["summary"] = await self.summarize_messages(dropped, overrides)
+                except Exception:
+                    logging.exception("Summarizing the chat history failed, sending the kept messages only")
+            props["summary_latency_ms"] = round(measurement.duration * 1000)
+        if summary:
+            kept = [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}, *kept]
+        return kept, ThoughtStep("Fit chat history into token budget", summary, props)
+
+    @staticmethod
+    def get_history_keys(messages: list[ChatCompletionMessageParam]) -> list[str]:
+        """Returns a key for each prefix of the messages, each key being the hash of the previous key and the next message"""
+        keys = []
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(json.dumps(message, sort_keys=True, default=str).encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    async def summarize_messages(
+        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any]
+    ) -> tuple[str, str]:
+        """
+        Returns a rolling summary of the messages, with whether it was "cached" or "generated".
+        Summaries are cached by the messages they summarize, so that the next turn, which drops more messages,
+        only summarizes the previous summary with the newly dropped messages.
+        """
+        if self.history_summary_cache is None:
+            raise ValueError("Summarizing messages requires a history summary cache")
+        keys = self.get_history_keys(messages)
+        summary: Optional[str] = None
+        summarized = len(messages)
+        while summarized > 0 and keys[summarized - 1] not in self.history_summary_cache:
+            summarized -= 1
+        if summarized > 0:
+            summary = self.history_summary_cache.get(keys[summarized - 1])
+            if summary is not None and summarized == len(messages):
+                return summary, "cached"
+        summary_messages = self.prompt_manager.render_prompt(
+            self.history_summary_prompt, {"summary": summary, "past_messages": messages[summarized:]}
+        )
+        chat_completion = cast(
+            ChatCompletion,
+            await self.create_chat_completion(
+                self.chatgpt_deployment,
+                self.chatgpt_model,
+                messages=summary_messages,
+                overrides=overrides,
+                response_token_limit=self.get_response_token_limit(
+                    self.chatgpt_model, self.HISTORY_SUMMARY_TOKEN_LIMIT
+                ),
+                temperature=0.0,
+                reasoning_effort="low",
+            ),
+        )
+        summary = chat_completion.choices[0].message.content or ""
+        self.history_summary_cache.set(keys[-1], summary)
+        return summary, "generated"
+
     async def run_search_approach(
         self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
     ):
@@ -134,6 +269,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         use_query_rewriting = True if overrides.get("query_rewriting") else False
+        bypass_retrieval_cache = True if overrides.get("bypass_retrieval_cache") else False
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
@@ -148,49 +284,93 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
         tools: list[ChatCompletionToolParam] = self.query_rewrite_tools
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        async def search_for_query(query_text: str) -> list[Document]:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors: list[VectorQuery] = []
+            if use_vector_search:
+                vectors.append(await self.compute_text_embedding(query_text, self.get_priority(overrides)))
 
-        chat_completion = cast(
-            ChatCompletion,
-            await self.create_chat_completion(
-                self.chatgpt_deployment,
-                self.chatgpt_model,
-                messages=query_messages,
-                overrides=overrides,
-                response_token_limit=self.get_response_token_limit(
-                    self.chatgpt_model, 100
-                ),  # Setting too low risks malformed JSON, setting too high may affect performance
-                temperature=0.0,  # Minimize creativity for search query generation
-                tools=tools,
-                reasoning_effort="low",  # Minimize reasoning for search query generation
-            ),
-        )
+            return await self.search(
+                top,
+                query_text,
+                search_index_filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                use_query_rewriting,
+                bypass_cache=bypass_retrieval_cache,
+            )
+
+        async def speculative_search_for_query(query_text: str) -> tuple[list[Document], float]:
+            started = time.monotonic()
+            results = await search_for_query(query_text)
+            return results, time.monotonic() - started
+
+        # On the first turn of a conversation, the generated search query is usually equivalent to the user question,
+        # so the user question can be searched while the search query is being generated.
+        speculative_search: Optional[asyncio.Task[tuple[list[Document], float]]] = None
+        if self.use_speculative_search and len(messages) == 1:
+            speculative_search = asyncio.create_task(speculative_search_for_query(original_user_query))
+
+        try:
+            # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+
+            with measure_stage(STAGE_REWRITE):
+                chat_completion = cast(
+                    ChatCompletion,
+                    await self.create_chat_completion(
+                        self.chatgpt_deployment,
+                        self.chatgpt_model,
+                        messages=query_messages,
+                        overrides=overrides,
+                        response_token_limit=self.get_response_token_limit(
+                            self.chatgpt_model, 100
+                        ),  # Setting too low risks malformed JSON, setting too high may affect performance
+                        temperature=0.0,  # Minimize creativity for search query generation
+                        tools=tools,
+                        reasoning_effort="low",  # Minimize reasoning for search query generation
+                    ),
+                )
+        except BaseException:
+            if speculative_search:
+                speculative_search.cancel()
+            raise
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            search_index_filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-            use_query_rewriting,
-        )
+        results: Optional[list[Document]] = None
+        speculative_search_props: Optional[dict[str, Any]] = None
+        if speculative_search:
+            self.speculative_search_attempts += 1
+            match, similarity = self.compare_search_queries(original_user_query, query_text)
+            speculative_search_props = {"match": match, "similarity": round(similarity, 3)}
+            if match == "none":
+                speculative_search.cancel()
+                await asyncio.gather(speculative_search, return_exceptions=True)
+            else:
+                try:
+                    results, speculative_search_latency = await speculative_search
+                    # The results were retrieved for the user question, so report that as the search query
+                    query_text = original_user_query
+                    self.speculative_search_hits += 1
+                    speculative_search_props["latency_ms"] = round(speculative_search_latency * 1000)
+                except Exception:
+                    logging.exception("Speculative search failed, searching with the generated search query")
+            speculative_search_props["used"] = results is not None
+            speculative_search_props["hit_rate"] = round(
+                self.speculative_search_hits / self.speculative_search_attempts, 3
+            )
+        if results is None:
+            results = await search_for_query(query_text)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        text_sources, source_packing = self.pack_sources_content(text_sources, self.chatgpt_model)
 
         extra_info = ExtraInfo(
             DataPoints(text=text_sources),
@@ -215,16 +395,41 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         "filter": search_index_filter,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
-                    },
+                    }
+                    | ({"speculative_search": speculative_search_props} if speculative_search_props else {}),
                 ),
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
+                    {"source_packing": source_packing} if source_packing else None,
                 ),
             ],
         )
         return extra_info
 
+    @staticmethod
+    def normalize_search_query(query: str) -> list[str]:
+        return re.findall(r"\w+", query.casefold())
+
+    def compare_search_queries(self, user_query: str, search_query: str) -> tuple[str, float]:
+        """
+        Checks whether the generated search query is equivalent to the user question,
+        returning the kind of match ("exact", "normalized", "similar" or "none") and the word overlap
+        """
+        if user_query.strip() == search_query.strip():
+            return "exact", 1.0
+        user_words = self.normalize_search_query(user_query)
+        search_words = self.normalize_search_query(search_query)
+        if user_words == search_words:
+            return "normalized", 1.0
+        user_word_set, search_word_set = set(user_words), set(search_words)
+        if not user_word_set or not search_word_set:
+            return "none", 0.0
+        similarity = len(user_word_set & search_word_set) / len(user_word_set | search_word_set)
+        if similarity >= self.SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD:
+            return "similar", similarity
+        return "none", similarity
+
     async def run_agentic_retrieval_approach(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -251,6 +456,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
 
         text_sources = self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False)
+        text_sources, source_packing = self.pack_sources_content(text_sources, self.chatgpt_model)
 
         extra_info = ExtraInfo(
             DataPoints(text=text_sources),
@@ -274,7 +480,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         ),
                         "model": self.agent_model,
                         "deployment": self.agent_deployment,
-                    },
+                    }
+                    | ({"source_packing": source_packing} if source_packing else {}),
                 ),
             ],
         )
@@ -2,6 +2,7 @@ from collections.abc import Awaitable
 from typing import Any, Callable, Optional, Union, cast
 
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -11,11 +12,20 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
+from approaches.approach import DataPoints, Document, ExtraInfo, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from approaches.promptmanager import PromptManager
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry
+from core.imageshelper import ImageCache, ImagePreparer, fetch_images
+from core.openairouter import OpenAIRouter
+from core.singleflight import SingleFlight
+from core.timings import STAGE_FETCH_IMAGE, STAGE_REWRITE, measure_stage
+from core.tokenbudget import TokenBudgetScheduler
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -47,6 +57,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        embedding_cache: Optional[TTLCache[list[float]]] = None,
+        retrieval_cache: Optional[TTLCache[list[Document]]] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission_controllers: Optional[dict[str, AdmissionController]] = None,
+        token_schedulers: Optional[dict[str, TokenBudgetScheduler]] = None,
+        openai_router: Optional[OpenAIRouter] = None,
+        hedging_policy: Optional[HedgingPolicy] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        image_cache: Optional[ImageCache] = None,
+        image_fetch_concurrency: int = 8,
+        image_preparer: Optional[ImagePreparer] = None,
+        sources_token_budget: Optional[int] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -60,6 +83,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
         self.embedding_field = embedding_field
+        self.embedding_cache = embedding_cache
+        self.retrieval_cache = retrieval_cache
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.admission_controllers = admission_controllers
+        self.token_schedulers = token_schedulers
+        self.openai_router = openai_router
+        self.hedging_policy = hedging_policy
+        self.http_sessions = http_sessions
+        self.sources_token_budget = sources_token_budget
+        self.image_cache = image_cache
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.image_preparer = image_preparer
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
@@ -85,6 +121,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
         use_query_rewriting = True if overrides.get("query_rewriting") else False
+        bypass_retrieval_cache = True if overrides.get("bypass_retrieval_cache") else False
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
@@ -106,28 +143,28 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         tools: list[ChatCompletionToolParam] = self.query_rewrite_tools
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=query_messages,
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,
-            n=1,
-            tools=tools,
-            seed=seed,
-        )
+        with measure_stage(STAGE_REWRITE):
+            chat_completion: ChatCompletion = await self.call_openai(
+                lambda client: client.chat.completions.create(
+                    messages=query_messages,
+                    # Azure OpenAI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,  # Minimize creativity for search query generation
+                    max_tokens=100,
+                    n=1,
+                    tools=tools,
+                    seed=seed,
+                )
+            )
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        vectors: list[VectorQuery] = []
         if use_vector_search:
-            if vector_fields == "textEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_text_embedding(query_text))
-            if vector_fields == "imageEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_image_embedding(query_text))
+            vectors = await self.compute_query_vectors(query_text, vector_fields, self.get_priority(overrides))
 
         results = await self.search(
             top,
@@ -141,18 +178,25 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             minimum_search_score,
             minimum_reranker_score,
             use_query_rewriting,
+            bypass_cache=bypass_retrieval_cache,
         )
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         text_sources = []
-        image_sources = []
+        source_packing: Optional[dict[str, int]] = None
+        image_sources: list[str] = []
         if send_text_to_gptvision:
             text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
+            text_sources, source_packing = self.pack_sources_content(text_sources, self.gpt4v_model)
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_sources.append(url)
+            with measure_stage(STAGE_FETCH_IMAGE):
+                image_sources = await fetch_images(
+                    self.blob_container_client,
+                    results,
+                    self.image_cache,
+                    self.image_fetch_concurrency,
+                    self.image_preparer,
+                )
 
         messages = self.prompt_manager.render_prompt(
             self.answer_prompt,
@@ -165,6 +209,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 "image_sources": image_sources,
             },
         )
+        if self.image_preparer is not None:
+            messages = self.image_preparer.set_detail(messages)
 
         extra_info = ExtraInfo(
             DataPoints(text=text_sources, images=image_sources),
@@ -194,6 +240,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
+                    {"source_packing": source_packing} if source_packing else None,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
@@ -209,14 +256,16 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         chat_coroutine = cast(
             Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]],
-            self.openai_client.chat.completions.create(
-                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-                messages=messages,
-                temperature=overrides.get("temperature", 0.3),
-                max_tokens=1024,
-                n=1,
-                stream=should_stream,
-                seed=seed,
+            self.call_openai(
+                lambda client: client.chat.completions.create(
+                    model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                    messages=messages,
+                    temperature=overrides.get("temperature", 0.3),
+                    max_tokens=1024,
+                    n=1,
+                    stream=should_stream,
+                    seed=seed,
+                )
             ),
         )
         return (extra_info, chat_coroutine)
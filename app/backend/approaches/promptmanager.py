@@ -4,6 +4,8 @@ import pathlib
 import prompty
 from openai.types.chat import ChatCompletionMessageParam
 
+from core.timings import STAGE_PROMPT_RENDER, measure_stage
+
 
 class PromptManager:
 
@@ -28,4 +30,5 @@ class PromptyManager(PromptManager):
         return json.loads(open(self.PROMPTS_DIRECTORY / path).read())
 
     def render_prompt(self, prompt, data) -> list[ChatCompletionMessageParam]:
-        return prompty.prepare(prompt, data)
+        with measure_stage(STAGE_PROMPT_RENDER):
+            return prompty.prepare(prompt, data)
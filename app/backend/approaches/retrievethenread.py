@@ -6,9 +6,18 @@ from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 
-from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
+from approaches.approach import Approach, DataPoints, Document, ExtraInfo, ThoughtStep
 from approaches.promptmanager import PromptManager
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry
+from core.openairouter import OpenAIRouter
+from core.singleflight import SingleFlight
+from core.timings import STAGE_GENERATION, get_stage_timings, measure_stage
+from core.tokenbudget import TokenBudgetScheduler
 
 
 class RetrieveThenReadApproach(Approach):
@@ -40,6 +49,16 @@ class RetrieveThenReadApproach(Approach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        embedding_cache: Optional[TTLCache[list[float]]] = None,
+        retrieval_cache: Optional[TTLCache[list[Document]]] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission_controllers: Optional[dict[str, AdmissionController]] = None,
+        token_schedulers: Optional[dict[str, TokenBudgetScheduler]] = None,
+        openai_router: Optional[OpenAIRouter] = None,
+        hedging_policy: Optional[HedgingPolicy] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        sources_token_budget: Optional[int] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -55,6 +74,16 @@ class RetrieveThenReadApproach(Approach):
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.embedding_field = embedding_field
+        self.embedding_cache = embedding_cache
+        self.retrieval_cache = retrieval_cache
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.admission_controllers = admission_controllers
+        self.token_schedulers = token_schedulers
+        self.openai_router = openai_router
+        self.hedging_policy = hedging_policy
+        self.http_sessions = http_sessions
+        self.sources_token_budget = sources_token_budget
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
@@ -72,11 +101,38 @@ class RetrieveThenReadApproach(Approach):
     ) -> dict[str, Any]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
+        if self.single_flight is None:
+            return await self.generate_response(messages, overrides, auth_claims, session_state)
+        # Identical concurrent requests share one response
+        return await self.run_coalesced(
+            ("run", self.get_single_flight_key(messages, overrides, auth_claims)),
+            lambda: self.generate_response(messages, overrides, auth_claims),
+            session_state,
+        )
+
+    async def generate_response(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> dict[str, Any]:
         use_agentic_retrieval = True if overrides.get("use_agentic_retrieval") else False
         q = messages[-1]["content"]
         if not isinstance(q, str):
             raise ValueError("The most recent message content must be a string.")
 
+        answer_cache_lookup = await self.lookup_answer_cache(messages, overrides, auth_claims)
+        if answer_cache_lookup and answer_cache_lookup.hit:
+            return {
+                "message": {
+                    "content": answer_cache_lookup.hit.answer.content,
+                    "role": answer_cache_lookup.hit.answer.role,
+                },
+                "context": self.get_cached_answer_extra_info(answer_cache_lookup.hit),
+                "session_state": session_state,
+            }
+
         if use_agentic_retrieval:
             extra_info = await self.run_agentic_retrieval_approach(messages, overrides, auth_claims)
         else:
@@ -89,16 +145,17 @@ class RetrieveThenReadApproach(Approach):
             | {"user_query": q, "text_sources": extra_info.data_points.text},
         )
 
-        chat_completion = cast(
-            ChatCompletion,
-            await self.create_chat_completion(
-                self.chatgpt_deployment,
-                self.chatgpt_model,
-                messages=messages,
-                overrides=overrides,
-                response_token_limit=self.get_response_token_limit(self.chatgpt_model, 1024),
-            ),
-        )
+        with measure_stage(STAGE_GENERATION):
+            chat_completion = cast(
+                ChatCompletion,
+                await self.create_chat_completion(
+                    self.chatgpt_deployment,
+                    self.chatgpt_model,
+                    messages=messages,
+                    overrides=overrides,
+                    response_token_limit=self.get_response_token_limit(self.chatgpt_model, 1024),
+                ),
+            )
         extra_info.thoughts.append(
             self.format_thought_step_for_chatcompletion(
                 title="Prompt to generate answer",
@@ -109,6 +166,14 @@ class RetrieveThenReadApproach(Approach):
                 usage=chat_completion.usage,
             )
         )
+        self.attach_stage_timings(extra_info, get_stage_timings())
+        if answer_cache_lookup:
+            self.save_answer_to_cache(
+                answer_cache_lookup,
+                chat_completion.choices[0].message.content,
+                chat_completion.choices[0].message.role,
+                extra_info,
+            )
         return {
             "message": {
                 "content": chat_completion.choices[0].message.content,
@@ -125,6 +190,7 @@ class RetrieveThenReadApproach(Approach):
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
         use_query_rewriting = True if overrides.get("query_rewriting") else False
+        bypass_retrieval_cache = True if overrides.get("bypass_retrieval_cache") else False
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
@@ -135,7 +201,7 @@ class RetrieveThenReadApproach(Approach):
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if use_vector_search:
-            vectors.append(await self.compute_text_embedding(q))
+            vectors.append(await self.compute_text_embedding(q, self.get_priority(overrides)))
 
         results = await self.search(
             top,
@@ -149,9 +215,11 @@ class RetrieveThenReadApproach(Approach):
             minimum_search_score,
             minimum_reranker_score,
             use_query_rewriting,
+            bypass_cache=bypass_retrieval_cache,
         )
 
         text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        text_sources, source_packing = self.pack_sources_content(text_sources, self.chatgpt_model)
 
         return ExtraInfo(
             DataPoints(text=text_sources),
@@ -172,6 +240,7 @@ class RetrieveThenReadApproach(Approach):
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
+                    {"source_packing": source_packing} if source_packing else None,
                 ),
             ],
         )
@@ -202,6 +271,7 @@ class RetrieveThenReadApproach(Approach):
         )
 
         text_sources = self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False)
+        text_sources, source_packing = self.pack_sources_content(text_sources, self.chatgpt_model)
 
         extra_info = ExtraInfo(
             DataPoints(text=text_sources),
@@ -225,7 +295,8 @@ class RetrieveThenReadApproach(Approach):
                         ),
                         "model": self.agent_model,
                         "deployment": self.agent_deployment,
-                    },
+                    }
+                    | ({"source_packing": source_packing} if source_packing else {}),
                 ),
             ],
         )
@@ -2,16 +2,31 @@ from collections.abc import Awaitable
 from typing import Any, Callable, Optional
 
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 
-from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
+from approaches.approach import Approach, DataPoints, Document, ExtraInfo, ThoughtStep
 from approaches.promptmanager import PromptManager
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.httpsessions import HTTPSessionRegistry
+from core.imageshelper import ImageCache, ImagePreparer, fetch_images
+from core.openairouter import OpenAIRouter
+from core.singleflight import SingleFlight
+from core.timings import (
+    STAGE_FETCH_IMAGE,
+    STAGE_GENERATION,
+    get_stage_timings,
+    measure_stage,
+)
+from core.tokenbudget import TokenBudgetScheduler
 
 
 class RetrieveThenReadVisionApproach(Approach):
@@ -41,6 +56,19 @@ class RetrieveThenReadVisionApproach(Approach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        embedding_cache: Optional[TTLCache[list[float]]] = None,
+        retrieval_cache: Optional[TTLCache[list[Document]]] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission_controllers: Optional[dict[str, AdmissionController]] = None,
+        token_schedulers: Optional[dict[str, TokenBudgetScheduler]] = None,
+        openai_router: Optional[OpenAIRouter] = None,
+        hedging_policy: Optional[HedgingPolicy] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        image_cache: Optional[ImageCache] = None,
+        image_fetch_concurrency: int = 8,
+        image_preparer: Optional[ImagePreparer] = None,
+        sources_token_budget: Optional[int] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -50,6 +78,19 @@ class RetrieveThenReadVisionApproach(Approach):
         self.embedding_deployment = embedding_deployment
         self.embedding_dimensions = embedding_dimensions
         self.embedding_field = embedding_field
+        self.embedding_cache = embedding_cache
+        self.retrieval_cache = retrieval_cache
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.admission_controllers = admission_controllers
+        self.token_schedulers = token_schedulers
+        self.openai_router = openai_router
+        self.hedging_policy = hedging_policy
+        self.http_sessions = http_sessions
+        self.sources_token_budget = sources_token_budget
+        self.image_cache = image_cache
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.image_preparer = image_preparer
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.gpt4v_deployment = gpt4v_deployment
@@ -76,10 +117,23 @@ class RetrieveThenReadVisionApproach(Approach):
         overrides = context.get("overrides", {})
         seed = overrides.get("seed", None)
         auth_claims = context.get("auth_claims", {})
+
+        answer_cache_lookup = await self.lookup_answer_cache(messages, overrides, auth_claims)
+        if answer_cache_lookup and answer_cache_lookup.hit:
+            return {
+                "message": {
+                    "content": answer_cache_lookup.hit.answer.content,
+                    "role": answer_cache_lookup.hit.answer.role,
+                },
+                "context": self.get_cached_answer_extra_info(answer_cache_lookup.hit),
+                "session_state": session_state,
+            }
+
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
         use_query_rewriting = True if overrides.get("query_rewriting") else False
+        bypass_retrieval_cache = True if overrides.get("bypass_retrieval_cache") else False
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
@@ -91,12 +145,9 @@ class RetrieveThenReadVisionApproach(Approach):
         send_images_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        vectors: list[VectorQuery] = []
         if use_vector_search:
-            if vector_fields == "textEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_text_embedding(q))
-            if vector_fields == "imageEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_image_embedding(q))
+            vectors = await self.compute_query_vectors(q, vector_fields, self.get_priority(overrides))
 
         results = await self.search(
             top,
@@ -110,33 +161,45 @@ class RetrieveThenReadVisionApproach(Approach):
             minimum_search_score,
             minimum_reranker_score,
             use_query_rewriting,
+            bypass_cache=bypass_retrieval_cache,
         )
 
         # Process results
         text_sources = []
-        image_sources = []
+        source_packing: Optional[dict[str, int]] = None
+        image_sources: list[str] = []
         if send_text_to_gptvision:
             text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
+            text_sources, source_packing = self.pack_sources_content(text_sources, self.gpt4v_model)
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_sources.append(url)
+            with measure_stage(STAGE_FETCH_IMAGE):
+                image_sources = await fetch_images(
+                    self.blob_container_client,
+                    results,
+                    self.image_cache,
+                    self.image_fetch_concurrency,
+                    self.image_preparer,
+                )
 
         messages = self.prompt_manager.render_prompt(
             self.answer_prompt,
             self.get_system_prompt_variables(overrides.get("prompt_template"))
             | {"user_query": q, "text_sources": text_sources, "image_sources": image_sources},
         )
+        if self.image_preparer is not None:
+            messages = self.image_preparer.set_detail(messages)
 
-        chat_completion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=1024,
-            n=1,
-            seed=seed,
-        )
+        with measure_stage(STAGE_GENERATION):
+            chat_completion = await self.call_openai(
+                lambda client: client.chat.completions.create(
+                    model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                    messages=messages,
+                    temperature=overrides.get("temperature", 0.3),
+                    max_tokens=1024,
+                    n=1,
+                    seed=seed,
+                )
+            )
 
         extra_info = ExtraInfo(
             DataPoints(text=text_sources, images=image_sources),
@@ -158,6 +221,7 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
+                    {"source_packing": source_packing} if source_packing else None,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
@@ -170,6 +234,14 @@ class RetrieveThenReadVisionApproach(Approach):
                 ),
             ],
         )
+        self.attach_stage_timings(extra_info, get_stage_timings())
+        if answer_cache_lookup:
+            self.save_answer_to_cache(
+                answer_cache_lookup,
+                chat_completion.choices[0].message.content,
+                chat_completion.choices[0].message.role,
+                extra_info,
+            )
 
         return {
             "message": {
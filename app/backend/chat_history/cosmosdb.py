@@ -13,6 +13,7 @@ from config import (
     CONFIG_COSMOS_HISTORY_VERSION,
     CONFIG_CREDENTIAL,
 )
+from core.metrics import UPSTREAM_COSMOS, measure_upstream
 from decorators import authenticated
 from error import error_response
 
@@ -70,7 +71,8 @@ async def post_chat_history(auth_claims: dict[str, Any]):
         batch_operations = [("upsert", (session_item,))] + [
             ("upsert", (message_pair_item,)) for message_pair_item in message_pair_items
         ]
-        await container.execute_item_batch(batch_operations=batch_operations, partition_key=[entra_oid, session_id])
+        async with measure_upstream(UPSTREAM_COSMOS):
+            await container.execute_item_batch(batch_operations=batch_operations, partition_key=[entra_oid, session_id])
         return jsonify({}), 201
     except Exception as error:
         return error_response(error, "/chat_history")
@@ -105,23 +107,24 @@ async def get_chat_history_sessions(auth_claims: dict[str, Any]):
 
         # Get the first page, and the continuation token
         sessions = []
-        try:
-            page = await pager.__anext__()
-            continuation_token = pager.continuation_token  # type: ignore
-
-            async for item in page:
-                sessions.append(
-                    {
-                        "id": item.get("id"),
-                        "entra_oid": item.get("entra_oid"),
-                        "title": item.get("title", "untitled"),
-                        "timestamp": item.get("timestamp"),
-                    }
-                )
-
-        # If there are no more pages, StopAsyncIteration is raised
-        except StopAsyncIteration:
-            continuation_token = None
+        async with measure_upstream(UPSTREAM_COSMOS):
+            try:
+                page = await pager.__anext__()
+                continuation_token = pager.continuation_token  # type: ignore
+
+                async for item in page:
+                    sessions.append(
+                        {
+                            "id": item.get("id"),
+                            "entra_oid": item.get("entra_oid"),
+                            "title": item.get("title", "untitled"),
+                            "timestamp": item.get("timestamp"),
+                        }
+                    )
+
+            # If there are no more pages, StopAsyncIteration is raised
+            except StopAsyncIteration:
+                continuation_token = None
 
         return jsonify({"sessions": sessions, "continuation_token": continuation_token}), 200
 
@@ -151,9 +154,10 @@ async def get_chat_history_session(auth_claims: dict[str, Any], session_id: str)
         )
 
         message_pairs = []
-        async for page in res.by_page():
-            async for item in page:
-                message_pairs.append([item["question"], item["response"]])
+        async with measure_upstream(UPSTREAM_COSMOS):
+            async for page in res.by_page():
+                async for item in page:
+                    message_pairs.append([item["question"], item["response"]])
 
         return (
             jsonify(
@@ -191,12 +195,14 @@ async def delete_chat_history_session(auth_claims: dict[str, Any], session_id: s
         )
 
         ids_to_delete = []
-        async for page in res.by_page():
-            async for item in page:
-                ids_to_delete.append(item["id"])
+        async with measure_upstream(UPSTREAM_COSMOS):
+            async for page in res.by_page():
+                async for item in page:
+                    ids_to_delete.append(item["id"])
 
         batch_operations = [("delete", (id,)) for id in ids_to_delete]
-        await container.execute_item_batch(batch_operations=batch_operations, partition_key=[entra_oid, session_id])
+        async with measure_upstream(UPSTREAM_COSMOS):
+            await container.execute_item_batch(batch_operations=batch_operations, partition_key=[entra_oid, session_id])
         return await make_response("", 204)
     except Exception as error:
         return error_response(error, f"/chat_history/sessions/{session_id}")
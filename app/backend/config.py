@@ -4,6 +4,19 @@ CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_ASK_VISION_APPROACH = "ask_vision_approach"
 CONFIG_CHAT_VISION_APPROACH = "chat_vision_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_RETRIEVAL_CACHE = "retrieval_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_IMAGE_CACHE = "image_cache"
+CONFIG_HISTORY_SUMMARY_CACHE = "history_summary_cache"
+CONFIG_SINGLE_FLIGHT = "single_flight"
+CONFIG_ADMISSION_CONTROLLERS = "admission_controllers"
+CONFIG_TOKEN_SCHEDULERS = "token_schedulers"
+CONFIG_SEARCH_HEDGING = "search_hedging"
+CONFIG_SHOW_STAGE_TIMINGS = "show_stage_timings"
+CONFIG_BLOCKING_EXECUTOR = "blocking_executor"
+CONFIG_HTTP_SESSIONS = "http_sessions"
+CONFIG_CONTENT_SAS_GENERATOR = "content_sas_generator"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_USER_UPLOAD_ENABLED = "user_upload_enabled"
 CONFIG_USER_BLOB_CONTAINER_CLIENT = "user_blob_container_client"
@@ -17,6 +30,7 @@ CONFIG_DEFAULT_REASONING_EFFORT = "default_reasoning_effort"
 CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_OPENAI_ROUTER = "openai_router"
 CONFIG_AGENT_CLIENT = "agent_client"
 CONFIG_INGESTER = "ingester"
 CONFIG_LANGUAGE_PICKER_ENABLED = "language_picker_enabled"
@@ -27,6 +41,7 @@ CONFIG_SPEECH_SERVICE_ID = "speech_service_id"
 CONFIG_SPEECH_SERVICE_LOCATION = "speech_service_location"
 CONFIG_SPEECH_SERVICE_TOKEN = "speech_service_token"
 CONFIG_SPEECH_SERVICE_VOICE = "speech_service_voice"
+CONFIG_SPEECH_AUDIO_CACHE = "speech_audio_cache"
 CONFIG_STREAMING_ENABLED = "streaming_enabled"
 CONFIG_CHAT_HISTORY_BROWSER_ENABLED = "chat_history_browser_enabled"
 CONFIG_CHAT_HISTORY_COSMOS_ENABLED = "chat_history_cosmos_enabled"
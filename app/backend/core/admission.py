@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+from core.metrics import (
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_QUEUE_TIME,
+    ADMISSION_REJECTED,
+    ADMISSION_WAITING,
+)
+
+UPSTREAM_OPENAI = "openai"
+UPSTREAM_SEARCH = "search"
+
+
+class OverloadedError(Exception):
+    """Raised when a call to an upstream service is shed because too many calls are already waiting for it"""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"Too many pending calls to {upstream}, retry after {retry_after} seconds")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent calls to one upstream service.
+    Calls over the limit wait in a bounded queue, and calls that arrive when the queue is full are rejected right away
+    with an OverloadedError, so that latency stays stable under overload instead of degrading for every request.
+    Keeps queue time statistics, also exported as metrics labeled by upstream, so that the limits can be tuned.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        max_concurrency: int,
+        max_queue: int,
+        retry_after: int = 1,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be a positive number")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+        self.upstream = upstream
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.timer = timer
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def is_overloaded(self) -> bool:
+        return self.in_flight + self.waiting >= self.max_concurrency + self.max_queue
+
+    def check(self) -> None:
+        """Rejects a request before it starts if calls to the upstream service would be rejected"""
+        if self.is_overloaded():
+            self.rejected += 1
+            ADMISSION_REJECTED.labels(self.upstream).inc()
+            raise OverloadedError(self.upstream, self.retry_after)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[None, None]:
+        self.check()
+        started = self.timer()
+        must_wait = self._semaphore.locked()
+        self.waiting += 1
+        ADMISSION_WAITING.labels(self.upstream).inc()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            ADMISSION_WAITING.labels(self.upstream).dec()
+        self.admitted += 1
+        queue_time = self.timer() - started if must_wait else 0.0
+        if must_wait:
+            self.queued += 1
+            self.queue_time_total += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+        ADMISSION_QUEUE_TIME.labels(self.upstream).observe(queue_time)
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.labels(self.upstream).inc()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            ADMISSION_IN_FLIGHT.labels(self.upstream).dec()
+            self._semaphore.release()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "queue_time_avg_ms": round(self.queue_time_total / self.admitted * 1000, 1) if self.admitted else 0,
+            "queue_time_max_ms": round(self.queue_time_max * 1000, 1),
+        }
+
+
+@asynccontextmanager
+async def admitted(controller: Optional[AdmissionController]) -> AsyncGenerator[None, None]:
+    """Waits for the controller to admit a call, if there is a controller for the upstream service"""
+    if controller is None:
+        yield
+        return
+    async with controller.acquire():
+        yield
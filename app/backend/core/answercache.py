@@ -0,0 +1,137 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    content: Optional[str]
+    role: str
+    context: Any
+    followup_questions: Optional[list[Any]] = None
+
+
+@dataclass
+class SemanticCacheHit:
+    answer: CachedAnswer
+    similarity: float
+
+
+class _Partition:
+    def __init__(self):
+        self.entries: OrderedDict[Hashable, tuple[float, np.ndarray, CachedAnswer]] = OrderedDict()
+        # Matrix of the normalized embeddings of the entries, rebuilt after the entries change
+        self._keys: list[Hashable] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def matrix(self) -> tuple[list[Hashable], np.ndarray]:
+        if self._matrix is None:
+            self._keys = list(self.entries.keys())
+            self._matrix = np.stack([vector for _, vector, _ in self.entries.values()])
+        return self._keys, self._matrix
+
+    def invalidate(self) -> None:
+        self._matrix = None
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of final answers, looked up by the cosine similarity between the embedding of a new question
+    and the embeddings of the questions that were already answered.
+    Entries are partitioned, notably by the security filter of the request, and a lookup only compares
+    a question with the questions in the same partition, so answers are never shared between users with different access.
+    Holds at most max_entries answers across all partitions, evicting the least recently used answer first.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        similarity_threshold: float,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be a positive number")
+        if ttl <= 0:
+            raise ValueError("ttl must be a positive number of seconds")
+        if not 0 < similarity_threshold <= 1:
+            raise ValueError("similarity_threshold must be between 0 and 1")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._partitions: dict[Hashable, _Partition] = {}
+        self._lru: OrderedDict[tuple[Hashable, Hashable], None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, partition_key: Hashable, embedding: list[float]) -> Optional[SemanticCacheHit]:
+        partition = self._partitions.get(partition_key)
+        if partition is None or not partition.entries:
+            self.misses += 1
+            return None
+        keys, matrix = partition.matrix()
+        similarities = matrix @ self._normalize(embedding)
+        now = self.timer()
+        # Look at the candidates from the most to the least similar, skipping expired answers
+        for index in np.argsort(-similarities):
+            similarity = float(similarities[index])
+            if similarity < self.similarity_threshold:
+                break
+            key = keys[index]
+            expires_at, _, answer = partition.entries[key]
+            if expires_at <= now:
+                self._delete(partition_key, key)
+                continue
+            self._lru.move_to_end((partition_key, key))
+            self.hits += 1
+            return SemanticCacheHit(answer=answer, similarity=similarity)
+        self.misses += 1
+        return None
+
+    def set(self, partition_key: Hashable, key: Hashable, embedding: list[float], answer: CachedAnswer) -> None:
+        partition = self._partitions.setdefault(partition_key, _Partition())
+        partition.entries[key] = (self.timer() + self.ttl, self._normalize(embedding), answer)
+        partition.invalidate()
+        self._lru[(partition_key, key)] = None
+        self._lru.move_to_end((partition_key, key))
+        while len(self._lru) > self.max_entries:
+            evicted_partition_key, evicted_key = next(iter(self._lru))
+            self._delete(evicted_partition_key, evicted_key)
+
+    def _delete(self, partition_key: Hashable, key: Hashable) -> None:
+        self._lru.pop((partition_key, key), None)
+        partition = self._partitions.get(partition_key)
+        if partition is None or key not in partition.entries:
+            return
+        del partition.entries[key]
+        partition.invalidate()
+        if not partition.entries:
+            del self._partitions[partition_key]
+
+    def clear(self) -> None:
+        self._partitions.clear()
+        self._lru.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._lru),
+            "partitions": len(self._partitions),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
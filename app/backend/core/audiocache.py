@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Any, Callable, Optional, TypeVar
+
+from core.executor import BlockingExecutor
+
+T = TypeVar("T")
+
+
+class AudioCache:
+    """
+    Content-addressed cache of synthesized speech, keyed by voice, output format and a hash of the text.
+    Recently played audio is kept in memory. Audio evicted from memory is spilled to files in a local directory,
+    which is also bounded in size. Both tiers evict the least recently used audio first.
+    The files are read and written on the threads of the blocking executor, when one is given,
+    so that a slow disk doesn't block the event loop.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    FILE_SUFFIX = ".audio"
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        max_disk_bytes: int = 0,
+        directory: Optional[str] = None,
+        blocking_executor: Optional[BlockingExecutor] = None,
+    ):
+        if max_memory_bytes <= 0:
+            raise ValueError("max_memory_bytes must be a positive number")
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        self.blocking_executor = blocking_executor
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_bytes = 0
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.max_disk_bytes > 0:
+            if self.directory is None:
+                self.directory = os.path.join(tempfile.gettempdir(), "speech-audio-cache")
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(voice: str, output_format: str, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{voice}\n{output_format}\n{text_hash}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, key + self.FILE_SUFFIX)
+
+    def _load_disk_index(self) -> None:
+        # Audio is content-addressed, so files spilled by a previous process can be reused
+        assert self.directory is not None
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.FILE_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[: -len(self.FILE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        # Runs once when the app starts, before any request is handled
+        self._remove_files(self._evict_disk())
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        if self.blocking_executor is not None:
+            return await self.blocking_executor.run(func, *args)
+        return func(*args)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        audio = self.memory.get(key)
+        if audio is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return audio
+        if key in self.disk:
+            try:
+                audio = await self._run(self._read_file, self._path(key))
+            except OSError:
+                # Another worker sharing the directory may have evicted the file
+                if key in self.disk:
+                    self.disk_bytes -= self.disk.pop(key)
+            else:
+                self.disk_hits += 1
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                await self._set_memory(key, audio)
+                return audio
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, audio: bytes) -> None:
+        if len(audio) > self.max_memory_bytes:
+            await self._spill(key, audio)
+            return
+        await self._set_memory(key, audio)
+
+    async def _set_memory(self, key: str, audio: bytes) -> None:
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= len(previous)
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        evicted: list[tuple[str, bytes]] = []
+        while self.memory_bytes > self.max_memory_bytes:
+            evicted_key, evicted_audio = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted_audio)
+            evicted.append((evicted_key, evicted_audio))
+        for evicted_key, evicted_audio in evicted:
+            await self._spill(evicted_key, evicted_audio)
+
+    async def _spill(self, key: str, audio: bytes) -> None:
+        if self.max_disk_bytes <= 0 or len(audio) > self.max_disk_bytes:
+            return
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return
+        path = self._path(key)
+        try:
+            await self._run(self._write_file, path, audio)
+        except OSError:
+            logging.exception("Unable to spill synthesized speech to %s", path)
+            return
+        # The same audio may have been spilled by another request while the file was written
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return
+        self.disk[key] = len(audio)
+        self.disk_bytes += len(audio)
+        evicted_paths = self._evict_disk()
+        if evicted_paths:
+            await self._run(self._remove_files, evicted_paths)
+
+    def _evict_disk(self) -> list[str]:
+        """Removes the least recently used audio from the disk index, and returns the paths of the files to remove"""
+        evicted_paths = []
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            evicted_key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            evicted_paths.append(self._path(evicted_key))
+        return evicted_paths
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as audio_file:
+            return audio_file.read()
+
+    def _write_file(self, path: str, audio: bytes) -> None:
+        # Write to a temporary file first, so that readers never see a partially written file
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(file_descriptor, "wb") as audio_file:
+            audio_file.write(audio)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _remove_files(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
@@ -1,11 +1,13 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
 import base64
+import hashlib
 import json
 import logging
-from typing import Any, Optional
+import time
+from typing import Any, Callable, Optional
 
-import aiohttp
 import jwt
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchIndex
@@ -20,6 +22,11 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.cache import TTLCache
+from core.executor import BlockingExecutor
+from core.httpsessions import HTTPSessionRegistry, http_session
+from core.metrics import UPSTREAM_GRAPH, measure_upstream
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -31,6 +38,114 @@ class AuthError(Exception):
         return self.error or ""
 
 
+class JwksCache:
+    """
+    Caches the public keys used to sign Entra access tokens, indexed by key ID.
+    Keys are refreshed in the background once they are older than refresh_interval, and immediately
+    when a token is signed with an unknown key ID, as happens when Entra rotates its signing keys.
+    If refreshing fails, the previously downloaded keys keep being used.
+    Requests wait at most refresh_timeout for a refresh, so that they don't hang while Entra is unreachable.
+    """
+
+    def __init__(
+        self,
+        key_url: str,
+        refresh_interval: float = 3600,
+        min_refresh_interval: float = 60,
+        refresh_timeout: float = 10,
+        timer: Callable[[], float] = time.monotonic,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+    ):
+        self.key_url = key_url
+        self.refresh_interval = refresh_interval
+        # Unknown key IDs trigger a refresh, so limit how often that can happen
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_timeout = refresh_timeout
+        self.timer = timer
+        self.http_sessions = http_sessions
+        self.keys: dict[str, rsa.RSAPublicKey] = {}
+        self.fetched_at: Optional[float] = None
+        self.attempted_at: Optional[float] = None
+        self.refresh_task: Optional[asyncio.Task[None]] = None
+
+    @staticmethod
+    def create_public_key(jwk: dict[str, Any]) -> rsa.RSAPublicKey:
+        public_numbers = rsa.RSAPublicNumbers(
+            e=int.from_bytes(base64.urlsafe_b64decode(jwk["e"] + "=="), byteorder="big"),
+            n=int.from_bytes(base64.urlsafe_b64decode(jwk["n"] + "=="), byteorder="big"),
+        )
+        return public_numbers.public_key()
+
+    async def fetch_keys(self, retry: bool = True) -> dict[str, rsa.RSAPublicKey]:
+        jwks = None
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(AuthError),
+            wait=wait_random_exponential(min=15, max=60),
+            stop=stop_after_attempt(5 if retry else 1),
+            reraise=not retry,
+        ):
+            with attempt:
+                async with http_session(self.http_sessions, self.key_url) as session:
+                    async with session.get(url=self.key_url) as resp:
+                        resp_status = resp.status
+                        if resp_status in [500, 502, 503, 504]:
+                            raise AuthError(
+                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
+                            )
+                        jwks = await resp.json()
+
+        if not jwks or "keys" not in jwks:
+            raise AuthError("Unable to get keys to validate auth token.", 401)
+
+        keys = {}
+        for jwk in jwks["keys"]:
+            if jwk.get("kty") != "RSA" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = self.create_public_key(jwk)
+            except (KeyError, ValueError):
+                logging.warning("Skipping signing key %s that could not be parsed", jwk["kid"])
+        return keys
+
+    async def refresh(self, retry: bool = True) -> None:
+        self.attempted_at = self.timer()
+        try:
+            self.keys = await self.fetch_keys(retry)
+            self.fetched_at = self.timer()
+        except Exception:
+            if not self.keys:
+                raise
+            logging.exception("Unable to refresh signing keys, using the previously downloaded keys")
+
+    def start_refresh(self, retry: bool = True) -> asyncio.Task[None]:
+        # Concurrent requests share the same refresh instead of each downloading the keys
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.refresh(retry))
+            self.refresh_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self.refresh_task
+
+    async def wait_for_refresh(self, retry: bool = True) -> None:
+        refresh_task = self.start_refresh(retry)
+        try:
+            await asyncio.wait_for(asyncio.shield(refresh_task), self.refresh_timeout)
+        except asyncio.TimeoutError:
+            # The refresh keeps running for the next requests, and this request is validated with the current keys
+            logging.warning("Timed out after %s seconds waiting for the signing keys", self.refresh_timeout)
+
+    async def get_signing_key(self, kid: Optional[str]) -> Optional[rsa.RSAPublicKey]:
+        now = self.timer()
+        if self.fetched_at is None:
+            await self.wait_for_refresh()
+        elif kid not in self.keys:
+            if self.attempted_at is None or now - self.attempted_at >= self.min_refresh_interval:
+                # Tokens can be signed with any key ID, so the keys are only downloaded once, without retries
+                await self.wait_for_refresh(retry=False)
+        elif now - self.fetched_at >= self.refresh_interval:
+            if self.attempted_at is None or now - self.attempted_at >= self.min_refresh_interval:
+                self.start_refresh()
+        return self.keys.get(kid) if kid else None
+
+
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
 
@@ -45,8 +160,16 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        auth_claims_cache_max_entries: int = 1000,
+        blocking_executor: Optional[BlockingExecutor] = None,
+        path_auth_cache_max_entries: int = 1000,
+        path_auth_cache_ttl: float = 120,
+        path_auth_cache_negative_ttl: float = 30,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
     ):
         self.use_authentication = use_authentication
+        self.blocking_executor = blocking_executor
+        self.http_sessions = http_sessions
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
@@ -61,6 +184,21 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        self.jwks_cache = JwksCache(self.key_url, http_sessions=http_sessions)
+        # Claims resolved for an access token, so that repeated requests with the same token
+        # skip the On Behalf Of exchange and the Microsoft Graph group listing
+        self.auth_claims_cache: Optional[TTLCache[tuple[dict[str, Any], bool]]] = (
+            TTLCache(max_entries=auth_claims_cache_max_entries, ttl=3600) if auth_claims_cache_max_entries > 0 else None
+        )
+        self.auth_claims_cache_metrics = {"obo_hits": 0, "obo_misses": 0, "graph_hits": 0, "graph_misses": 0}
+        # Access decisions for documents, keyed by a hash of the security filter and the path.
+        # Denials expire sooner, so that newly granted access is picked up quickly
+        self.path_auth_cache: Optional[TTLCache[bool]] = (
+            TTLCache(max_entries=path_auth_cache_max_entries, ttl=path_auth_cache_ttl)
+            if path_auth_cache_max_entries > 0
+            else None
+        )
+        self.path_auth_cache_negative_ttl = path_auth_cache_negative_ttl
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -179,13 +317,17 @@ class AuthenticationHelper:
         return security_filter
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, http_sessions: Optional[HTTPSessionRegistry] = None
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        url = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+        async with http_session(http_sessions, url) as session, measure_upstream(UPSTREAM_GRAPH):
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            # The session may be shared with other users, so the token is sent with each request
+            async with session.get(url=url, headers=headers) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -197,7 +339,7 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
                 else:
@@ -207,6 +349,16 @@ class AuthenticationHelper:
 
         return groups
 
+    @staticmethod
+    def get_token_expiration(token: str) -> float:
+        # Only call this for tokens that have already been validated
+        try:
+            claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.PyJWTError:
+            return 0
+        expiration = claims.get("exp")
+        return float(expiration) if isinstance(expiration, (int, float)) else 0
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -218,11 +370,26 @@ class AuthenticationHelper:
             # Validate the token before use
             await self.validate_access_token(auth_token)
 
+            cache_key = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            if self.auth_claims_cache is not None:
+                cached = self.auth_claims_cache.get(cache_key)
+                if cached is not None:
+                    cached_claims, used_graph = cached
+                    self.auth_claims_cache_metrics["obo_hits"] += 1
+                    if used_graph:
+                        self.auth_claims_cache_metrics["graph_hits"] += 1
+                    return {"oid": cached_claims["oid"], "groups": list(cached_claims["groups"])}
+
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            # MSAL is synchronous, so run it on a thread to keep the event loop responsive
+            run_blocking = self.blocking_executor.run if self.blocking_executor else asyncio.to_thread
+            graph_resource_access_token = await run_blocking(
+                self.confidential_client.acquire_token_on_behalf_of,
+                user_assertion=auth_token,
+                scopes=["https://graph.microsoft.com/.default"],
             )
+            self.auth_claims_cache_metrics["obo_misses"] += 1
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
 
@@ -240,9 +407,22 @@ class AuthenticationHelper:
                 and "_claim_names" in id_token_claims
                 and "groups" in id_token_claims["_claim_names"]
             )
-            if missing_groups_claim or has_group_overage_claim:
+            used_graph = missing_groups_claim or has_group_overage_claim
+            if used_graph:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                auth_claims["groups"] = await AuthenticationHelper.list_groups(
+                    graph_resource_access_token, self.http_sessions
+                )
+                self.auth_claims_cache_metrics["graph_misses"] += 1
+
+            # The claims are only valid for as long as the token they were resolved from
+            expires_in = AuthenticationHelper.get_token_expiration(auth_token) - time.time()
+            if self.auth_claims_cache is not None and expires_in > 0:
+                self.auth_claims_cache.set(
+                    cache_key,
+                    ({"oid": auth_claims["oid"], "groups": list(auth_claims["groups"])}, used_graph),
+                    ttl=min(expires_in, self.auth_claims_cache.ttl),
+                )
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -267,6 +447,12 @@ class AuthenticationHelper:
         if fragment_index != -1:
             path = path[:fragment_index]
 
+        cache_key = (hashlib.sha256(security_filter.encode()).hexdigest(), path)
+        if self.path_auth_cache is not None:
+            cached_allowed = self.path_auth_cache.get(cache_key)
+            if cached_allowed is not None:
+                return cached_allowed
+
         # Filter down to only chunks that are from the specific source file
         # Sourcepage is used for GPT-4V
         # Replace ' with '' to escape the single quote for the filter
@@ -282,18 +468,23 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        if self.path_auth_cache is not None:
+            self.path_auth_cache.set(cache_key, allowed, ttl=None if allowed else self.path_auth_cache_negative_ttl)
         return allowed
 
+    def invalidate_path_auth_cache(self) -> None:
+        """
+        Forget cached access decisions, called when ingestion changes the documents or their access control lists
+        """
+        if self.path_auth_cache is not None:
+            self.path_auth_cache.clear()
+
     async def create_pem_format(self, jwks, token):
         unverified_header = jwt.get_unverified_header(token)
         for key in jwks["keys"]:
             if key["kid"] == unverified_header["kid"]:
                 # Construct the RSA public key
-                public_numbers = rsa.RSAPublicNumbers(
-                    e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
-                    n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
-                )
-                public_key = public_numbers.public_key()
+                public_key = JwksCache.create_public_key(key)
 
                 # Convert to PEM format
                 pem_key = public_key.public_bytes(
@@ -307,35 +498,17 @@ class AuthenticationHelper:
         """
         Validate an access token is issued by Entra
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError("Unable to get keys to validate auth token.", 401)
-
-        rsa_key = None
         issuer = None
         audience = None
         try:
+            unverified_header = jwt.get_unverified_header(token)
             unverified_claims = jwt.decode(token, options={"verify_signature": False})
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
         except jwt.PyJWTError as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+
+        rsa_key = await self.jwks_cache.get_signing_key(unverified_header.get("kid"))
         if not rsa_key:
             raise AuthError("Unable to find appropriate key", 401)
 
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Callable, Generic, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    In-process LRU cache with a maximum number of entries and a time-to-live for each entry.
+    When max_bytes is set, the cache is also limited by the total size of its values, as estimated by size_of.
+    Keeps hit and miss counters so that the effectiveness of the cache can be monitored.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        timer: Callable[[], float] = time.monotonic,
+        max_bytes: Optional[int] = None,
+        size_of: Optional[Callable[[V], int]] = None,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be a positive number")
+        if ttl <= 0:
+            raise ValueError("ttl must be a positive number of seconds")
+        if max_bytes is not None and (max_bytes <= 0 or size_of is None):
+            raise ValueError("max_bytes must be a positive number and requires size_of")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timer = timer
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries: OrderedDict[Hashable, tuple[float, V, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > self.timer()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = entry
+        if expires_at <= self.timer():
+            self.delete(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        size = self.size_of(value) if self.max_bytes is not None and self.size_of is not None else 0
+        self.delete(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = (self.timer() + (ttl if ttl is not None else self.ttl), value, size)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes
+        ):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def delete(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        stats = {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+        if self.max_bytes is not None:
+            stats["bytes"] = self.total_bytes
+        return stats
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from core.metrics import (
+    BLOCKING_CALL_WAIT,
+    BLOCKING_CALLS_ACTIVE,
+    BLOCKING_CALLS_QUEUED,
+)
+
+T = TypeVar("T")
+
+
+class BlockingExecutor:
+    """
+    Runs blocking SDK calls (like MSAL and the Speech SDK) on a bounded pool of threads,
+    so that they don't block the event loop and stall every other request on the worker.
+    Keeps track of how many calls are waiting for a thread and how long they waited,
+    and exports them as metrics on the /metrics endpoint.
+    """
+
+    def __init__(self, max_workers: int, timer: Callable[[], float] = time.monotonic):
+        if max_workers <= 0:
+            raise ValueError("max_workers must be a positive number")
+        self.max_workers = max_workers
+        self.timer = timer
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blocking")
+        # Updated from the worker threads, so guarded by a lock
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        submitted_at = self.timer()
+        with self._lock:
+            self.queued += 1
+        BLOCKING_CALLS_QUEUED.inc()
+        dequeued = False
+
+        def leave_queue() -> None:
+            # Called with the lock held, either when a thread picks up the call or when the call is cancelled first
+            nonlocal dequeued
+            if not dequeued:
+                dequeued = True
+                self.queued -= 1
+                BLOCKING_CALLS_QUEUED.dec()
+
+        def run_in_thread() -> T:
+            wait_time = self.timer() - submitted_at
+            with self._lock:
+                leave_queue()
+                self.active += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            BLOCKING_CALL_WAIT.observe(wait_time)
+            BLOCKING_CALLS_ACTIVE.inc()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                BLOCKING_CALLS_ACTIVE.dec()
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run_in_thread)
+        finally:
+            # A call that was cancelled before it got a thread never runs, so it leaves the queue here
+            with self._lock:
+                leave_queue()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                "max_workers": self.max_workers,
+                "queue_depth": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "average_wait_time": self.total_wait_time / started if started else 0.0,
+                "max_wait_time": self.max_wait_time,
+            }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable, Hashable
+from typing import Any, Callable, Optional, TypeVar
+
+from core.metrics import HEDGING_CALLS, HEDGING_HEDGED, HEDGING_THRESHOLD, HEDGING_WINS
+
+T = TypeVar("T")
+
+
+class _Operation:
+    def __init__(self, window: int):
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+
+class HedgingPolicy:
+    """
+    Cuts the tail latency of idempotent calls by sending a duplicate of a call that takes longer than usual,
+    and returning the result of whichever call finishes first, the other call being cancelled.
+    A call is duplicated when it takes longer than a percentile of the recent latencies of the same operation,
+    and only while the duplicates stay under max_extra_ratio of the calls, so that overloaded services
+    don't receive even more calls. The calls, duplicates and thresholds are exported as metrics labeled by operation.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        max_extra_ratio: float = 0.05,
+        min_samples: int = 20,
+        window: int = 200,
+        max_burst: float = 10,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if not 0 < percentile < 100:
+            raise ValueError("percentile must be between 0 and 100")
+        if not 0 < max_extra_ratio <= 1:
+            raise ValueError("max_extra_ratio must be between 0 and 1")
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self.max_burst = max_burst
+        self.timer = timer
+        # Every call earns a fraction of a duplicate, and a duplicate can only be sent once a whole one is earned
+        self._budget = 0.0
+        self._operations: dict[Hashable, _Operation] = {}
+
+    def _operation(self, key: Hashable) -> _Operation:
+        operation = self._operations.get(key)
+        if operation is None:
+            operation = self._operations[key] = _Operation(self.window)
+        return operation
+
+    def threshold(self, key: Hashable) -> Optional[float]:
+        """Returns the delay after which a call is duplicated, or None until enough latencies have been recorded"""
+        operation = self._operations.get(key)
+        if operation is None or len(operation.latencies) < self.min_samples:
+            return None
+        latencies = sorted(operation.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        operation = self._operation(key)
+        operation.calls += 1
+        HEDGING_CALLS.labels(str(key)).inc()
+        self._budget = min(self.max_burst, self._budget + self.max_extra_ratio)
+        threshold = self.threshold(key)
+        if threshold is not None:
+            HEDGING_THRESHOLD.labels(str(key)).set(threshold)
+        started = self.timer()
+        primary = asyncio.ensure_future(fn())
+        tasks: list[asyncio.Future[T]] = [primary]
+        try:
+            if threshold is not None:
+                await asyncio.wait(tasks, timeout=threshold)
+            if not primary.done() and threshold is not None and self._budget >= 1:
+                self._budget -= 1
+                operation.hedged += 1
+                HEDGING_HEDGED.labels(str(key)).inc()
+                tasks.append(asyncio.ensure_future(fn()))
+            winner = await self._first_success(tasks)
+            result = winner.result()
+            if winner is not primary:
+                operation.hedge_wins += 1
+                HEDGING_WINS.labels(str(key)).inc()
+            operation.latencies.append(self.timer() - started)
+            return result
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    @staticmethod
+    async def _first_success(tasks: list["asyncio.Future[T]"]) -> "asyncio.Future[T]":
+        # A call that fails doesn't win as long as the other call can still succeed
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in tasks if task in done and task.exception() is None]
+            if succeeded:
+                return succeeded[0]
+            if not pending:
+                return next(task for task in tasks if task in done)
+
+    def stats(self) -> dict[str, Any]:
+        stats = {}
+        for key, operation in self._operations.items():
+            threshold = self.threshold(key)
+            stats[str(key)] = {
+                "calls": operation.calls,
+                "hedged": operation.hedged,
+                "hedge_wins": operation.hedge_wins,
+                "threshold_ms": round(threshold * 1000, 1) if threshold is not None else None,
+            }
+        return stats
@@ -0,0 +1,67 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+
+class HTTPSessionRegistry:
+    """
+    Keeps one aiohttp session per target host, so that calls to the same host reuse the kept-alive connections
+    of its pool instead of each opening a new TCP connection with a new TLS handshake.
+    The sessions are created on first use, since they must be created in the running event loop,
+    and are all closed by close(), when the app stops serving or when an ingestion run ends.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        limit_per_host: int = 100,
+        keepalive_timeout: float = 60,
+        dns_cache_ttl: int = 300,
+    ):
+        # Connections above the limit wait for a connection of the pool to be released
+        self.limit_per_host = limit_per_host
+        # Idle connections are closed after keepalive_timeout, before the services close them on their side
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+        self._created = 0
+        self._reused = 0
+
+    def get(self, url: str) -> aiohttp.ClientSession:
+        """Returns the session for the host of the URL. The session is shared, so it must not be closed by callers."""
+        host = urlsplit(url).netloc.lower()
+        session = self._sessions.get(host)
+        if session is not None and not session.closed:
+            self._reused += 1
+            return session
+        connector = aiohttp.TCPConnector(
+            limit=self.limit_per_host,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        session = self._sessions[host] = aiohttp.ClientSession(connector=connector)
+        self._created += 1
+        return session
+
+    async def close(self) -> None:
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        await asyncio.gather(*(session.close() for session in sessions))
+
+    def stats(self) -> dict[str, int]:
+        return {"sessions": len(self._sessions), "created": self._created, "reused": self._reused}
+
+
+@asynccontextmanager
+async def http_session(http_sessions: Optional[HTTPSessionRegistry], url: str) -> AsyncIterator[aiohttp.ClientSession]:
+    """Yields the shared session for the host of the URL, or a session closed after the call when there's no registry"""
+    if http_sessions is None:
+        async with aiohttp.ClientSession() as session:
+            yield session
+    else:
+        yield http_sessions.get(url)
@@ -1,13 +1,22 @@
+import asyncio
 import base64
+import io
 import logging
+import math
 import os
-from typing import Optional
+import time
+from typing import Any, Callable, Optional
 
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.storage.blob.aio import ContainerClient
+from openai.types.chat import ChatCompletionMessageParam
 from typing_extensions import Literal, Required, TypedDict
 
-from approaches.approach import Document
+from approaches.approach import Document, gather_or_cancel
+from core.cache import TTLCache
+from core.executor import BlockingExecutor
+from core.metrics import UPSTREAM_BLOB, measure_upstream
 
 
 class ImageURL(TypedDict, total=False):
@@ -18,23 +27,238 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+IMAGE_FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Estimates the tokens of an image in a GPT-4V prompt: low detail images cost a fixed number of tokens,
+    other images are scaled to fit in 2048x2048 and then to a shortest side of 768, and cost tokens for each 512px tile.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+class ImagePreparer:
+    """
+    Prepares page images before they're sent to GPT-4V: downscales them to a maximum size of their long edge,
+    re-encodes them as JPEG or WebP, and sets the detail level of the images in the prompt.
+    Smaller images make smaller requests, cost fewer image tokens and are processed faster by the model.
+    """
+
+    def __init__(
+        self,
+        max_long_edge: Optional[int] = None,
+        image_format: str = "png",
+        quality: int = 85,
+        detail: Optional[Literal["auto", "low", "high"]] = None,
+        blocking_executor: Optional[BlockingExecutor] = None,
+    ):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"image_format must be one of {', '.join(IMAGE_FORMATS)}")
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        if detail not in [None, "auto", "low", "high"]:
+            raise ValueError("detail must be auto, low or high")
+        self.max_long_edge = max_long_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.detail = detail
+        # Decoding and encoding images takes tens of milliseconds, so it's done off the event loop when possible
+        self.blocking_executor = blocking_executor
+
+    def prepare(self, image: bytes) -> tuple[bytes, str]:
+        """Returns the prepared image with its MIME type, or the original PNG image when it doesn't need changes"""
+        # Pillow is only imported by the apps that prepare images, see the worker start time in docs/productionizing.md
+        from PIL import Image
+
+        with Image.open(io.BytesIO(image)) as original:
+            resized = original
+            if self.max_long_edge and max(original.size) > self.max_long_edge:
+                resized = original.copy()
+                # Keeps the aspect ratio, so that the long edge becomes max_long_edge
+                resized.thumbnail((self.max_long_edge, self.max_long_edge), Image.Resampling.LANCZOS)
+            if resized is original and self.image_format == "png":
+                return image, IMAGE_FORMATS["png"]
+            if self.image_format == "jpeg" and resized.mode not in ["RGB", "L"]:
+                resized = resized.convert("RGB")
+            output = io.BytesIO()
+            resized.save(output, format=self.image_format.upper(), quality=self.quality, optimize=True)
+        return output.getvalue(), IMAGE_FORMATS[self.image_format]
+
+    async def prepare_data_url(self, image: bytes) -> str:
+        if self.blocking_executor is not None:
+            prepared, mime_type = await self.blocking_executor.run(self.prepare, image)
+        else:
+            prepared, mime_type = self.prepare(image)
+        return f"data:{mime_type};base64,{base64.b64encode(prepared).decode('utf-8')}"
+
+    def set_detail(self, messages: list[ChatCompletionMessageParam]) -> list[ChatCompletionMessageParam]:
+        """Sets the detail level of the images in the messages rendered from a prompt"""
+        if self.detail is None:
+            return messages
+        for message in messages:
+            content: Any = message.get("content")
+            if isinstance(content, list):
+                for part in content:
+                    if part.get("type") == "image_url":
+                        image_url: ImageURL = part["image_url"]
+                        image_url["detail"] = self.detail
+        return messages
+
+
+class ImageCache:
+    """
+    Cache of page images as data URLs, ready to be added to GPT-4V prompts, keyed by blob name and ETag.
+    The ETag of a cached image is trusted for revalidate_after seconds. After that, the image is downloaded
+    only if the blob changed, so revalidating an unchanged image costs a request without a body.
+    The cache is limited by the total size of the data URLs, evicting the least recently used images first.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        revalidate_after: float = 300,
+        max_entries: int = 10000,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if revalidate_after <= 0:
+            raise ValueError("revalidate_after must be a positive number of seconds")
+        self.revalidate_after = revalidate_after
+        self.timer = timer
+        # Images stay cached until they're evicted or their blob changes, so their time-to-live is only a safety net
+        self.images: TTLCache[str] = TTLCache(
+            max_entries=max_entries, ttl=24 * 3600, timer=timer, max_bytes=max_bytes, size_of=len
+        )
+        # The ETag of the last downloaded version of each blob, with the time it was last checked
+        self.etags: TTLCache[tuple[str, float]] = TTLCache(max_entries=max_entries, ttl=24 * 3600, timer=timer)
+        self.hits = 0
+        self.revalidated_hits = 0
+        self.misses = 0
+
+    def get(self, blob_name: str) -> tuple[Optional[str], Optional[str]]:
+        """
+        Returns the cached image if its ETag was checked recently.
+        Otherwise returns the ETag to download the blob with only if it changed, when the image is still cached.
+        """
+        entry = self.etags.get(blob_name)
+        if entry is None:
+            return None, None
+        etag, checked_at = entry
+        key = (blob_name, etag)
+        if self.timer() - checked_at < self.revalidate_after:
+            image = self.images.get(key)
+            if image is not None:
+                self.hits += 1
+            return image, None
+        return None, (etag if key in self.images else None)
+
+    def revalidated(self, blob_name: str, etag: str) -> Optional[str]:
+        """Returns the cached image after storage reported that its blob didn't change"""
+        image = self.images.get((blob_name, etag))
+        if image is not None:
+            self.revalidated_hits += 1
+            self.etags.set(blob_name, (etag, self.timer()))
+        return image
+
+    def set(self, blob_name: str, etag: str, image: str) -> None:
+        self.misses += 1
+        previous = self.etags.get(blob_name)
+        if previous is not None and previous[0] != etag:
+            self.images.delete((blob_name, previous[0]))
+        self.etags.set(blob_name, (etag, self.timer()))
+        self.images.set((blob_name, etag), image)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.images),
+            "bytes": self.images.total_bytes,
+            "hits": self.hits,
+            "revalidated_hits": self.revalidated_hits,
+            "misses": self.misses,
+        }
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient,
+    file_path: str,
+    image_cache: Optional[ImageCache] = None,
+    image_preparer: Optional[ImagePreparer] = None,
+) -> Optional[str]:
     base_name, _ = os.path.splitext(file_path)
     image_filename = base_name + ".png"
+    etag = None
+    if image_cache is not None:
+        img, etag = image_cache.get(image_filename)
+        if img is not None:
+            return img
     try:
-        blob = await blob_container_client.get_blob_client(image_filename).download_blob()
-        if not blob.properties:
-            logging.warning(f"No blob exists for {image_filename}")
-            return None
-        img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        async with measure_upstream(UPSTREAM_BLOB):
+            blob_client = blob_container_client.get_blob_client(image_filename)
+            blob = None
+            if image_cache is not None and etag is not None:
+                try:
+                    blob = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+                except HttpResponseError as error:
+                    # Storage reports an unchanged blob with a 304 response, which the SDK raises as an error
+                    if error.status_code != 304:
+                        raise
+                    if (img := image_cache.revalidated(image_filename, etag)) is not None:
+                        return img
+            if blob is None:
+                blob = await blob_client.download_blob()
+            if not blob.properties:
+                logging.warning(f"No blob exists for {image_filename}")
+                return None
+            content = await blob.readall()
+        if image_preparer is not None:
+            # The prepared image is cached, so that it's only prepared again when the blob changes
+            image_url = await image_preparer.prepare_data_url(content)
+        else:
+            image_url = f"data:image/png;base64,{base64.b64encode(content).decode('utf-8')}"
+        if image_cache is not None and blob.properties.etag:
+            image_cache.set(image_filename, blob.properties.etag, image_url)
+        return image_url
     except ResourceNotFoundError:
         logging.warning(f"No blob exists for {image_filename}")
         return None
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[str]:
+async def fetch_image(
+    blob_container_client: ContainerClient,
+    result: Document,
+    image_cache: Optional[ImageCache] = None,
+    image_preparer: Optional[ImagePreparer] = None,
+) -> Optional[str]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache, image_preparer)
         return img
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: list[Document],
+    image_cache: Optional[ImageCache] = None,
+    max_concurrency: int = 8,
+    image_preparer: Optional[ImagePreparer] = None,
+) -> list[str]:
+    """
+    Fetches the page images of the search results concurrently, and returns them in the order of the results.
+    Results from the same page share a single download.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def download(sourcepage: str) -> Optional[str]:
+        async with semaphore:
+            return await download_blob_as_base64(blob_container_client, sourcepage, image_cache, image_preparer)
+
+    sourcepages = [result.sourcepage for result in results if result.sourcepage]
+    unique_sourcepages = list(dict.fromkeys(sourcepages))
+    images = dict(zip(unique_sourcepages, await gather_or_cancel(*map(download, unique_sourcepages))))
+    return [img for sourcepage in sourcepages if (img := images[sourcepage])]
@@ -0,0 +1,216 @@
+import os
+import time
+from collections.abc import AsyncIterator, Mapping
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# The OpenAI and Search upstream names are shared with core.admission
+UPSTREAM_BLOB = "blob"
+UPSTREAM_COSMOS = "cosmos"
+UPSTREAM_GRAPH = "graph"
+
+# Buckets in seconds, from cached responses to long answers generated by reasoning models
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+# Buckets in seconds for the time spent waiting in a queue, which is usually close to zero
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# When PROMETHEUS_MULTIPROC_DIR is set before prometheus_client is imported, the values of the metrics
+# are kept in memory mapped files in that directory, so that a scrape of any worker sees the metrics of all the workers
+REQUEST_DURATION = Histogram(
+    "app_request_duration_seconds",
+    "Duration of the requests handled by the app, until the response headers are sent",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_DURATION = Histogram(
+    "app_upstream_duration_seconds",
+    "Duration of the calls to upstream services",
+    ["upstream", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "app_upstream_errors_total",
+    "Calls to upstream services that failed, by type of error",
+    ["upstream", "error"],
+)
+OPENAI_TOKENS = Counter(
+    "app_openai_tokens_total",
+    "Tokens used by the chat completions, as reported in their usage",
+    ["model", "type"],
+)
+CACHE_LOOKUPS = Counter(
+    "app_cache_lookups_total",
+    "Lookups of the caches of the app, by result",
+    ["cache", "result"],
+)
+STREAMS_IN_FLIGHT = Gauge(
+    "app_streams_in_flight",
+    "Streamed responses that are still being sent",
+    multiprocess_mode="livesum",
+)
+HEDGING_CALLS = Counter(
+    "app_hedging_calls_total",
+    "Calls run by the hedging policy, by operation",
+    ["operation"],
+)
+HEDGING_HEDGED = Counter(
+    "app_hedging_hedged_total",
+    "Calls that took longer than the threshold and were sent a second time, by operation",
+    ["operation"],
+)
+HEDGING_WINS = Counter(
+    "app_hedging_wins_total",
+    "Duplicated calls that finished before the original call, by operation",
+    ["operation"],
+)
+# The latencies are kept by each worker, so each worker reports its own threshold
+HEDGING_THRESHOLD = Gauge(
+    "app_hedging_threshold_seconds",
+    "Latency after which a call is sent a second time, by operation",
+    ["operation"],
+    multiprocess_mode="liveall",
+)
+OPENAI_ENDPOINT_CALLS = Counter(
+    "app_openai_endpoint_calls_total",
+    "Calls sent to each Azure OpenAI endpoint by the router",
+    ["endpoint"],
+)
+OPENAI_ENDPOINT_FAILURES = Counter(
+    "app_openai_endpoint_failures_total",
+    "Calls to each Azure OpenAI endpoint that failed with an error specific to the endpoint, including 429 responses",
+    ["endpoint"],
+)
+OPENAI_ENDPOINT_RATE_LIMITED = Counter(
+    "app_openai_endpoint_rate_limited_total",
+    "Calls to each Azure OpenAI endpoint that were rejected with a 429 response",
+    ["endpoint"],
+)
+OPENAI_ENDPOINT_IN_FLIGHT = Gauge(
+    "app_openai_endpoint_in_flight",
+    "Calls to each Azure OpenAI endpoint that haven't finished",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+# The moving averages are kept by each worker, so each worker reports its own
+OPENAI_ENDPOINT_LATENCY = Gauge(
+    "app_openai_endpoint_latency_ewma_seconds",
+    "Exponentially weighted moving average of the latency of each Azure OpenAI endpoint, as used by the router",
+    ["endpoint", "operation"],
+    multiprocess_mode="liveall",
+)
+OPENAI_ENDPOINT_COOLDOWN_UNTIL = Gauge(
+    "app_openai_endpoint_cooldown_until_seconds",
+    "Unix time until which the router avoids each Azure OpenAI endpoint after a 429 response or an error",
+    ["endpoint"],
+    multiprocess_mode="livemax",
+)
+OPENAI_FAILOVERS = Counter(
+    "app_openai_failovers_total",
+    "Calls that the router sent to another Azure OpenAI endpoint after an error",
+)
+ADMISSION_WAITING = Gauge(
+    "app_admission_waiting",
+    "Calls to upstream services waiting in the queue of their concurrency limit",
+    ["upstream"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "app_admission_in_flight",
+    "Calls to upstream services admitted by their concurrency limit that haven't finished",
+    ["upstream"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUE_TIME = Histogram(
+    "app_admission_queue_time_seconds",
+    "Time that calls to upstream services waited to be admitted by their concurrency limit",
+    ["upstream"],
+    buckets=WAIT_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "app_admission_rejected_total",
+    "Requests rejected because the queue of the concurrency limit of an upstream service was full",
+    ["upstream"],
+)
+BLOCKING_CALLS_QUEUED = Gauge(
+    "app_blocking_calls_queued",
+    "Blocking SDK calls waiting for a thread of the blocking executor",
+    multiprocess_mode="livesum",
+)
+BLOCKING_CALLS_ACTIVE = Gauge(
+    "app_blocking_calls_active",
+    "Blocking SDK calls running on a thread of the blocking executor",
+    multiprocess_mode="livesum",
+)
+BLOCKING_CALL_WAIT = Histogram(
+    "app_blocking_call_wait_seconds",
+    "Time that blocking SDK calls waited for a thread of the blocking executor",
+    buckets=WAIT_BUCKETS,
+)
+
+
+@asynccontextmanager
+async def measure_upstream(upstream: str) -> AsyncIterator[None]:
+    """Records the duration of a call to an upstream service, and its error if it fails"""
+    started = time.perf_counter()
+    outcome = "success"
+    try:
+        yield
+    except Exception as error:
+        outcome = "error"
+        UPSTREAM_ERRORS.labels(upstream, type(error).__name__).inc()
+        raise
+    finally:
+        UPSTREAM_DURATION.labels(upstream, outcome).observe(time.perf_counter() - started)
+
+
+def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int, reasoning_tokens: Optional[int]) -> None:
+    OPENAI_TOKENS.labels(model, "prompt").inc(prompt_tokens)
+    OPENAI_TOKENS.labels(model, "completion").inc(completion_tokens)
+    if reasoning_tokens:
+        OPENAI_TOKENS.labels(model, "reasoning").inc(reasoning_tokens)
+
+
+def record_request(route: str, method: str, status: int, duration: float) -> None:
+    REQUEST_DURATION.labels(route, method, str(status)).observe(duration)
+
+
+class CacheStatsExporter:
+    """
+    Exports the hit and miss counts kept by the caches of the app, like TTLCache.stats(), as counters.
+    The caches keep plain integer counts, so the counters are increased by the difference since the last export,
+    which is cheap enough to do after every request.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(self):
+        self._exported: dict[tuple[str, str], int] = {}
+
+    def export(self, cache: str, stats: Mapping[str, Any]) -> None:
+        for result, count in stats.items():
+            if not result.endswith(("hits", "misses")):
+                continue
+            previous = self._exported.get((cache, result), 0)
+            # A cache that was cleared or replaced starts counting from zero again
+            increase = count - previous if count >= previous else count
+            if increase:
+                CACHE_LOOKUPS.labels(cache, result).inc(increase)
+            self._exported[(cache, result)] = count
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Returns the metrics in the Prometheus text format, with their content type"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
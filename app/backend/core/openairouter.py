@@ -0,0 +1,216 @@
+import logging
+import time
+from collections.abc import Awaitable, Mapping
+from typing import Any, Callable, Optional, TypeVar
+
+import httpx
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+
+from core.metrics import (
+    OPENAI_ENDPOINT_CALLS,
+    OPENAI_ENDPOINT_COOLDOWN_UNTIL,
+    OPENAI_ENDPOINT_FAILURES,
+    OPENAI_ENDPOINT_IN_FLIGHT,
+    OPENAI_ENDPOINT_LATENCY,
+    OPENAI_ENDPOINT_RATE_LIMITED,
+    OPENAI_FAILOVERS,
+)
+
+T = TypeVar("T")
+
+logger = logging.getLogger("scripts")
+
+# Embeddings take tens of milliseconds and chat completions take seconds, so their latencies are averaged separately
+OPERATION_CHAT = "chat"
+OPERATION_EMBEDDINGS = "embeddings"
+
+# Errors that are specific to one endpoint, so the call is sent to the next endpoint instead
+FAILOVER_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class OpenAIEndpoint:
+    """
+    One Azure OpenAI endpoint, with the statistics used to route calls to it.
+    The last resort client is used when no other endpoint is left to fail over to, so it can retry failed calls itself.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        client: AsyncOpenAI,
+        timer: Callable[[], float] = time.monotonic,
+        last_resort_client: Optional[AsyncOpenAI] = None,
+    ):
+        self.name = name
+        self.client = client
+        self.last_resort_client = last_resort_client or client
+        self.timer = timer
+        # Moving average latency by operation
+        self.latency_ewma: dict[str, float] = {}
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+        self.remaining_tokens: Optional[float] = None
+        self.remaining_tokens_at = 0.0
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is None:
+            return
+        try:
+            self.remaining_tokens = float(remaining_tokens)
+        except ValueError:
+            return
+        self.remaining_tokens_at = self.timer()
+
+    async def observe_response(self, response: httpx.Response) -> None:
+        """httpx response hook recording the remaining quota reported by every response of the endpoint"""
+        self.observe_headers(response.headers)
+
+
+class OpenAIRouter:
+    """
+    Routes each OpenAI call to one of several Azure OpenAI endpoints that have the same deployments.
+    Endpoints are ranked by their exponentially weighted moving average latency for the operation of the call,
+    weighted by the calls in flight, and endpoints that recently returned a 429 or an error, or that reported
+    little remaining quota, are only used when no other endpoint is available.
+    A call that fails with an error specific to its endpoint is sent to the next one,
+    and the last endpoint is called with its last resort client.
+    The statistics of each endpoint are also exported as metrics labeled by endpoint name.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[OpenAIEndpoint],
+        ewma_alpha: float = 0.3,
+        cooldown: float = 10,
+        low_tokens_threshold: int = 1000,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if not endpoints:
+            raise ValueError("endpoints must not be empty")
+        if not 0 < ewma_alpha <= 1:
+            raise ValueError("ewma_alpha must be between 0 and 1")
+        self.endpoints = endpoints
+        self.ewma_alpha = ewma_alpha
+        self.cooldown = cooldown
+        self.low_tokens_threshold = low_tokens_threshold
+        self.timer = timer
+        self.failovers = 0
+
+    def _is_low_on_tokens(self, endpoint: OpenAIEndpoint, now: float) -> bool:
+        # The remaining quota is reported for the current minute, so older reports are ignored
+        return (
+            endpoint.remaining_tokens is not None
+            and endpoint.remaining_tokens < self.low_tokens_threshold
+            and now - endpoint.remaining_tokens_at < 60
+        )
+
+    def rank(self, operation: str = OPERATION_CHAT) -> list[OpenAIEndpoint]:
+        now = self.timer()
+
+        def sort_key(endpoint: OpenAIEndpoint) -> tuple[bool, bool, float]:
+            # Endpoints without latency measurements yet are tried first, so that every endpoint gets measured
+            score = endpoint.latency_ewma.get(operation, 0) * (endpoint.in_flight + 1)
+            return (endpoint.cooldown_until > now, self._is_low_on_tokens(endpoint, now), score)
+
+        return sorted(self.endpoints, key=sort_key)
+
+    async def call(self, fn: Callable[[AsyncOpenAI], Awaitable[T]], operation: str = OPERATION_CHAT) -> T:
+        """Calls fn with the client of the best endpoint, failing over to the other endpoints on endpoint errors"""
+        endpoints = self.rank(operation)
+        for endpoint in endpoints[:-1]:
+            try:
+                return await self._call_endpoint(endpoint, fn, operation)
+            except FAILOVER_ERRORS as error:
+                self.failovers += 1
+                OPENAI_FAILOVERS.inc()
+                logger.warning("OpenAI endpoint %s failed with %s, failing over", endpoint.name, type(error).__name__)
+        return await self._call_endpoint(endpoints[-1], fn, operation, last_resort=True)
+
+    async def _call_endpoint(
+        self,
+        endpoint: OpenAIEndpoint,
+        fn: Callable[[AsyncOpenAI], Awaitable[T]],
+        operation: str,
+        last_resort: bool = False,
+    ) -> T:
+        endpoint.calls += 1
+        OPENAI_ENDPOINT_CALLS.labels(endpoint.name).inc()
+        endpoint.in_flight += 1
+        OPENAI_ENDPOINT_IN_FLIGHT.labels(endpoint.name).inc()
+        started = self.timer()
+        try:
+            result = await fn(endpoint.last_resort_client if last_resort else endpoint.client)
+        except FAILOVER_ERRORS as error:
+            self._record_failure(endpoint, error)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+            OPENAI_ENDPOINT_IN_FLIGHT.labels(endpoint.name).dec()
+        self._record_latency(endpoint, operation, self.timer() - started)
+        return result
+
+    def _record_latency(self, endpoint: OpenAIEndpoint, operation: str, latency: float) -> None:
+        latency_ewma = endpoint.latency_ewma.get(operation)
+        if latency_ewma is None:
+            latency_ewma = latency
+        else:
+            latency_ewma = self.ewma_alpha * latency + (1 - self.ewma_alpha) * latency_ewma
+        endpoint.latency_ewma[operation] = latency_ewma
+        OPENAI_ENDPOINT_LATENCY.labels(endpoint.name, operation).set(latency_ewma)
+
+    def _record_failure(self, endpoint: OpenAIEndpoint, error: Exception) -> None:
+        endpoint.failures += 1
+        OPENAI_ENDPOINT_FAILURES.labels(endpoint.name).inc()
+        cooldown = self.cooldown
+        if isinstance(error, RateLimitError):
+            endpoint.rate_limited += 1
+            OPENAI_ENDPOINT_RATE_LIMITED.labels(endpoint.name).inc()
+            cooldown = parse_retry_after(error.response.headers) or cooldown
+        now = self.timer()
+        endpoint.cooldown_until = max(endpoint.cooldown_until, now + cooldown)
+        # The timer is monotonic, so the end of the cooldown is converted to wall clock time for the metric
+        OPENAI_ENDPOINT_COOLDOWN_UNTIL.labels(endpoint.name).set(time.time() + endpoint.cooldown_until - now)
+
+    def stats(self) -> dict[str, Any]:
+        now = self.timer()
+        return {
+            "failovers": self.failovers,
+            "endpoints": [
+                {
+                    "name": endpoint.name,
+                    "latency_ewma_ms": {
+                        operation: round(latency_ewma * 1000, 1)
+                        for operation, latency_ewma in endpoint.latency_ewma.items()
+                    },
+                    "in_flight": endpoint.in_flight,
+                    "calls": endpoint.calls,
+                    "failures": endpoint.failures,
+                    "rate_limited": endpoint.rate_limited,
+                    "cooling_down": endpoint.cooldown_until > now,
+                    "remaining_tokens": endpoint.remaining_tokens,
+                }
+                for endpoint in self.endpoints
+            ],
+        }
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Returns the number of seconds to wait before retrying from the retry-after-ms or retry-after headers"""
+    for name, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) / scale
+            except ValueError:
+                continue
+    return None
@@ -0,0 +1,73 @@
+import asyncio
+import datetime
+from typing import Callable, Optional
+
+from azure.storage.blob import BlobSasPermissions, UserDelegationKey, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+
+
+class UserDelegationSasGenerator:
+    """
+    Generates short-lived, read-only SAS URLs for blobs, signed with a user delegation key.
+    The user delegation key is cached and renewed before it expires, so generating a URL
+    usually doesn't require a call to storage.
+    """
+
+    def __init__(
+        self,
+        service_client: BlobServiceClient,
+        container: str,
+        sas_expiry: datetime.timedelta = datetime.timedelta(minutes=5),
+        key_expiry: datetime.timedelta = datetime.timedelta(hours=6),
+        clock: Callable[[], datetime.datetime] = lambda: datetime.datetime.now(datetime.timezone.utc),
+    ):
+        if sas_expiry >= key_expiry:
+            raise ValueError("sas_expiry must be shorter than key_expiry")
+        if not service_client.account_name:
+            raise ValueError("Unable to determine the storage account name")
+        self.account_name: str = service_client.account_name
+        self.service_client = service_client
+        self.container = container
+        self.sas_expiry = sas_expiry
+        self.key_expiry = key_expiry
+        self.clock = clock
+        self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.user_delegation_key_expiry: Optional[datetime.datetime] = None
+        self.lock = asyncio.Lock()
+
+    async def get_user_delegation_key(self, now: datetime.datetime) -> UserDelegationKey:
+        # A SAS can't outlive the key that signed it, so renew the key while it can still sign a full SAS
+        async with self.lock:
+            if (
+                self.user_delegation_key is None
+                or self.user_delegation_key_expiry is None
+                or self.user_delegation_key_expiry < now + self.sas_expiry
+            ):
+                # Start slightly in the past to tolerate clock skew with storage
+                start = now - datetime.timedelta(minutes=5)
+                expiry = now + self.key_expiry
+                self.user_delegation_key = await self.service_client.get_user_delegation_key(start, expiry)
+                self.user_delegation_key_expiry = expiry
+            return self.user_delegation_key
+
+    async def generate_blob_url(
+        self, blob_name: str, content_type: Optional[str] = None, content_disposition: Optional[str] = None
+    ) -> str:
+        now = self.clock()
+        user_delegation_key = await self.get_user_delegation_key(now)
+        blob_client = self.service_client.get_blob_client(self.container, blob_name)
+        sas_token = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=self.container,
+            blob_name=blob_name,
+            user_delegation_key=user_delegation_key,
+            permission=BlobSasPermissions(read=True),
+            start=now - datetime.timedelta(minutes=5),
+            expiry=now + self.sas_expiry,
+            content_type=content_type,
+            content_disposition=content_disposition,
+        )
+        return f"{blob_client.url}?{sas_token}"
+
+    async def close(self) -> None:
+        await self.service_client.close()
@@ -0,0 +1,125 @@
+import asyncio
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Hashable
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    def __init__(self, task: "asyncio.Future[Any]"):
+        self.task = task
+        self.waiters = 0
+
+
+class _Stream(Generic[T]):
+    def __init__(self):
+        self.items: list[T] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task[None]] = None
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first call runs, and the calls that arrive while it is
+    in flight wait for it and share its result or exception. Nothing is kept once the call has finished.
+    Streams are fanned out the same way, every subscriber receiving all the items produced by a single upstream stream.
+    The upstream call is cancelled once every caller waiting for it has been cancelled.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, _Call] = {}
+        self._streams: dict[Hashable, _Stream[Any]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        """Whether a call with the key is running, so that a call to do with the same key would join it"""
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            self.calls += 1
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget_call(key, call))
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # Calls that arrive from now on start a new flight instead of joining the cancelled one
+                self._forget_call(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget_call(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def stream(self, key: Hashable, fn: Callable[[], AsyncIterator[T]]) -> AsyncGenerator[T, None]:
+        stream = self._streams.get(key)
+        if stream is None:
+            self.calls += 1
+            stream = _Stream()
+            self._streams[key] = stream
+            stream.task = asyncio.create_task(self._produce(key, stream, fn))
+        else:
+            self.coalesced += 1
+        stream.subscribers += 1
+        index = 0
+        try:
+            while True:
+                # Subscribers that join late first receive the items that were already produced
+                while index < len(stream.items):
+                    yield stream.items[index]
+                    index += 1
+                if stream.done:
+                    if stream.error is not None:
+                        raise stream.error
+                    return
+                await stream.changed.wait()
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0 and stream.task is not None and not stream.task.done():
+                # Subscribers that arrive from now on start a new stream instead of joining the cancelled one
+                self._forget_stream(key, stream)
+                stream.task.cancel()
+
+    def _forget_stream(self, key: Hashable, stream: _Stream[Any]) -> None:
+        if self._streams.get(key) is stream:
+            del self._streams[key]
+
+    async def _produce(self, key: Hashable, stream: _Stream[T], fn: Callable[[], AsyncIterator[T]]) -> None:
+        try:
+            async for item in fn():
+                stream.items.append(item)
+                stream.notify()
+        except Exception as error:
+            stream.error = error
+        except asyncio.CancelledError:
+            # A stream cut short must never look like a complete one
+            stream.error = RuntimeError("The stream was cancelled before it finished")
+            raise
+        finally:
+            stream.done = True
+            self._forget_stream(key, stream)
+            stream.notify()
+
+    def stats(self) -> dict[str, int]:
+        return {"in_flight": len(self), "calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,99 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+STAGE_HISTORY_SUMMARY = "history_summary"
+STAGE_REWRITE = "rewrite"
+STAGE_EMBEDDING = "embedding"
+STAGE_IMAGE_EMBEDDING = "image_embedding"
+# The wall clock time of the text and image embeddings of a query, which are computed concurrently
+STAGE_QUERY_VECTORS = "query_vectors"
+STAGE_SEARCH = "search"
+STAGE_FETCH_IMAGE = "fetch_image"
+STAGE_PROMPT_RENDER = "prompt_render"
+STAGE_TIME_TO_FIRST_TOKEN = "ttft"
+STAGE_GENERATION = "generation"
+# The time spent waiting for an identical request in flight, whose response is shared instead of generated again
+STAGE_COALESCED = "coalesced"
+STAGE_TOTAL = "total"
+
+
+class StageMeasurement:
+    """The duration of one measured stage, in seconds, set when the stage ends"""
+
+    def __init__(self):
+        self.duration = 0.0
+
+
+class StageTimings:
+    """
+    Durations of the stages of one request, measured with a monotonic clock.
+    Stages that run several times, like the searches of a request, are added up,
+    and stages that run concurrently, like a speculative search and the query rewrite, overlap.
+    """
+
+    def __init__(self, show_in_thoughts: bool = False, timer: Callable[[], float] = time.perf_counter):
+        # The durations are added to the thought process of the response when requested,
+        # otherwise they're only sent in the Server-Timing header
+        self.show_in_thoughts = show_in_thoughts
+        self.timer = timer
+        self.started = timer()
+        self.durations: dict[str, float] = {}
+
+    def record(self, stage: str, duration: float) -> None:
+        self.durations[stage] = self.durations.get(stage, 0.0) + duration
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[StageMeasurement]:
+        measurement = StageMeasurement()
+        started = self.timer()
+        try:
+            yield measurement
+        finally:
+            measurement.duration = self.timer() - started
+            self.record(stage, measurement.duration)
+
+    def record_total(self) -> None:
+        self.durations[STAGE_TOTAL] = self.timer() - self.started
+
+    def as_props(self) -> dict[str, float]:
+        return {f"{stage}_ms": round(duration * 1000, 1) for stage, duration in self.durations.items()}
+
+    def server_timing(self) -> str:
+        """Formats the durations for the Server-Timing header, which browser developer tools display"""
+        return ", ".join(f"{stage};dur={duration * 1000:.1f}" for stage, duration in self.durations.items())
+
+
+# The timings of the request being handled, which are inherited by the tasks that the request starts
+_current_timings: ContextVar[Optional[StageTimings]] = ContextVar("stage_timings", default=None)
+
+
+def start_stage_timings(show_in_thoughts: bool = False) -> StageTimings:
+    timings = StageTimings(show_in_thoughts)
+    _current_timings.set(timings)
+    return timings
+
+
+def get_stage_timings() -> Optional[StageTimings]:
+    return _current_timings.get()
+
+
+@contextmanager
+def measure_stage(stage: str) -> Iterator[StageMeasurement]:
+    """
+    Measures a stage of the request being handled, recording it in its timings if they were started.
+    The duration of the stage is also set on the yielded measurement, for the callers that report it elsewhere.
+    """
+    timings = _current_timings.get()
+    if timings is not None:
+        with timings.measure(stage) as measurement:
+            yield measurement
+        return
+    measurement = StageMeasurement()
+    started = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement.duration = time.perf_counter() - started
@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import itertools
+import json
+import re
+import time
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+# Priority classes that clients can request with the "priority" override, lower values are scheduled first
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "batch": PRIORITY_BATCH}
+
+# Tokens added by the chat format around each message and before the reply
+# https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# Images are counted as a low detail image, as the size of the image isn't known without decoding it
+TOKENS_PER_IMAGE = 85
+
+
+@lru_cache
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Deployments of recent models that tiktoken doesn't know yet use the encoding of the GPT-4o family
+        return tiktoken.get_encoding("o200k_base")
+
+
+def estimate_text_tokens(model: str, text: str) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def estimate_messages_tokens(
+    model: str,
+    messages: list[ChatCompletionMessageParam],
+    tools: Optional[list[ChatCompletionToolParam]] = None,
+) -> int:
+    """Estimates the number of prompt tokens of a chat completion request before sending it"""
+    encoding = get_encoding(model)
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE + len(encoding.encode(str(message["role"]), disallowed_special=()))
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(encoding.encode(content, disallowed_special=()))
+        elif content:
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += len(encoding.encode(str(part.get("text", "")), disallowed_special=()))
+                else:
+                    tokens += TOKENS_PER_IMAGE
+    if tools:
+        tokens += len(encoding.encode(json.dumps(tools), disallowed_special=()))
+    return tokens
+
+
+def trim_messages(
+    model: str, messages: list[ChatCompletionMessageParam], token_budget: int
+) -> tuple[list[ChatCompletionMessageParam], list[ChatCompletionMessageParam]]:
+    """
+    Keeps the newest messages of a conversation that fit in the token budget.
+    Returns the kept messages and the older messages that were dropped.
+    """
+    kept_from = len(messages)
+    tokens = 0
+    for i in range(len(messages) - 1, -1, -1):
+        message_tokens = estimate_messages_tokens(model, [messages[i]]) - TOKENS_PER_REPLY
+        if tokens + message_tokens > token_budget:
+            break
+        tokens += message_tokens
+        kept_from = i
+    # An answer whose question was dropped is dropped too, so that the kept messages start with a question
+    if kept_from < len(messages) and messages[kept_from]["role"] == "assistant":
+        kept_from += 1
+    return messages[kept_from:], messages[:kept_from]
+
+
+# End of a sentence, in the text of a source once its newlines are replaced by spaces
+SENTENCE_END = re.compile(r"[.!?](?=\s|$)|[。！？]")
+
+
+def pack_sources(model: str, sources: list[str], token_budget: int) -> tuple[list[str], dict[str, int]]:
+    """
+    Keeps the sources in rank order until they fill the token budget. The first source that doesn't fit is truncated
+    after its last complete sentence within the budget, and the sources after it are dropped.
+    Sources start with their citation, like "benefits.pdf#page=2: ", which is kept with any part of the source.
+    """
+    encoding = get_encoding(model)
+    packed: list[str] = []
+    packed_tokens = dropped_tokens = dropped_sources = truncated_sources = 0
+    for source in sources:
+        tokens = encoding.encode(source, disallowed_special=())
+        remaining = token_budget - packed_tokens
+        budget_filled = dropped_sources or truncated_sources
+        if not budget_filled and len(tokens) <= remaining:
+            packed.append(source)
+            packed_tokens += len(tokens)
+            continue
+        if not budget_filled and remaining > 0:
+            citation_end = source.find(": ") + 2
+            # The last token may be a partial character, which is cut off with the incomplete sentence
+            text = encoding.decode(tokens[:remaining])
+            sentence_ends = [match.end() for match in SENTENCE_END.finditer(text, citation_end)]
+            if sentence_ends:
+                truncated = text[: sentence_ends[-1]]
+                truncated_tokens = len(encoding.encode(truncated, disallowed_special=()))
+                packed.append(truncated)
+                packed_tokens += truncated_tokens
+                dropped_tokens += len(tokens) - truncated_tokens
+                truncated_sources += 1
+                continue
+        dropped_tokens += len(tokens)
+        dropped_sources += 1
+    return packed, {
+        "token_budget": token_budget,
+        "packed_tokens": packed_tokens,
+        "dropped_tokens": dropped_tokens,
+        "packed_sources": len(packed),
+        "truncated_sources": truncated_sources,
+        "dropped_sources": dropped_sources,
+    }
+
+
+class TokenBudgetScheduler:
+    """
+    Paces the calls to one OpenAI deployment so that they stay under its tokens per minute and requests per minute quota,
+    instead of being rejected with 429 responses and retried.
+    Each call reserves its estimated number of tokens from a token bucket that refills at the quota rate,
+    and waits until there are enough tokens left. Calls wait in priority order, then in arrival order.
+    The buckets are lowered to the remaining quota reported by the x-ratelimit-remaining-* response headers,
+    as the quota of a deployment can be shared with other clients.
+    Not thread-safe: it is meant to be used from a single asyncio event loop.
+    """
+
+    def __init__(
+        self,
+        deployment: str,
+        tokens_per_minute: int,
+        requests_per_minute: int,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if tokens_per_minute <= 0:
+            raise ValueError("tokens_per_minute must be a positive number")
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be a positive number")
+        self.deployment = deployment
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.timer = timer
+        self.tokens = float(tokens_per_minute)
+        self.requests = float(requests_per_minute)
+        self.scheduled = 0
+        self.delayed = 0
+        self.rate_limited = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._refilled_at = timer()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, int, asyncio.Future[None]]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self) -> None:
+        now = self.timer()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute / 60)
+        self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute / 60)
+
+    def _delay(self, tokens: int) -> float:
+        """Returns the number of seconds until there is enough budget left for a call"""
+        delay = max(0.0, self._paused_until - self.timer())
+        if self.tokens < tokens:
+            delay = max(delay, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+        if self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.requests_per_minute)
+        return delay
+
+    def _take(self, tokens: int) -> None:
+        self.tokens -= tokens
+        self.requests -= 1
+        self.scheduled += 1
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE) -> None:
+        """Waits until there is enough budget left for a call using the given number of tokens, and reserves it"""
+        # A call larger than the quota could never be scheduled, so it only waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        self._refill()
+        if not self._waiters and self._delay(tokens) == 0:
+            self._take(tokens)
+            return
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self.delayed += 1
+        started = self.timer()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The budget was reserved just before the call was cancelled, so it's given back
+                self.tokens += tokens
+                self.requests += 1
+            self._dispatch()
+            raise
+        wait_time = self.timer() - started
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def _dispatch(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._refill()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            # Only the first call in line can be scheduled, so that large calls aren't starved by smaller ones
+            delay = self._delay(tokens)
+            if delay > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+    @staticmethod
+    def _parse_header(headers: Mapping[str, str], name: str) -> Optional[float]:
+        value = headers.get(name)
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Lowers the budget to the remaining quota reported by the deployment"""
+        self._refill()
+        remaining_tokens = self._parse_header(headers, "x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.tokens = min(self.tokens, remaining_tokens)
+        remaining_requests = self._parse_header(headers, "x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.requests = min(self.requests, remaining_requests)
+
+    def record_rate_limit(self, headers: Mapping[str, str]) -> None:
+        """Pauses the calls for the time requested by a 429 response of the deployment"""
+        self.rate_limited += 1
+        self.update_from_headers(headers)
+        retry_after_ms = self._parse_header(headers, "retry-after-ms")
+        retry_after = (
+            retry_after_ms / 1000 if retry_after_ms is not None else self._parse_header(headers, "retry-after")
+        )
+        self._paused_until = max(self._paused_until, self.timer() + (retry_after or 1))
+
+    def stats(self) -> dict[str, Any]:
+        self._refill()
+        return {
+            "deployment": self.deployment,
+            "tokens_available": int(self.tokens),
+            "requests_available": int(self.requests),
+            "waiting": sum(1 for _, _, _, future in self._waiters if not future.done()),
+            "scheduled": self.scheduled,
+            "delayed": self.delayed,
+            "rate_limited": self.rate_limited,
+            "wait_time_avg_ms": round(self.wait_time_total / self.delayed * 1000, 1) if self.delayed else 0,
+            "wait_time_max_ms": round(self.wait_time_max * 1000, 1),
+        }
@@ -3,6 +3,8 @@ import logging
 from openai import APIError
 from quart import jsonify
 
+from core.admission import OverloadedError
+
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -11,8 +13,12 @@ ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the
 
 ERROR_MESSAGE_LENGTH = """Your message exceeded the context length limit for this OpenAI model. Please shorten your message or change your settings to retrieve fewer search results."""
 
+ERROR_MESSAGE_OVERLOADED = """The app is receiving too many requests right now. Please try again in a few seconds."""
+
 
 def error_dict(error: Exception) -> dict:
+    if isinstance(error, OverloadedError):
+        return {"error": ERROR_MESSAGE_OVERLOADED}
     if isinstance(error, APIError) and error.code == "content_filter":
         return {"error": ERROR_MESSAGE_FILTER}
     if isinstance(error, APIError) and error.code == "context_length_exceeded":
@@ -21,6 +27,10 @@ def error_dict(error: Exception) -> dict:
 
 
 def error_response(error: Exception, route: str, status_code: int = 500):
+    if isinstance(error, OverloadedError):
+        # Shedding load is expected under overload, so there is no need for a stack trace
+        logging.warning("Request to %s shed: %s", route, error)
+        return jsonify(error_dict(error)), 503, {"Retry-After": str(error.retry_after)}
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
@@ -1,5 +1,15 @@
 import multiprocessing
 import os
+import shutil
+import tempfile
+
+# The metrics of all the workers are aggregated through files in this directory, which has to be set
+# before the workers import prometheus_client, and is emptied when the app starts
+prometheus_multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus-metrics")
+)
+shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+os.makedirs(prometheus_multiproc_dir, exist_ok=True)
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -16,3 +26,10 @@ if os.getenv("WEBSITE_SKU") == "LinuxFree":
 else:
     workers = (num_cpus * 2) + 1
 worker_class = "custom_uvicorn_worker.CustomUvicornWorker"
+
+
+def child_exit(server, worker):
+    # The gauges of a worker that exited no longer count in the metrics
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
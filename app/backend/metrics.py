@@ -0,0 +1,56 @@
+import time
+
+from quart import Blueprint, Response, current_app, g, request
+
+from config import (
+    CONFIG_ANSWER_CACHE,
+    CONFIG_AUTH_CLIENT,
+    CONFIG_EMBEDDING_CACHE,
+    CONFIG_HISTORY_SUMMARY_CACHE,
+    CONFIG_IMAGE_CACHE,
+    CONFIG_RETRIEVAL_CACHE,
+    CONFIG_SPEECH_AUDIO_CACHE,
+)
+from core.metrics import CacheStatsExporter, record_request, render_metrics
+
+metrics_bp = Blueprint("metrics", __name__)
+
+# Caches whose hits and misses are exported, by the name used in the metrics
+CACHES = {
+    "embedding": CONFIG_EMBEDDING_CACHE,
+    "retrieval": CONFIG_RETRIEVAL_CACHE,
+    "answer": CONFIG_ANSWER_CACHE,
+    "image": CONFIG_IMAGE_CACHE,
+    "history_summary": CONFIG_HISTORY_SUMMARY_CACHE,
+    "speech_audio": CONFIG_SPEECH_AUDIO_CACHE,
+}
+
+cache_stats_exporter = CacheStatsExporter()
+
+
+@metrics_bp.before_app_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@metrics_bp.after_app_request
+async def record_request_metrics(response: Response):
+    started = g.get("request_started")
+    if started is not None:
+        # Requests are grouped by route rule rather than path, so that paths like /content/<path> don't create a series per file
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        record_request(route, request.method, response.status_code, time.perf_counter() - started)
+    for name, config_key in CACHES.items():
+        cache = current_app.config.get(config_key)
+        if cache is not None:
+            cache_stats_exporter.export(name, cache.stats())
+    auth_helper = current_app.config.get(CONFIG_AUTH_CLIENT)
+    if auth_helper is not None:
+        cache_stats_exporter.export("auth_claims", auth_helper.auth_claims_cache_metrics)
+    return response
+
+
+@metrics_bp.route("/metrics", methods=["GET"])
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content, content_type=content_type)
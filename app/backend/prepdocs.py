@@ -9,6 +9,7 @@ from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
 from rich.logging import RichHandler
 
+from core.httpsessions import HTTPSessionRegistry
 from load_azd_env import load_azd_env
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.csvparser import CsvParser
@@ -178,6 +179,7 @@ def setup_file_processors(
     search_images: bool = False,
     use_content_understanding: bool = False,
     content_understanding_endpoint: Union[str, None] = None,
+    http_sessions: Optional[HTTPSessionRegistry] = None,
 ):
     sentence_text_splitter = SentenceTextSplitter()
 
@@ -192,6 +194,7 @@ def setup_file_processors(
             credential=documentintelligence_creds,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=content_understanding_endpoint,
+            http_sessions=http_sessions,
         )
 
     pdf_parser: Optional[Parser] = None
@@ -241,7 +244,10 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    http_sessions: Optional[HTTPSessionRegistry] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -250,6 +256,7 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            http_sessions=http_sessions,
         )
     return image_embeddings_service
 
@@ -351,6 +358,8 @@ if __name__ == "__main__":
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    # The calls to the vision and Content Understanding endpoints share pooled connections for the whole run
+    http_sessions = HTTPSessionRegistry()
 
     openai_host = os.environ["OPENAI_HOST"]
     # Check for incompatibility
@@ -445,11 +454,13 @@ if __name__ == "__main__":
             search_images=use_gptvision,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            http_sessions=http_sessions,
         )
         image_embeddings_service = setup_image_embeddings_service(
             azure_credential=azd_credential,
             vision_endpoint=os.getenv("AZURE_VISION_ENDPOINT"),
             search_images=use_gptvision,
+            http_sessions=http_sessions,
         )
 
         ingestion_strategy = FileStrategy(
@@ -467,7 +478,11 @@ if __name__ == "__main__":
             category=args.category,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            http_sessions=http_sessions,
         )
 
-    loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    try:
+        loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    finally:
+        loop.run_until_complete(http_sessions.close())
     loop.close()
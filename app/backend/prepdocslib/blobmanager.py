@@ -71,6 +71,46 @@ class BlobManager:
     def get_managedidentity_connectionstring(self):
         return f"ResourceId=/subscriptions/{self.subscriptionId}/resourceGroups/{self.resourceGroup}/providers/Microsoft.Storage/storageAccounts/{self.account};"
 
+    @staticmethod
+    def page_image_font() -> Optional[Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]]:
+        font = None
+        try:
+            font = ImageFont.truetype("arial.ttf", 20)
+        except OSError:
+            try:
+                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
+            except OSError:
+                logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
+        return font
+
+    @staticmethod
+    def render_page_image(
+        page: pymupdf.Page, blob_name: str, font: Optional[Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]] = None
+    ) -> bytes:
+        """Renders a PDF page as the PNG image that is uploaded for GPT-4V, with the name of its blob above the page"""
+        pix = page.get_pixmap()
+        original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
+
+        # Create a new image with additional space for text
+        text_height = 40  # Height of the text area
+        new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+        # Paste the original image onto the new image
+        new_img.paste(original_img, (0, text_height))
+
+        # Draw the text on the white area
+        draw = ImageDraw.Draw(new_img)
+        text = f"SourceFileName:{blob_name}"
+
+        # 10 pixels from the top and left of the image
+        x = 10
+        y = 10
+        draw.text((x, y), text, font=font, fill="black")
+
+        output = io.BytesIO()
+        new_img.save(output, format="PNG")
+        return output.getvalue()
+
     async def upload_pdf_blob_images(
         self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
     ) -> list[str]:
@@ -82,14 +122,7 @@ class BlobManager:
         start_time = datetime.datetime.now(datetime.timezone.utc)
         expiry_time = start_time + datetime.timedelta(days=1)
 
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except OSError:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
-            except OSError:
-                logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
+        font = BlobManager.page_image_font()
 
         for i in range(page_count):
             blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
@@ -97,28 +130,7 @@ class BlobManager:
 
             doc = pymupdf.open(file.content.name)
             page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
+            output = io.BytesIO(BlobManager.render_page_image(page, blob_name, font))
 
             blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
             if not self.user_delegation_key:
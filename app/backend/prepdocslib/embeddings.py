@@ -4,7 +4,6 @@ from collections.abc import Awaitable
 from typing import Callable, Optional, Union
 from urllib.parse import urljoin
 
-import aiohttp
 import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -18,6 +17,8 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from core.httpsessions import HTTPSessionRegistry, http_session
+
 logger = logging.getLogger("scripts")
 
 
@@ -232,9 +233,15 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        self.http_sessions = http_sessions
 
     async def create_embeddings(self, blob_urls: list[str]) -> list[list[float]]:
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
@@ -243,7 +250,7 @@ class ImageEmbeddings:
         headers["Authorization"] = "Bearer " + await self.token_provider()
 
         embeddings: list[list[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with http_session(self.http_sessions, endpoint) as session:
             for blob_url in blob_urls:
                 async for attempt in AsyncRetrying(
                     retry=retry_if_exception_type(Exception),
@@ -253,7 +260,7 @@ class ImageEmbeddings:
                 ):
                     with attempt:
                         body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
+                        async with session.post(url=endpoint, params=params, headers=headers, json=body) as resp:
                             resp_json = await resp.json()
                             embeddings.append(resp_json["vector"])
 
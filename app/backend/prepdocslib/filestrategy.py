@@ -3,6 +3,8 @@ from typing import Optional
 
 from azure.core.credentials import AzureKeyCredential
 
+from core.httpsessions import HTTPSessionRegistry
+
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
@@ -59,6 +61,7 @@ class FileStrategy(Strategy):
         category: Optional[str] = None,
         use_content_understanding: bool = False,
         content_understanding_endpoint: Optional[str] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -73,6 +76,7 @@ class FileStrategy(Strategy):
         self.category = category
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.http_sessions = http_sessions
 
     def setup_search_manager(self):
         self.search_manager = SearchManager(
@@ -96,7 +100,9 @@ class FileStrategy(Strategy):
                 raise ValueError(
                     "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                 )
-            cu_manager = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.search_info.credential)
+            cu_manager = ContentUnderstandingDescriber(
+                self.content_understanding_endpoint, self.search_info.credential, self.http_sessions
+            )
             await cu_manager.create_analyzer()
 
     async def run(self):
@@ -3,7 +3,7 @@ import io
 import logging
 from collections.abc import AsyncGenerator
 from enum import Enum
-from typing import IO, Union
+from typing import IO, Optional, Union
 from .customizations.medica import MedicaDocClassifier
 
 import pymupdf
@@ -20,6 +20,8 @@ from azure.core.exceptions import HttpResponseError
 from PIL import Image
 from pypdf import PdfReader
 
+from core.httpsessions import HTTPSessionRegistry
+
 from .mediadescriber import ContentUnderstandingDescriber
 from .page import Page
 from .parser import Parser
@@ -58,12 +60,14 @@ class DocumentAnalysisParser(Parser):
         model_id="prebuilt-layout",
         use_content_understanding=True,
         content_understanding_endpoint: Union[str, None] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.http_sessions = http_sessions
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using Azure Document Intelligence", content.name)
@@ -79,7 +83,9 @@ class DocumentAnalysisParser(Parser):
                     raise ValueError(
                         "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                     )
-                cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
+                cu_describer = ContentUnderstandingDescriber(
+                    self.content_understanding_endpoint, self.credential, self.http_sessions
+                )
                 content_bytes = content.read()
                 try:
                     poller = await document_intelligence_client.begin_analyze_document(
@@ -42,6 +42,8 @@ export type ChatAppRequestOverrides = {
     vector_fields: VectorFields;
     language: string;
     use_agentic_retrieval: boolean;
+    bypass_retrieval_cache?: boolean;
+    priority?: "interactive" | "batch";
 };
 
 export type ResponseMessage = {
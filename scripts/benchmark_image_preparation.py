@@ -0,0 +1,102 @@
+"""
+Compares the sizes and the estimated GPT-4V tokens of the page images sent to GPT-4V, as uploaded by prepdocs,
+with the images prepared by the IMAGE_MAX_LONG_EDGE, IMAGE_FORMAT, IMAGE_QUALITY and IMAGE_DETAIL settings.
+The pages of the PDFs are rendered like prepdocs renders them, so the images match the images in the storage account.
+
+Usage:
+    python ./scripts/benchmark_image_preparation.py --max-pages 20
+    python ./scripts/benchmark_image_preparation.py --data-dir ./data --json
+"""
+
+import argparse
+import base64
+import io
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import pymupdf
+from PIL import Image
+
+sys.path.append(str(Path(__file__).parent.parent / "app" / "backend"))
+
+from core.imageshelper import ImagePreparer, estimate_image_tokens  # noqa: E402
+from prepdocslib.blobmanager import BlobManager  # noqa: E402
+
+# Variants of the preparation, by name, with the detail level used to estimate their tokens
+VARIANTS = {
+    "original png": (None, "auto"),
+    "jpeg q85": (ImagePreparer(image_format="jpeg", quality=85), "auto"),
+    "webp q80": (ImagePreparer(image_format="webp", quality=80), "auto"),
+    # Pages of 512px or less fit in a single tile of 512px
+    "png, 512px": (ImagePreparer(max_long_edge=512), "auto"),
+    "jpeg q85, 512px": (ImagePreparer(max_long_edge=512, image_format="jpeg", quality=85), "auto"),
+    "jpeg q85, low detail": (ImagePreparer(image_format="jpeg", quality=85, detail="low"), "low"),
+}
+
+
+def render_pages(data_dir: Path, max_pages: int) -> list[bytes]:
+    font = BlobManager.page_image_font()
+    images: list[bytes] = []
+    for path in sorted(data_dir.glob("*.pdf")):
+        with pymupdf.open(path) as doc:
+            for i in range(doc.page_count):
+                if len(images) >= max_pages:
+                    return images
+                blob_name = BlobManager.blob_image_name_from_file_page(path.name, i)
+                images.append(BlobManager.render_page_image(doc.load_page(i), blob_name, font))
+    return images
+
+
+def measure_variant(images: list[bytes], preparer: Optional[ImagePreparer], detail: str) -> dict[str, float]:
+    sizes, tokens, durations = [], [], []
+    for image in images:
+        started = time.perf_counter()
+        prepared = preparer.prepare(image)[0] if preparer else image
+        durations.append(time.perf_counter() - started)
+        with Image.open(io.BytesIO(prepared)) as opened:
+            tokens.append(estimate_image_tokens(opened.width, opened.height, detail))
+        # The images are sent as base64 data URLs, which are a third larger than the images
+        sizes.append(len(base64.b64encode(prepared)))
+    return {
+        "data_url_bytes_mean": statistics.mean(sizes),
+        "tokens_mean": statistics.mean(tokens),
+        "prepare_ms_median": statistics.median(durations) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the savings of preparing page images for GPT-4V")
+    parser.add_argument("--data-dir", type=Path, default=Path(__file__).parent.parent / "data", help="Folder of PDFs")
+    parser.add_argument("--max-pages", type=int, default=20, help="Number of pages to render")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON, to track them over time")
+    args = parser.parse_args()
+
+    images = render_pages(args.data_dir, args.max_pages)
+    if not images:
+        print(f"No PDF pages found in {args.data_dir}", file=sys.stderr)
+        sys.exit(1)
+    variants = {name: measure_variant(images, preparer, detail) for name, (preparer, detail) in VARIANTS.items()}
+    original = variants["original png"]
+    for result in variants.values():
+        result["bytes_saved_percent"] = 100 * (1 - result["data_url_bytes_mean"] / original["data_url_bytes_mean"])
+        result["tokens_saved_percent"] = 100 * (1 - result["tokens_mean"] / original["tokens_mean"])
+    results = {"pages": len(images), "variants": variants}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"Page images of {len(images)} pages from {args.data_dir}:")
+        print(f"  {'variant':<30}{'KB':>8}{'saved':>8}{'tokens':>8}{'saved':>8}{'ms':>8}")
+        for name, result in variants.items():
+            print(
+                f"  {name:<30}{result['data_url_bytes_mean'] / 1024:>8.0f}{result['bytes_saved_percent']:>7.0f}%"
+                f"{result['tokens_mean']:>8.0f}{result['tokens_saved_percent']:>7.0f}%{result['prepare_ms_median']:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures how long a worker of the backend app takes to boot, that is to import the app module and create the Quart app,
+in fresh Python processes like the workers that gunicorn starts and restarts.
+
+Usage:
+    python ./scripts/benchmark_worker_boot.py --runs 5 --top 15
+    python ./scripts/benchmark_worker_boot.py --max-seconds 3 --json
+
+The environment variables of the shell are passed to the workers, so features that import more modules
+(like APPLICATIONINSIGHTS_CONNECTION_STRING) can be measured by setting them.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent.parent / "app" / "backend"
+
+BOOT_CODE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({"import_seconds": imported - started, "create_app_seconds": created - imported}))
+"""
+
+
+def measure_boot() -> dict[str, float]:
+    output = subprocess.run(
+        [sys.executable, "-c", BOOT_CODE], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(top: int) -> list[tuple[str, float]]:
+    """Returns the modules with the longest cumulative import time, as reported by python -X importtime"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"], cwd=BACKEND_DIR, capture_output=True, text=True
+    ).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.removeprefix("import time:").split("|")
+        # Only the modules imported by the app module are listed, as their cumulative time includes the modules they import
+        if len(module) - len(module.lstrip()) == 3:
+            imports.append((module.strip(), int(cumulative) / 1_000_000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the boot time of a backend app worker")
+    parser.add_argument("--runs", type=int, default=5, help="Number of workers to boot")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument("--max-seconds", type=float, help="Exit with an error when the median boot time is longer")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON, to track them over time")
+    args = parser.parse_args()
+
+    runs = [measure_boot() for _ in range(args.runs)]
+    boot_times = [run["import_seconds"] + run["create_app_seconds"] for run in runs]
+    results = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "boot_seconds_median": statistics.median(boot_times),
+        "boot_seconds_min": min(boot_times),
+        "import_seconds_median": statistics.median(run["import_seconds"] for run in runs),
+        "create_app_seconds_median": statistics.median(run["create_app_seconds"] for run in runs),
+        "slowest_imports": [{"module": module, "seconds": seconds} for module, seconds in slowest_imports(args.top)],
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"Worker boot time over {args.runs} runs (Python {results['python']}):")
+        print(f"  median {results['boot_seconds_median']:.3f}s, min {results['boot_seconds_min']:.3f}s")
+        print(
+            f"  import app: {results['import_seconds_median']:.3f}s, create_app: {results['create_app_seconds_median']:.3f}s"
+        )
+        print("Slowest imports:")
+        for item in results["slowest_imports"]:
+            print(f"  {item['seconds']:.3f}s  {item['module']}")
+
+    if args.max_seconds is not None and results["boot_seconds_median"] > args.max_seconds:
+        print(f"Median boot time is longer than {args.max_seconds}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
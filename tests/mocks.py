@@ -62,6 +62,13 @@ class MockBlob:
     async def readinto(self, buffer: BytesIO):
         buffer.write(b"test")
 
+    @property
+    def size(self):
+        return len(b"test")
+
+    async def chunks(self):
+        yield b"test"
+
 
 class MockAsyncPageIterator:
     def __init__(self, data):
@@ -293,12 +300,38 @@ class MockSynthesisResult:
 
 
 def mock_speak_text_success(self, text):
-    return MockSynthesisResult(MockAudio("mock_audio_data"))
+    return MockSynthesisResult(MockAudio(b"mock_audio_data"))
 
 
 def mock_speak_text_cancelled(self, text):
-    return MockSynthesisResult(MockAudioCancelled("mock_audio_data"))
+    return MockSynthesisResult(MockAudioCancelled(b"mock_audio_data"))
 
 
 def mock_speak_text_failed(self, text):
-    return MockSynthesisResult(MockAudioFailure("mock_audio_data"))
+    return MockSynthesisResult(MockAudioFailure(b"mock_audio_data"))
+
+
+class MockSynthesisEventArgs:
+    def __init__(self, audio_data):
+        self.result = MockAudio(audio_data)
+
+
+class MockEventSignal:
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+
+def mock_speak_text_streaming(chunks):
+    signal = MockEventSignal()
+
+    def speak_text_async(self, text):
+        # The Speech SDK reports each synthesized chunk to the synthesizing event before completing
+        for chunk in chunks:
+            for callback in signal.callbacks:
+                callback(MockSynthesisEventArgs(chunk))
+        return MockSynthesisResult(MockAudio(b"".join(chunks)))
+
+    return signal, speak_text_async
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from core.admission import AdmissionController, OverloadedError, admitted
+
+
+@pytest.mark.asyncio
+async def test_admission_limits_concurrency():
+    controller = AdmissionController("openai", max_concurrency=2, max_queue=10)
+    running = 0
+    max_running = 0
+
+    async def call():
+        nonlocal running, max_running
+        async with controller.acquire():
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(call() for _ in range(5)))
+    assert max_running == 2
+    stats = controller.stats()
+    assert stats["admitted"] == 5
+    assert stats["rejected"] == 0
+    assert stats["queued"] == 3
+    assert stats["queue_time_max_ms"] >= 10
+    assert stats["in_flight"] == stats["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_sheds_when_queue_full():
+    controller = AdmissionController("search", max_concurrency=1, max_queue=1, retry_after=3)
+    release = asyncio.Event()
+
+    async def call():
+        async with controller.acquire():
+            await release.wait()
+
+    first = asyncio.create_task(call())
+    second = asyncio.create_task(call())
+    await asyncio.sleep(0)
+    assert controller.is_overloaded()
+    with pytest.raises(OverloadedError) as exc_info:
+        async with controller.acquire():
+            pass
+    assert exc_info.value.upstream == "search"
+    assert exc_info.value.retry_after == 3
+    assert controller.rejected == 1
+    release.set()
+    await asyncio.gather(first, second)
+    assert not controller.is_overloaded()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_admission_metrics():
+    controller = AdmissionController("test-metrics", max_concurrency=1, max_queue=1)
+    release = asyncio.Event()
+
+    async def call():
+        async with controller.acquire():
+            await release.wait()
+
+    first = asyncio.create_task(call())
+    second = asyncio.create_task(call())
+    await asyncio.sleep(0)
+    assert sample("app_admission_in_flight", upstream="test-metrics") == 1
+    assert sample("app_admission_waiting", upstream="test-metrics") == 1
+    with pytest.raises(OverloadedError):
+        controller.check()
+    assert sample("app_admission_rejected_total", upstream="test-metrics") == 1
+
+    release.set()
+    await asyncio.gather(first, second)
+    assert sample("app_admission_in_flight", upstream="test-metrics") == 0
+    assert sample("app_admission_waiting", upstream="test-metrics") == 0
+    assert sample("app_admission_queue_time_seconds_count", upstream="test-metrics") == 2
+
+
+@pytest.mark.asyncio
+async def test_admission_releases_on_error():
+    controller = AdmissionController("openai", max_concurrency=1, max_queue=0)
+    with pytest.raises(ZeroDivisionError):
+        async with controller.acquire():
+            1 / 0
+    assert controller.in_flight == 0
+    async with controller.acquire():
+        assert controller.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_admitted_without_controller():
+    async with admitted(None):
+        pass
+
+
+def test_admission_invalid_arguments():
+    with pytest.raises(ValueError):
+        AdmissionController("openai", max_concurrency=0, max_queue=10)
+    with pytest.raises(ValueError):
+        AdmissionController("openai", max_concurrency=1, max_queue=-1)
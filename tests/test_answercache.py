@@ -0,0 +1,60 @@
+import pytest
+
+from core.answercache import CachedAnswer, SemanticAnswerCache
+
+
+def make_answer(question: str) -> CachedAnswer:
+    return CachedAnswer(question=question, content=f"Answer to {question}", role="assistant", context=None)
+
+
+def test_answer_cache_similarity():
+    cache = SemanticAnswerCache(max_entries=10, ttl=60, similarity_threshold=0.9)
+    cache.set("partition", "question", [1.0, 0.0, 0.0], make_answer("question"))
+    # Cosine similarity doesn't depend on the length of the embeddings
+    hit = cache.get("partition", [2.0, 0.1, 0.0])
+    assert hit is not None
+    assert hit.answer.content == "Answer to question"
+    assert hit.similarity == pytest.approx(0.9988, abs=1e-3)
+    assert cache.get("partition", [0.5, 0.5, 0.0]) is None
+    assert cache.stats() == {"entries": 1, "partitions": 1, "hits": 1, "misses": 1}
+
+
+def test_answer_cache_returns_most_similar_answer():
+    cache = SemanticAnswerCache(max_entries=10, ttl=60, similarity_threshold=0.5)
+    cache.set("partition", "first", [1.0, 0.0], make_answer("first"))
+    cache.set("partition", "second", [0.0, 1.0], make_answer("second"))
+    assert cache.get("partition", [0.2, 1.0]).answer.question == "second"
+    assert cache.get("partition", [1.0, 0.2]).answer.question == "first"
+
+
+def test_answer_cache_partitions():
+    cache = SemanticAnswerCache(max_entries=10, ttl=60, similarity_threshold=0.9)
+    cache.set("user-a", "question", [1.0, 0.0], make_answer("question"))
+    assert cache.get("user-b", [1.0, 0.0]) is None
+    assert cache.get("user-a", [1.0, 0.0]) is not None
+
+
+def test_answer_cache_expiry_and_eviction():
+    now = 0.0
+    cache = SemanticAnswerCache(max_entries=2, ttl=10, similarity_threshold=0.9, timer=lambda: now)
+    cache.set("a", "first", [1.0, 0.0], make_answer("first"))
+    cache.set("b", "second", [1.0, 0.0], make_answer("second"))
+    assert cache.get("a", [1.0, 0.0]) is not None
+    # The least recently used answer is evicted, along with its empty partition
+    cache.set("c", "third", [1.0, 0.0], make_answer("third"))
+    assert cache.get("b", [1.0, 0.0]) is None
+    assert cache.stats()["partitions"] == 2
+    now = 10.0
+    assert cache.get("a", [1.0, 0.0]) is None
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_answer_cache_invalid_arguments():
+    with pytest.raises(ValueError):
+        SemanticAnswerCache(max_entries=0, ttl=60, similarity_threshold=0.9)
+    with pytest.raises(ValueError):
+        SemanticAnswerCache(max_entries=10, ttl=0, similarity_threshold=0.9)
+    with pytest.raises(ValueError):
+        SemanticAnswerCache(max_entries=10, ttl=60, similarity_threshold=1.5)
@@ -2,12 +2,17 @@ import json
 import os
 from unittest import mock
 
+import azure.cognitiveservices.speech
 import pytest
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from core.admission import AdmissionController, OverloadedError
+from error import ERROR_MESSAGE_OVERLOADED
+
+from .mocks import mock_speak_text_failed, mock_speak_text_streaming
 
 
 def fake_response(http_code):
@@ -116,6 +121,39 @@ async def test_ask_handle_exception(client, monkeypatch, snapshot, caplog):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_shed_when_overloaded(client, monkeypatch):
+    monkeypatch.setattr(
+        "approaches.retrievethenread.RetrieveThenReadApproach.run",
+        mock.Mock(side_effect=OverloadedError("openai", retry_after=2)),
+    )
+
+    response = await client.post(
+        "/ask",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    result = await response.get_json()
+    assert result == {"error": ERROR_MESSAGE_OVERLOADED}
+
+
+@pytest.mark.asyncio
+async def test_chat_shed_when_queue_full(client):
+    # Requests are shed before they start when calls to an upstream service are already queueing at capacity
+    admission_controller = AdmissionController("search", max_concurrency=1, max_queue=0, retry_after=5)
+    admission_controller.in_flight = 1
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLERS]["search"] = admission_controller
+
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert admission_controller.rejected == 1
+
+
 @pytest.mark.asyncio
 async def test_ask_handle_exception_contentsafety(client, monkeypatch, snapshot, caplog):
     monkeypatch.setattr(
@@ -488,6 +526,69 @@ async def test_speech_request_failed(client, mock_speech_failed):
     assert result["error"] == "Speech synthesis failed. Check logs for details."
 
 
+@pytest.mark.asyncio
+async def test_speech_cached(client, mock_speech_success, monkeypatch):
+    response = await client.post("/speech", json={"text": "test"})
+    assert response.status_code == 200
+
+    # Repeat plays of the same text are served from the cache without synthesizing again
+    monkeypatch.setattr(azure.cognitiveservices.speech.SpeechSynthesizer, "speak_text_async", mock_speak_text_failed)
+    response = await client.post("/speech", json={"text": "test"})
+    assert response.status_code == 200
+    assert await response.get_data() == b"mock_audio_data"
+
+    response = await client.post("/speech", json={"text": "other text"})
+    assert response.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_speech_stream(client, monkeypatch):
+    signal, speak_text_async = mock_speak_text_streaming([b"chunk1", b"chunk2", b"chunk3"])
+    monkeypatch.setattr(azure.cognitiveservices.speech.SpeechSynthesizer, "synthesizing", signal)
+    monkeypatch.setattr(azure.cognitiveservices.speech.SpeechSynthesizer, "speak_text_async", speak_text_async)
+
+    response = await client.post("/speech/stream", json={"text": "test"})
+    assert response.status_code == 200
+    assert response.mimetype == "audio/mp3"
+    assert await response.get_data() == b"chunk1chunk2chunk3"
+
+    # The complete audio is cached once synthesis finishes
+    monkeypatch.setattr(azure.cognitiveservices.speech.SpeechSynthesizer, "speak_text_async", mock_speak_text_failed)
+    response = await client.post("/speech/stream", json={"text": "test"})
+    assert response.status_code == 200
+    assert await response.get_data() == b"chunk1chunk2chunk3"
+    response = await client.post("/speech", json={"text": "test"})
+    assert await response.get_data() == b"chunk1chunk2chunk3"
+
+
+@pytest.mark.asyncio
+async def test_speech_stream_without_chunks(client, mock_speech_success):
+    response = await client.post("/speech/stream", json={"text": "test"})
+    assert response.status_code == 200
+    assert await response.get_data() == b"mock_audio_data"
+
+
+@pytest.mark.asyncio
+async def test_speech_stream_failed(client, mock_speech_cancelled):
+    response = await client.post("/speech/stream", json={"text": "test"})
+    assert response.status_code == 500
+    result = await response.get_json()
+    assert result["error"] == "Speech synthesis canceled. Check logs for details."
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["/speech", "/speech/stream"])
+async def test_speech_synthesizer_error(client, monkeypatch, route):
+    async def mock_create_speech_synthesizer():
+        raise Exception("Unable to get a token for the Speech service")
+
+    monkeypatch.setattr(app, "create_speech_synthesizer", mock_create_speech_synthesizer)
+    response = await client.post(route, json={"text": "test"})
+    assert response.status_code == 500
+    result = await response.get_json()
+    assert result["error"] == "Unable to get a token for the Speech service"
+
+
 @pytest.mark.asyncio
 async def test_chat_text(client, snapshot):
     response = await client.post(
@@ -507,6 +608,88 @@ async def test_chat_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_chat_server_timing(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "hybrid"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    stages = [metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")]
+    assert set(stages) == {"prompt_render", "rewrite", "embedding", "search", "generation", "total"}
+    result = await response.get_json()
+    # The timings are only added to the thought process when requested
+    assert "timings" not in result["context"]["thoughts"][-1]["props"]
+
+
+@pytest.mark.asyncio
+async def test_chat_show_stage_timings(client):
+    client.app.config[app.CONFIG_SHOW_STAGE_TIMINGS] = True
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    timings = result["context"]["thoughts"][-1]["props"]["timings"]
+    assert set(timings) == {"rewrite_ms", "search_ms", "prompt_render_ms", "generation_ms"}
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_server_timing(client):
+    client.app.config[app.CONFIG_SHOW_STAGE_TIMINGS] = True
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    # The headers are sent before the answer is generated
+    assert "search;dur=" in response.headers["Server-Timing"]
+    assert "generation" not in response.headers["Server-Timing"]
+    lines = (await response.get_data()).decode().splitlines()
+    timings = json.loads(lines[-1])["context"]["thoughts"][-1]["props"]["timings"]
+    assert "ttft_ms" in timings
+    assert "generation_ms" in timings
+
+
+@pytest.mark.asyncio
+async def test_metrics(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    metrics = (await response.get_data()).decode()
+    assert 'app_request_duration_seconds_count{method="POST",route="/chat",status="200"}' in metrics
+    assert 'app_upstream_duration_seconds_count{outcome="success",upstream="openai"}' in metrics
+    assert 'app_upstream_duration_seconds_count{outcome="success",upstream="search"}' in metrics
+    assert 'app_openai_tokens_total{model="gpt-4o-mini",type="prompt"}' in metrics
+
+
 @pytest.mark.asyncio
 async def test_chat_text_agent(agent_client, snapshot):
     response = await agent_client.post(
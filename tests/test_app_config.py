@@ -307,3 +307,148 @@ async def test_app_config_for_reasoning_override_effort(monkeypatch, minimal_env
         assert result["streamingEnabled"] is True
         assert result["showReasoningEffortOption"] is True
         assert result["defaultReasoningEffort"] == "low"
+
+
+@pytest.mark.asyncio
+async def test_app_embedding_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("EMBEDDING_CACHE_MAX_ENTRIES", "50")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        embedding_cache = quart_app.config[app.CONFIG_EMBEDDING_CACHE]
+        assert embedding_cache.max_entries == 50
+        assert embedding_cache.ttl == 3600
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].embedding_cache is embedding_cache
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].embedding_cache is embedding_cache
+
+
+@pytest.mark.asyncio
+async def test_app_embedding_cache_disabled(monkeypatch, minimal_env):
+    monkeypatch.setenv("EMBEDDING_CACHE_MAX_ENTRIES", "0")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_EMBEDDING_CACHE] is None
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].embedding_cache is None
+
+
+@pytest.mark.asyncio
+async def test_app_retrieval_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("RETRIEVAL_CACHE_MAX_BYTES", "1000000")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        retrieval_cache = quart_app.config[app.CONFIG_RETRIEVAL_CACHE]
+        assert retrieval_cache.max_bytes == 1000000
+        assert retrieval_cache.ttl == 60
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].retrieval_cache is retrieval_cache
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].retrieval_cache is retrieval_cache
+
+
+@pytest.mark.asyncio
+async def test_app_retrieval_cache_disabled_by_default(minimal_env):
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_RETRIEVAL_CACHE] is None
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].retrieval_cache is None
+
+
+@pytest.mark.asyncio
+async def test_app_answer_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("ANSWER_CACHE_MAX_ENTRIES", "100")
+    monkeypatch.setenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.9")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        answer_cache = quart_app.config[app.CONFIG_ANSWER_CACHE]
+        assert answer_cache.max_entries == 100
+        assert answer_cache.ttl == 3600
+        assert answer_cache.similarity_threshold == 0.9
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].answer_cache is answer_cache
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].answer_cache is answer_cache
+
+
+@pytest.mark.asyncio
+async def test_app_answer_cache_vision(monkeypatch, minimal_env):
+    monkeypatch.setenv("ANSWER_CACHE_MAX_ENTRIES", "100")
+    monkeypatch.setenv("USE_GPT4V", "true")
+    monkeypatch.setenv("AZURE_OPENAI_GPT4V_MODEL", "gpt-4")
+    monkeypatch.setenv("AZURE_VISION_ENDPOINT", "https://testvision.cognitiveservices.azure.com/")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        answer_cache = quart_app.config[app.CONFIG_ANSWER_CACHE]
+        assert quart_app.config[app.CONFIG_ASK_VISION_APPROACH].answer_cache is answer_cache
+        assert quart_app.config[app.CONFIG_CHAT_VISION_APPROACH].answer_cache is answer_cache
+
+
+@pytest.mark.asyncio
+async def test_app_answer_cache_requires_vectors(monkeypatch, minimal_env):
+    monkeypatch.setenv("ANSWER_CACHE_MAX_ENTRIES", "100")
+    monkeypatch.setenv("USE_VECTORS", "false")
+    quart_app = app.create_app()
+    with pytest.raises(quart.testing.app.LifespanError, match="ANSWER_CACHE_MAX_ENTRIES requires an embedding model"):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_app_admission_controllers(monkeypatch, minimal_env):
+    monkeypatch.setenv("OPENAI_MAX_CONCURRENCY", "8")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        admission_controllers = quart_app.config[app.CONFIG_ADMISSION_CONTROLLERS]
+        assert list(admission_controllers.keys()) == ["openai"]
+        assert admission_controllers["openai"].max_concurrency == 8
+        assert admission_controllers["openai"].max_queue == 100
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].admission_controllers is admission_controllers
+
+
+@pytest.mark.asyncio
+async def test_app_token_schedulers(monkeypatch, minimal_env):
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "chat")
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_TOKENS_PER_MINUTE", "30000")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        token_schedulers = quart_app.config[app.CONFIG_TOKEN_SCHEDULERS]
+        assert list(token_schedulers.keys()) == ["chat"]
+        assert token_schedulers["chat"].tokens_per_minute == 30000
+        assert token_schedulers["chat"].requests_per_minute == 180
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].token_schedulers is token_schedulers
+
+
+@pytest.mark.asyncio
+async def test_app_openai_router(monkeypatch, minimal_env):
+    monkeypatch.setenv(
+        "AZURE_OPENAI_ENDPOINTS", "https://test-openai-1.openai.azure.com, https://test-openai-2.openai.azure.com"
+    )
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        openai_router = quart_app.config[app.CONFIG_OPENAI_ROUTER]
+        assert [endpoint.name for endpoint in openai_router.endpoints] == [
+            "https://test-openai-1.openai.azure.com",
+            "https://test-openai-2.openai.azure.com",
+        ]
+        assert quart_app.config[app.CONFIG_OPENAI_CLIENT] is openai_router.endpoints[0].client
+        assert openai_router.endpoints[1].client.max_retries == 0
+        assert openai_router.endpoints[1].last_resort_client.max_retries == 2
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].openai_router is openai_router
+
+
+@pytest.mark.asyncio
+async def test_app_openai_router_api_key(monkeypatch, minimal_env):
+    monkeypatch.setenv(
+        "AZURE_OPENAI_ENDPOINTS", "https://test-openai-1.openai.azure.com,https://test-openai-2.openai.azure.com"
+    )
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY_OVERRIDE", "test-key")
+    quart_app = app.create_app()
+    with pytest.raises(quart.testing.app.LifespanError, match="AZURE_OPENAI_API_KEY_OVERRIDE"):
+        async with quart_app.test_app():
+            pass
+
+
+@pytest.mark.asyncio
+async def test_app_search_hedging(monkeypatch, minimal_env):
+    monkeypatch.setenv("USE_SEARCH_HEDGING", "true")
+    monkeypatch.setenv("SEARCH_HEDGING_MAX_EXTRA_RATIO", "0.1")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        hedging_policy = quart_app.config[app.CONFIG_SEARCH_HEDGING]
+        assert hedging_policy.percentile == 95
+        assert hedging_policy.max_extra_ratio == 0.1
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].hedging_policy is hedging_policy
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from core.audiocache import AudioCache
+from core.executor import BlockingExecutor
+
+
+def test_make_key():
+    key = AudioCache.make_key("en-US-AndrewMultilingualNeural", "Audio16Khz32KBitRateMonoMp3", "Hello")
+    assert key == AudioCache.make_key("en-US-AndrewMultilingualNeural", "Audio16Khz32KBitRateMonoMp3", "Hello")
+    assert key != AudioCache.make_key("en-US-AvaMultilingualNeural", "Audio16Khz32KBitRateMonoMp3", "Hello")
+    assert key != AudioCache.make_key("en-US-AndrewMultilingualNeural", "Riff16Khz16BitMonoPcm", "Hello")
+    assert key != AudioCache.make_key("en-US-AndrewMultilingualNeural", "Audio16Khz32KBitRateMonoMp3", "Hello!")
+
+
+@pytest.mark.asyncio
+async def test_memory_only():
+    cache = AudioCache(max_memory_bytes=10)
+    await cache.set("a", b"aaaa")
+    await cache.set("b", b"bbbb")
+    assert await cache.get("a") == b"aaaa"
+    # Least recently used audio is evicted, and discarded without a disk tier
+    await cache.set("c", b"cccc")
+    assert await cache.get("b") is None
+    assert await cache.get("a") == b"aaaa"
+    assert await cache.get("c") == b"cccc"
+    assert cache.stats() == {
+        "memory_entries": 2,
+        "memory_bytes": 8,
+        "disk_entries": 0,
+        "disk_bytes": 0,
+        "memory_hits": 3,
+        "disk_hits": 0,
+        "misses": 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_spill_to_disk(tmp_path):
+    cache = AudioCache(max_memory_bytes=10, max_disk_bytes=10, directory=str(tmp_path))
+    await cache.set("a", b"aaaa")
+    await cache.set("b", b"bbbb")
+    await cache.set("c", b"cccc")
+    assert "a" not in cache.memory
+    assert os.listdir(tmp_path) == ["a.audio"]
+
+    # Audio read back from disk is promoted to memory, spilling the least recently used audio in turn
+    assert await cache.get("a") == b"aaaa"
+    assert "a" in cache.memory
+    assert "b" not in cache.memory
+    assert await cache.get("b") == b"bbbb"
+    assert cache.stats()["disk_hits"] == 2
+
+    # The disk tier evicts the least recently used files
+    await cache.set("d", b"dddd")
+    await cache.set("e", b"eeee")
+    assert cache.disk_bytes <= 10
+    assert sorted(os.listdir(tmp_path)) == sorted(key + AudioCache.FILE_SUFFIX for key in cache.disk)
+
+
+@pytest.mark.asyncio
+async def test_large_audio_skips_memory(tmp_path):
+    cache = AudioCache(max_memory_bytes=4, max_disk_bytes=100, directory=str(tmp_path))
+    await cache.set("large", b"0123456789")
+    assert cache.memory_bytes == 0
+    assert cache.disk["large"] == 10
+
+
+@pytest.mark.asyncio
+async def test_reuse_disk_directory(tmp_path):
+    cache = AudioCache(max_memory_bytes=4, max_disk_bytes=100, directory=str(tmp_path))
+    await cache.set("a", b"aaaa")
+    await cache.set("b", b"bbbb")
+
+    # Spilled files survive a restart, since the audio is content-addressed
+    restarted = AudioCache(max_memory_bytes=4, max_disk_bytes=100, directory=str(tmp_path))
+    assert await restarted.get("a") == b"aaaa"
+    assert await restarted.get("b") is None
+
+
+@pytest.mark.asyncio
+async def test_missing_disk_file(tmp_path):
+    cache = AudioCache(max_memory_bytes=4, max_disk_bytes=100, directory=str(tmp_path))
+    await cache.set("a", b"aaaa")
+    await cache.set("b", b"bbbb")
+    os.remove(tmp_path / "a.audio")
+    assert await cache.get("a") is None
+    assert cache.disk_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_disk_io_on_blocking_executor(tmp_path):
+    executor = BlockingExecutor(max_workers=1)
+    cache = AudioCache(max_memory_bytes=4, max_disk_bytes=8, directory=str(tmp_path), blocking_executor=executor)
+    await cache.set("a", b"aaaa")
+    await cache.set("b", b"bbbb")
+    assert await cache.get("a") == b"aaaa"
+    await cache.set("c", b"cccc")
+    await cache.set("d", b"dddd")
+    # Spilling, reading and evicting the files all ran on the executor
+    assert executor.stats()["completed"] >= 4
+    assert sorted(os.listdir(tmp_path)) == sorted(key + AudioCache.FILE_SUFFIX for key in cache.disk)
+    executor.shutdown()
+
+
+def test_invalid_max_memory_bytes():
+    with pytest.raises(ValueError):
+        AudioCache(max_memory_bytes=0)
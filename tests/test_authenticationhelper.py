@@ -1,6 +1,8 @@
+import asyncio
 import base64
 import json
 import re
+import time
 from datetime import datetime, timedelta, timezone
 
 import aiohttp
@@ -13,6 +15,7 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 from core.authentication import AuthenticationHelper, AuthError
+from core.httpsessions import HTTPSessionRegistry
 
 from .mocks import MockAsyncPageIterator, MockResponse
 
@@ -111,12 +114,77 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(
+    mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_success
+):
+    helper = create_authentication_helper()
+    token, _, _ = create_mock_jwt()
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    auth_claims["groups"].append("MUTATED")
+
+    # The mocked Graph API only answers once, so the groups must come from the cache
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    assert helper.auth_claims_cache_metrics == {"obo_hits": 1, "obo_misses": 1, "graph_hits": 1, "graph_misses": 1}
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cache_requires_expiration(mock_confidential_client_success, mock_validate_token_success):
+    helper = create_authentication_helper()
+    # Tokens without an expiration are never cached
+    for _ in range(2):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert helper.auth_claims_cache_metrics["obo_misses"] == 2
+    assert helper.auth_claims_cache_metrics["obo_hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cache_disabled(mock_confidential_client_success, mock_validate_token_success):
+    helper = AuthenticationHelper(
+        search_index=MockSearchIndex,
+        use_authentication=True,
+        server_app_id="SERVER_APP",
+        server_app_secret="SERVER_SECRET",
+        client_app_id="CLIENT_APP",
+        tenant_id="TENANT_ID",
+        auth_claims_cache_max_entries=0,
+    )
+    token, _, _ = create_mock_jwt()
+    for _ in range(2):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert helper.auth_claims_cache is None
+    assert helper.auth_claims_cache_metrics["obo_misses"] == 2
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
     assert groups == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_list_groups_shared_session(monkeypatch, mock_validate_token_success):
+    requests = []
+
+    def mock_get(session, *args, **kwargs):
+        requests.append((session, kwargs))
+        return MockResponse(text=json.dumps({"value": [{"id": "GROUP_Y"}]}), status=200)
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    http_sessions = HTTPSessionRegistry()
+    for _ in range(2):
+        groups = await AuthenticationHelper.list_groups({"access_token": "MockToken"}, http_sessions)
+        assert groups == ["GROUP_Y"]
+    assert requests[0][0] is requests[1][0]
+    assert requests[0][1]["headers"] == {"Authorization": "Bearer MockToken"}
+    assert http_sessions.stats() == {"sessions": 1, "created": 1, "reused": 1}
+    await http_sessions.close()
+
+
 @pytest.mark.asyncio
 async def test_list_groups_unauthorized(mock_list_groups_unauthorized, mock_validate_token_success):
     with pytest.raises(AuthError) as exc_info:
@@ -518,6 +586,80 @@ async def test_check_path_auth_allowed_public_without_access_control(
     assert called_search is False
 
 
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper = create_authentication_helper(require_access_control=True)
+    timer = FakeTimer()
+    auth_helper.path_auth_cache.timer = timer
+    searched_filters = []
+    allowed_paths = {"Benefit_Options.pdf"}
+
+    async def mock_search(self, *args, **kwargs):
+        searched_filters.append(kwargs.get("filter"))
+        allowed = any(f"sourcefile eq '{path}'" in kwargs.get("filter") for path in allowed_paths)
+        return MockAsyncPageIterator(data=[{"sourcefile": "Benefit_Options.pdf"}] if allowed else [])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def check(path, oid="OID_X"):
+        return await auth_helper.check_path_auth(
+            path=path, auth_claims={"oid": oid, "groups": ["GROUP_Y"]}, search_client=create_search_client()
+        )
+
+    # Citations and range requests for the same document reuse the decision
+    assert await check("Benefit_Options.pdf") is True
+    assert await check("Benefit_Options.pdf#page=2") is True
+    assert await check("Role_Library.pdf") is False
+    assert await check("Role_Library.pdf") is False
+    assert len(searched_filters) == 2
+
+    # Decisions are cached separately for each security filter
+    assert await check("Benefit_Options.pdf", oid="OID_W") is True
+    assert len(searched_filters) == 3
+
+    # Denials expire sooner than grants
+    allowed_paths.add("Role_Library.pdf")
+    timer.now += auth_helper.path_auth_cache_negative_ttl
+    assert await check("Role_Library.pdf") is True
+    assert await check("Benefit_Options.pdf") is True
+    assert len(searched_filters) == 4
+
+    allowed_paths.clear()
+    auth_helper.invalidate_path_auth_cache()
+    assert await check("Benefit_Options.pdf") is False
+    assert len(searched_filters) == 5
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_cache_disabled(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_success
+):
+    auth_helper = AuthenticationHelper(
+        search_index=MockSearchIndex,
+        use_authentication=True,
+        server_app_id="SERVER_APP",
+        server_app_secret="SERVER_SECRET",
+        client_app_id="CLIENT_APP",
+        tenant_id="TENANT_ID",
+        require_access_control=True,
+        path_auth_cache_max_entries=0,
+    )
+    search_count = 0
+
+    async def mock_search(self, *args, **kwargs):
+        nonlocal search_count
+        search_count += 1
+        return MockAsyncPageIterator(data=[{"sourcefile": "Benefit_Options.pdf"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    for _ in range(2):
+        assert await auth_helper.check_path_auth(
+            path="Benefit_Options.pdf", auth_claims={"oid": "OID_X"}, search_client=create_search_client()
+        )
+    assert search_count == 2
+
+
 @pytest.mark.asyncio
 async def test_create_pem_format(mock_confidential_client_success, mock_validate_token_success):
     helper = create_authentication_helper()
@@ -600,52 +742,169 @@ async def test_create_pem_format(mock_confidential_client_success, mock_validate
         pytest.fail(f"Failed to load PEM key: {str(e)}")
 
 
+def create_mock_jwk(public_key, kid="mock_kid"):
+    numbers = public_key.public_numbers()
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "kid": kid,
+        "n": base64.urlsafe_b64encode(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, byteorder="big"))
+        .decode("utf-8")
+        .rstrip("="),
+        "e": base64.urlsafe_b64encode(numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, byteorder="big"))
+        .decode("utf-8")
+        .rstrip("="),
+    }
+
+
+class MockKeysEndpoint:
+    def __init__(self, *jwks):
+        self.jwks = list(jwks)
+        self.calls = 0
+        self.fail = False
+
+    def get(self, *args, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise aiohttp.ClientConnectionError("Keys endpoint unavailable")
+        return MockResponse(status=200, text=json.dumps({"keys": self.jwks}))
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
 @pytest.mark.asyncio
 async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
     mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
+    endpoint = MockKeysEndpoint(
+        # Keys that cannot be parsed are skipped
+        {"kty": "RSA", "use": "sig", "kid": "23nt", "n": "hu2SJ", "e": "AQAB"},
+        {"kty": "EC", "use": "sig", "kid": "MGLq"},
+        create_mock_jwk(public_key),
+    )
+    monkeypatch.setattr(aiohttp.ClientSession, "get", lambda session, *args, **kwargs: endpoint.get())
 
-    def mock_get(*args, **kwargs):
-        return MockResponse(
-            status=200,
-            text=json.dumps(
-                {
-                    "keys": [
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "23nt",
-                            "x5t": "23nt",
-                            "n": "hu2SJ",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "MGLq",
-                            "x5t": "MGLq",
-                            "n": "yfNcG8",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                    ]
-                }
-            ),
-        )
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+    await helper.validate_access_token(mock_token)
+
+    # The signing keys are downloaded once and reused for later tokens
+    assert endpoint.calls == 1
+    assert set(helper.jwks_cache.keys.keys()) == {"mock_kid"}
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_invalid_signature(monkeypatch, mock_confidential_client_success):
+    mock_token, _, _ = create_mock_jwt(oid="OID_X")
+    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
+    endpoint = MockKeysEndpoint(create_mock_jwk(other_public_key))
+    monkeypatch.setattr(aiohttp.ClientSession, "get", lambda session, *args, **kwargs: endpoint.get())
+
+    helper = create_authentication_helper()
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(mock_token)
+    assert exc_info.value.error == "Unable to parse authorization token."
 
-    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
-    def mock_decode(*args, **kwargs):
-        return payload
+@pytest.mark.asyncio
+async def test_jwks_cache_refreshes_unknown_kid(monkeypatch, mock_confidential_client_success):
+    old_token, old_public_key, _ = create_mock_jwt(kid="old_kid")
+    new_token, new_public_key, _ = create_mock_jwt(kid="new_kid")
+    endpoint = MockKeysEndpoint(create_mock_jwk(old_public_key, kid="old_kid"))
+    monkeypatch.setattr(aiohttp.ClientSession, "get", lambda session, *args, **kwargs: endpoint.get())
+
+    helper = create_authentication_helper()
+    timer = FakeTimer()
+    helper.jwks_cache.timer = timer
+    await helper.validate_access_token(old_token)
 
-    monkeypatch.setattr(jwt, "decode", mock_decode)
+    # Entra rotated its keys, but a refresh was attempted too recently to try again
+    endpoint.jwks.append(create_mock_jwk(new_public_key, kid="new_kid"))
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(new_token)
+    assert exc_info.value.error == "Unable to find appropriate key"
+    assert endpoint.calls == 1
 
-    async def mock_create_pem_format(*args, **kwargs):
-        return public_key
+    timer.now += helper.jwks_cache.min_refresh_interval
+    await helper.validate_access_token(new_token)
+    assert endpoint.calls == 2
 
-    monkeypatch.setattr(AuthenticationHelper, "create_pem_format", mock_create_pem_format)
+
+@pytest.mark.asyncio
+async def test_jwks_cache_unknown_kid_does_not_wait_for_retries(monkeypatch, mock_confidential_client_success):
+    old_token, old_public_key, _ = create_mock_jwt(kid="old_kid")
+    unknown_token, _, _ = create_mock_jwt(kid="unknown_kid")
+    endpoint = MockKeysEndpoint(create_mock_jwk(old_public_key, kid="old_kid"))
+    monkeypatch.setattr(aiohttp.ClientSession, "get", lambda session, *args, **kwargs: endpoint.get())
 
     helper = create_authentication_helper()
+    timer = FakeTimer()
+    helper.jwks_cache.timer = timer
+    helper.jwks_cache.refresh_timeout = 0.01
+    await helper.validate_access_token(old_token)
+
+    fetches = []
+
+    async def mock_fetch_keys(retry=True):
+        fetches.append(retry)
+        await asyncio.sleep(10)
+        return {}
+
+    monkeypatch.setattr(helper.jwks_cache, "fetch_keys", mock_fetch_keys)
+    timer.now += helper.jwks_cache.min_refresh_interval
+    started = time.monotonic()
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(unknown_token)
+    assert exc_info.value.error == "Unable to find appropriate key"
+    assert time.monotonic() - started < 1
+    # The refresh for an unknown key ID isn't retried, and known keys keep working while it runs
+    assert fetches == [False]
+    await helper.validate_access_token(old_token)
+    helper.jwks_cache.refresh_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_stale_while_revalidate(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt()
+    endpoint = MockKeysEndpoint(create_mock_jwk(public_key))
+    monkeypatch.setattr(aiohttp.ClientSession, "get", lambda session, *args, **kwargs: endpoint.get())
+
+    helper = create_authentication_helper()
+    timer = FakeTimer()
+    helper.jwks_cache.timer = timer
+    await helper.validate_access_token(mock_token)
+
+    # Expired keys are still used while they are refreshed in the background, even if that fails
+    endpoint.fail = True
+    timer.now += helper.jwks_cache.refresh_interval
+    await helper.validate_access_token(mock_token)
+    assert helper.jwks_cache.refresh_task is not None
+    await helper.jwks_cache.refresh_task
+    assert endpoint.calls == 2
+    assert "mock_kid" in helper.jwks_cache.keys
     await helper.validate_access_token(mock_token)
+
+    endpoint.fail = False
+    timer.now += helper.jwks_cache.min_refresh_interval
+    await helper.validate_access_token(mock_token)
+    await helper.jwks_cache.refresh_task
+    assert endpoint.calls == 3
+    assert helper.jwks_cache.fetched_at == timer.now
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_unavailable(monkeypatch, mock_confidential_client_success):
+    mock_token, _, _ = create_mock_jwt()
+    monkeypatch.setattr(
+        aiohttp.ClientSession, "get", lambda session, *args, **kwargs: MockResponse(status=200, text="{}")
+    )
+
+    helper = create_authentication_helper()
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(mock_token)
+    assert exc_info.value.error == "Unable to get keys to validate auth token."
@@ -0,0 +1,81 @@
+import pytest
+
+from core.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hit_and_miss():
+    cache: TTLCache[str] = TTLCache(max_entries=2, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", "value-a")
+    assert cache.get("a") == "value-a"
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+
+def test_cache_evicts_least_recently_used():
+    cache: TTLCache[str] = TTLCache(max_entries=2, ttl=60)
+    cache.set("a", "value-a")
+    cache.set("b", "value-b")
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == "value-a"
+    cache.set("c", "value-c")
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_cache_expires_entries():
+    timer = FakeTimer()
+    cache: TTLCache[str] = TTLCache(max_entries=2, ttl=10, timer=timer)
+    cache.set("a", "value-a")
+    cache.set("b", "value-b", ttl=30)
+    timer.now = 10
+    assert cache.get("a") is None
+    assert cache.get("b") == "value-b"
+    assert len(cache) == 1
+    timer.now = 30
+    assert cache.get("b") is None
+    assert cache.misses == 2
+
+
+def test_cache_invalid_arguments():
+    with pytest.raises(ValueError):
+        TTLCache(max_entries=0, ttl=60)
+    with pytest.raises(ValueError):
+        TTLCache(max_entries=10, ttl=0)
+
+
+def test_cache_evicts_to_fit_max_bytes():
+    cache: TTLCache[str] = TTLCache(max_entries=10, ttl=60, max_bytes=10, size_of=len)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    cache.set("c", "cccc")
+    assert "a" not in cache
+    assert cache.stats() == {"entries": 2, "hits": 0, "misses": 0, "bytes": 8}
+    # Replacing an entry accounts for the size of the previous value
+    cache.set("b", "bb")
+    assert cache.total_bytes == 6
+    # Values larger than the whole cache are not stored
+    cache.set("d", "d" * 11)
+    assert "d" not in cache
+    assert len(cache) == 2
+    cache.delete("b")
+    cache.delete("missing")
+    assert cache.total_bytes == 4
+    cache.clear()
+    assert cache.total_bytes == 0
+
+
+def test_cache_max_bytes_requires_size_of():
+    with pytest.raises(ValueError):
+        TTLCache(max_entries=10, ttl=60, max_bytes=10)
+    with pytest.raises(ValueError):
+        TTLCache(max_entries=10, ttl=60, max_bytes=0, size_of=len)
@@ -1,13 +1,31 @@
+import asyncio
 import json
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizedQuery
 from openai.types.chat import ChatCompletion
-
+from openai.types.chat.chat_completion import ChatCompletionMessage, Choice
+
+from approaches.approach import (
+    DataPoints,
+    Document,
+    ExtraInfo,
+    ThoughtStep,
+    estimate_documents_size,
+)
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.promptmanager import PromptyManager
+from core.admission import UPSTREAM_OPENAI, AdmissionController
+from core.answercache import SemanticAnswerCache
+from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.hedging import HedgingPolicy
+from core.singleflight import SingleFlight
+from core.timings import STAGE_HISTORY_SUMMARY, start_stage_timings
+from core.tokenbudget import PRIORITY_BATCH, TokenBudgetScheduler
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -266,6 +284,67 @@ async def test_search_results_query_rewriting(monkeypatch):
     assert query_rewrites == "generative"
 
 
+@pytest.mark.asyncio
+async def test_search_results_cached(monkeypatch):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-4o-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        retrieval_cache=TTLCache(max_entries=10, ttl=60, max_bytes=100000, size_of=estimate_documents_size),
+    )
+
+    filters = []
+
+    async def counting_mock_search(*args, **kwargs):
+        filters.append(kwargs.get("filter"))
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", counting_mock_search)
+
+    async def search(filter, bypass_cache=False):
+        return await chat_approach.search(
+            top=3,
+            query_text="test query",
+            filter=filter,
+            vectors=[],
+            use_text_search=True,
+            use_vector_search=False,
+            use_semantic_ranker=False,
+            use_semantic_captions=False,
+            bypass_cache=bypass_cache,
+        )
+
+    first = await search("oids/any(g:search.in(g, 'OID_X'))")
+    second = await search("oids/any(g:search.in(g, 'OID_X'))")
+    # Results are never shared between different security filters
+    await search("oids/any(g:search.in(g, 'OID_Y'))")
+    await search("oids/any(g:search.in(g, 'OID_X'))", bypass_cache=True)
+
+    assert first == second
+    assert first is not second
+    assert filters == [
+        "oids/any(g:search.in(g, 'OID_X'))",
+        "oids/any(g:search.in(g, 'OID_Y'))",
+        "oids/any(g:search.in(g, 'OID_X'))",
+    ]
+    assert chat_approach.retrieval_cache.hits == 1
+
+
 @pytest.mark.asyncio
 async def test_agent_retrieval_results(monkeypatch):
     chat_approach = ChatReadRetrieveReadApproach(
@@ -300,3 +379,571 @@ async def test_agent_retrieval_results(monkeypatch):
     assert results[0].content == "There is a whistleblower policy."
     assert results[0].sourcepage == "Benefit_Options-2.pdf"
     assert results[0].search_agent_query == "whistleblower query"
+
+
+@pytest.mark.parametrize(
+    "user_query,search_query,expected_match",
+    [
+        ("What is in my health plan?", "What is in my health plan?", "exact"),
+        ("What is in my health plan?", "what is in my health plan", "normalized"),
+        ("What does my Northwind health plan cover?", "what does my northwind health plan cover for", "similar"),
+        ("What about dental?", "Northwind Health Plus dental coverage", "none"),
+        ("???", "dental coverage", "none"),
+    ],
+)
+def test_compare_search_queries(chat_approach, user_query, search_query, expected_match):
+    match, similarity = chat_approach.compare_search_queries(user_query, search_query)
+    assert match == expected_match
+    assert 0 <= similarity <= 1
+
+
+def chat_completion_for_query(query_text: str) -> ChatCompletion:
+    return ChatCompletion(
+        object="chat.completion",
+        choices=[
+            Choice(message=ChatCompletionMessage(role="assistant", content=query_text), finish_reason="stop", index=0)
+        ],
+        id="test-123",
+        created=0,
+        model="test-model",
+    )
+
+
+@pytest.fixture
+def speculative_chat_approach(chat_approach, monkeypatch):
+    chat_approach.use_speculative_search = True
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    searched_queries = []
+
+    async def mock_approach_search(top, query_text, *args, **kwargs):
+        searched_queries.append(query_text)
+        await asyncio.sleep(0)
+        return [Document(id=query_text, content=query_text, sourcepage="Benefit_Options-2.pdf")]
+
+    monkeypatch.setattr(chat_approach, "search", mock_approach_search)
+    chat_approach.searched_queries = searched_queries
+    return chat_approach
+
+
+@pytest.mark.asyncio
+async def test_speculative_search_used(speculative_chat_approach, monkeypatch):
+    async def mock_create_chat_completion(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return chat_completion_for_query("what is included in my health plan")
+
+    monkeypatch.setattr(speculative_chat_approach, "create_chat_completion", mock_create_chat_completion)
+
+    extra_info = await speculative_chat_approach.run_search_approach(
+        [{"role": "user", "content": "What is included in my health plan?"}], {"retrieval_mode": "text"}, {}
+    )
+
+    assert speculative_chat_approach.searched_queries == ["What is included in my health plan?"]
+    search_step = extra_info.thoughts[1]
+    assert search_step.description == "What is included in my health plan?"
+    speculative_props = search_step.props["speculative_search"]
+    assert speculative_props["used"] is True
+    assert speculative_props["match"] == "normalized"
+    assert speculative_props["hit_rate"] == 1
+    assert "latency_ms" in speculative_props
+
+
+@pytest.mark.asyncio
+async def test_speculative_search_discarded(speculative_chat_approach, monkeypatch):
+    async def mock_create_chat_completion(*args, **kwargs):
+        return chat_completion_for_query("Northwind Health Plus dental coverage")
+
+    monkeypatch.setattr(speculative_chat_approach, "create_chat_completion", mock_create_chat_completion)
+
+    extra_info = await speculative_chat_approach.run_search_approach(
+        [{"role": "user", "content": "What about dental?"}], {"retrieval_mode": "text"}, {}
+    )
+
+    assert speculative_chat_approach.searched_queries[-1] == "Northwind Health Plus dental coverage"
+    search_step = extra_info.thoughts[1]
+    assert search_step.description == "Northwind Health Plus dental coverage"
+    assert search_step.props["speculative_search"]["used"] is False
+    assert search_step.props["speculative_search"]["match"] == "none"
+    assert search_step.props["speculative_search"]["hit_rate"] == 0
+    assert extra_info.data_points.text == ["Benefit_Options-2.pdf: Northwind Health Plus dental coverage"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_search_skipped_for_followup(speculative_chat_approach, monkeypatch):
+    async def mock_create_chat_completion(*args, **kwargs):
+        return chat_completion_for_query("dental coverage")
+
+    monkeypatch.setattr(speculative_chat_approach, "create_chat_completion", mock_create_chat_completion)
+
+    extra_info = await speculative_chat_approach.run_search_approach(
+        [
+            {"role": "user", "content": "What is included in my health plan?"},
+            {"role": "assistant", "content": "Medical and vision coverage."},
+            {"role": "user", "content": "dental coverage"},
+        ],
+        {"retrieval_mode": "text"},
+        {},
+    )
+
+    assert speculative_chat_approach.searched_queries == ["dental coverage"]
+    assert "speculative_search" not in extra_info.thoughts[1].props
+    assert speculative_chat_approach.speculative_search_attempts == 0
+
+
+@pytest.fixture
+def answer_cache_chat_approach(chat_approach, monkeypatch):
+    chat_approach.answer_cache = SemanticAnswerCache(max_entries=10, ttl=60, similarity_threshold=0.9)
+    chat_approach.final_calls = 0
+
+    async def mock_compute_text_embedding(q, priority=None):
+        # Questions about dental coverage get similar embeddings
+        vector = [1.0, 0.1 * len(q) / 100] if "dental" in q else [0.0, 1.0]
+        return VectorizedQuery(vector=vector, k_nearest_neighbors=50, fields="embedding3")
+
+    async def mock_run_until_final_call(messages, overrides, auth_claims, should_stream):
+        chat_approach.final_calls += 1
+        extra_info = ExtraInfo(DataPoints(text=["Benefit_Options-2.pdf: dental"]), thoughts=[ThoughtStep("Search", "")])
+        return extra_info, chat_completion_coroutine("Dental is covered. <<Is vision covered?>>")
+
+    async def chat_completion_coroutine(content):
+        return chat_completion_for_query(content)
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+    monkeypatch.setattr(
+        chat_approach,
+        "build_filter",
+        lambda overrides, auth_claims: f"oids/any(g:search.in(g, '{auth_claims['oid']}'))",
+    )
+    return chat_approach
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_hit(answer_cache_chat_approach):
+    overrides = {"suggest_followup_questions": True}
+    first = await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is dental covered?"}], overrides, {"oid": "OID_X"}
+    )
+    second = await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Does my plan cover dental?"}], overrides, {"oid": "OID_X"}
+    )
+
+    assert answer_cache_chat_approach.final_calls == 1
+    assert second["message"] == first["message"] == {"content": "Dental is covered. ", "role": "assistant"}
+    assert second["context"].followup_questions == ["Is vision covered?"]
+    assert second["context"].thoughts[0].title == "Answer reused from semantic cache"
+    assert second["context"].thoughts[0].description == "Is dental covered?"
+    assert second["context"].thoughts[1:] == first["context"].thoughts
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_partitioned_by_security_filter(answer_cache_chat_approach):
+    await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is dental covered?"}], {}, {"oid": "OID_X"}
+    )
+    await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is dental covered?"}], {}, {"oid": "OID_Y"}
+    )
+    await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is dental covered?"}], {"bypass_answer_cache": True}, {"oid": "OID_X"}
+    )
+    await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is vision covered?"}], {}, {"oid": "OID_X"}
+    )
+
+    assert answer_cache_chat_approach.final_calls == 4
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_skipped_for_followup(answer_cache_chat_approach):
+    messages = [
+        {"role": "user", "content": "Is dental covered?"},
+        {"role": "assistant", "content": "Dental is covered."},
+        {"role": "user", "content": "Is dental covered?"},
+    ]
+    await answer_cache_chat_approach.run_without_streaming(messages, {}, {"oid": "OID_X"})
+    await answer_cache_chat_approach.run_without_streaming(messages, {}, {"oid": "OID_X"})
+
+    assert answer_cache_chat_approach.final_calls == 2
+    assert len(answer_cache_chat_approach.answer_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_replayed_when_streaming(answer_cache_chat_approach):
+    overrides = {"suggest_followup_questions": True}
+    await answer_cache_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "Is dental covered?"}], overrides, {"oid": "OID_X"}
+    )
+    events = [
+        event
+        async for event in answer_cache_chat_approach.run_with_streaming(
+            [{"role": "user", "content": "Does my plan cover dental?"}], overrides, {"oid": "OID_X"}, "state"
+        )
+    ]
+
+    assert answer_cache_chat_approach.final_calls == 1
+    assert len(events) == 3
+    assert events[0]["delta"] == {"role": "assistant"}
+    assert events[0]["session_state"] == "state"
+    assert events[0]["context"].thoughts[0].props["similarity"] >= 0.9
+    assert events[1] == {"delta": {"content": "Dental is covered. ", "role": "assistant"}}
+    assert events[2]["context"]["followup_questions"] == ["Is vision covered?"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_identical_requests(chat_approach, monkeypatch):
+    chat_approach.single_flight = SingleFlight()
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    final_calls = 0
+
+    async def mock_run_until_final_call(messages, overrides, auth_claims, should_stream):
+        nonlocal final_calls
+        final_calls += 1
+        await asyncio.sleep(0.01)
+        return ExtraInfo(DataPoints(text=[]), thoughts=[]), chat_completion_coroutine(messages[-1]["content"])
+
+    async def chat_completion_coroutine(content):
+        return chat_completion_for_query(f"Answer to {content}")
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    messages = [{"role": "user", "content": "Is dental covered?"}]
+    responses = await asyncio.gather(
+        chat_approach.run_without_streaming(messages, {}, {}, "session-1"),
+        chat_approach.run_without_streaming(messages, {}, {}, "session-2"),
+        chat_approach.run_without_streaming([{"role": "user", "content": "Is vision covered?"}], {}, {}, "session-3"),
+    )
+
+    assert final_calls == 2
+    assert [response["session_state"] for response in responses] == ["session-1", "session-2", "session-3"]
+    assert responses[0]["message"] == responses[1]["message"]
+    assert responses[2]["message"]["content"] == "Answer to Is vision covered?"
+    assert chat_approach.single_flight.coalesced == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesced_requests_have_own_context_and_timings(chat_approach, monkeypatch):
+    chat_approach.single_flight = SingleFlight()
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+
+    async def mock_run_until_final_call(messages, overrides, auth_claims, should_stream):
+        await asyncio.sleep(0.01)
+        thoughts = [ThoughtStep("Prompt to generate answer", [], {"model": "gpt-4.1-mini"})]
+        return ExtraInfo(DataPoints(text=[]), thoughts=thoughts), chat_completion_coroutine()
+
+    async def chat_completion_coroutine():
+        return chat_completion_for_query("Answer")
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    async def run(session_state):
+        timings = start_stage_timings(show_in_thoughts=True)
+        response = await chat_approach.run_without_streaming(
+            [{"role": "user", "content": "Is dental covered?"}], {}, {}, session_state
+        )
+        return response, timings
+
+    (leader, leader_timings), (follower, follower_timings) = await asyncio.gather(run("session-1"), run("session-2"))
+
+    assert chat_approach.single_flight.coalesced == 1
+    assert leader["context"] is not follower["context"]
+    assert "generation" in leader_timings.durations
+    assert "coalesced" not in leader_timings.durations
+    assert list(follower_timings.durations) == ["coalesced"]
+    assert leader["context"].thoughts[-1].props["timings"] == leader_timings.as_props()
+    assert follower["context"].thoughts[-1].props["timings"] == follower_timings.as_props()
+    follower["context"].followup_questions = ["Is vision covered?"]
+    assert leader["context"].followup_questions is None
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_searches(monkeypatch):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-4o-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        single_flight=SingleFlight(),
+    )
+    search_calls = 0
+
+    async def counting_mock_search(*args, **kwargs):
+        nonlocal search_calls
+        search_calls += 1
+        await asyncio.sleep(0.01)
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", counting_mock_search)
+
+    def search():
+        return chat_approach.search(
+            top=3,
+            query_text="test query",
+            filter=None,
+            vectors=[],
+            use_text_search=True,
+            use_vector_search=False,
+            use_semantic_ranker=False,
+            use_semantic_captions=False,
+        )
+
+    first, second = await asyncio.gather(search(), search())
+
+    assert search_calls == 1
+    assert first == second
+    assert first is not second
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_scheduled_with_token_budget(chat_approach, monkeypatch):
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=100000, requests_per_minute=600)
+    chat_approach.token_schedulers = {"chat": scheduler}
+    acquired = []
+    original_acquire = scheduler.acquire
+
+    async def mock_acquire(tokens, priority):
+        acquired.append((tokens, priority))
+        await original_acquire(tokens, priority)
+
+    monkeypatch.setattr(scheduler, "acquire", mock_acquire)
+    monkeypatch.setattr("approaches.approach.estimate_messages_tokens", lambda model, messages, tools: 20)
+
+    class MockRawResponse:
+        headers = {"x-ratelimit-remaining-tokens": "5000", "x-ratelimit-remaining-requests": "10"}
+
+        def parse(self):
+            return chat_completion_for_query("Answer")
+
+    class MockRawCompletions:
+        async def create(self, **kwargs):
+            assert kwargs["model"] == "chat"
+            return MockRawResponse()
+
+    class MockCompletions:
+        with_raw_response = MockRawCompletions()
+
+    class MockOpenAIClient:
+        class chat:
+            completions = MockCompletions()
+
+    chat_approach.openai_client = MockOpenAIClient()
+    chat_completion = await chat_approach.create_chat_completion(
+        "chat",
+        "gpt-4o-mini",
+        [{"role": "user", "content": "Is dental covered?"}],
+        {"priority": "batch"},
+        response_token_limit=100,
+    )
+
+    assert chat_completion.choices[0].message.content == "Answer"
+    assert acquired == [(120, PRIORITY_BATCH)]
+    assert scheduler.stats()["tokens_available"] <= 5000
+    assert scheduler.stats()["requests_available"] == 10
+
+
+@pytest.mark.asyncio
+async def test_zero_temperature_completions_coalesced(chat_approach):
+    chat_approach.single_flight = SingleFlight()
+    created = []
+
+    class MockCompletions:
+        async def create(self, **kwargs):
+            created.append(kwargs)
+            await asyncio.sleep(0.01)
+            return chat_completion_for_query("Answer")
+
+    class MockOpenAIClient:
+        class chat:
+            completions = MockCompletions()
+
+    chat_approach.openai_client = MockOpenAIClient()
+
+    def create_chat_completion():
+        # An explicit temperature of 0 is kept, rather than replaced by the default temperature of the overrides
+        return chat_approach.create_chat_completion(
+            "chat",
+            "gpt-4o-mini",
+            [{"role": "user", "content": "Is dental covered?"}],
+            {"seed": 42},
+            response_token_limit=100,
+            temperature=0.0,
+        )
+
+    first, second = await asyncio.gather(create_chat_completion(), create_chat_completion())
+
+    assert first.choices[0].message.content == second.choices[0].message.content == "Answer"
+    assert len(created) == 1
+    assert created[0]["temperature"] == 0.0
+
+
+@pytest.mark.asyncio
+async def test_streamed_completion_admitted_until_read(chat_approach):
+    controller = AdmissionController(UPSTREAM_OPENAI, max_concurrency=1, max_queue=1)
+    chat_approach.admission_controllers = {UPSTREAM_OPENAI: controller}
+
+    async def mock_stream():
+        for content in ["Dental ", "is covered"]:
+            yield content
+
+    class MockCompletions:
+        async def create(self, **kwargs):
+            assert kwargs["stream"] is True
+            return mock_stream()
+
+    class MockOpenAIClient:
+        class chat:
+            completions = MockCompletions()
+
+    chat_approach.openai_client = MockOpenAIClient()
+
+    def create_chat_completion():
+        return chat_approach.create_chat_completion(
+            "chat",
+            "gpt-4o-mini",
+            [{"role": "user", "content": "Is dental covered?"}],
+            {},
+            response_token_limit=100,
+            should_stream=True,
+        )
+
+    stream = await create_chat_completion()
+    assert controller.in_flight == 1
+    assert [chunk async for chunk in stream] == ["Dental ", "is covered"]
+    assert controller.in_flight == 0
+
+    # A stream that is closed before the end also releases its call
+    stream = await create_chat_completion()
+    assert await stream.__anext__() == "Dental "
+    await stream.aclose()
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_search_hedged(chat_approach, monkeypatch):
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    chat_approach.hedging_policy = HedgingPolicy()
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    documents = await chat_approach.search(
+        top=3,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=False,
+        use_semantic_captions=False,
+    )
+
+    assert len(documents) > 0
+    assert chat_approach.hedging_policy.stats()["search"]["calls"] == 1
+
+
+def test_sources_packed_into_token_budget(chat_approach, monkeypatch):
+    sources = ["a.pdf#page=1: Dental is covered.", "b.pdf#page=2: Vision is covered. Exams are yearly."]
+    assert chat_approach.pack_sources_content(sources, "gpt-4o-mini") == (sources, None)
+
+    class MockEncoding:
+        def encode(self, text, disallowed_special=()):
+            return text.split()
+
+        def decode(self, tokens):
+            return " ".join(tokens)
+
+    monkeypatch.setattr("core.tokenbudget.get_encoding", lambda model: MockEncoding())
+    chat_approach.sources_token_budget = 8
+    packed, stats = chat_approach.pack_sources_content(sources, "gpt-4o-mini")
+    assert packed == [sources[0], "b.pdf#page=2: Vision is covered."]
+    assert stats["packed_tokens"] == 8
+    assert stats["dropped_tokens"] == 3
+
+
+class WordEncoding:
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+@pytest.mark.asyncio
+async def test_past_messages_trimmed_and_summarized(chat_approach, monkeypatch):
+    monkeypatch.setattr("core.tokenbudget.get_encoding", lambda model: WordEncoding())
+    summarized = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        # Summaries are generated deterministically, so that they can be cached and shared
+        assert kwargs["temperature"] == 0.0
+        summarized.append(kwargs["messages"])
+        return chat_completion_for_query(f"Summary {len(summarized)}")
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    chat_approach.history_token_budget = 16
+    chat_approach.history_summary_cache = TTLCache(max_entries=10, ttl=60)
+    messages = [
+        {"role": "user", "content": "What plans are there?"},
+        {"role": "assistant", "content": "Standard and Plus."},
+        {"role": "user", "content": "Is dental covered?"},
+        {"role": "assistant", "content": "Yes, in Plus."},
+    ]
+
+    timings = start_stage_timings()
+    kept, thought = await chat_approach.fit_past_messages(messages, {})
+    assert kept == [
+        {"role": "system", "content": "Summary of the earlier conversation: Summary 1"},
+        *messages[2:],
+    ]
+    assert thought.props.pop("summary_latency_ms") == round(timings.durations[STAGE_HISTORY_SUMMARY] * 1000)
+    assert thought.props == {"token_budget": 16, "kept_messages": 2, "dropped_messages": 2, "summary": "generated"}
+
+    # The next turn reuses the cached summary
+    kept, thought = await chat_approach.fit_past_messages(messages, {})
+    assert thought.props["summary"] == "cached"
+    assert len(summarized) == 1
+
+    # Once more messages are dropped, the cached summary is updated with the newly dropped messages only
+    messages += [{"role": "user", "content": "And vision?"}, {"role": "assistant", "content": "Only in Plus."}]
+    kept, thought = await chat_approach.fit_past_messages(messages, {})
+    assert kept[0]["content"] == "Summary of the earlier conversation: Summary 2"
+    assert thought.props["summary"] == "generated"
+    rendered = json.dumps(summarized[1])
+    assert "Summary 1" in rendered
+    assert "Is dental covered?" in rendered
+    assert "What plans are there?" not in rendered
+
+
+@pytest.mark.asyncio
+async def test_past_messages_kept_without_budget(chat_approach):
+    messages = [{"role": "user", "content": "What plans are there?"}]
+    assert await chat_approach.fit_past_messages(messages, {}) == (messages, None)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import pytest
@@ -10,6 +11,8 @@ from openai.types.chat import ChatCompletion
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.promptmanager import PromptyManager
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.timings import start_stage_timings
 
 from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
 
@@ -151,3 +154,79 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k_nearest_neighbors == 50
     assert result.fields == "embedding3"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, monkeypatch, mock_openai_embedding):
+    mock_openai_embedding(openai_client)
+    create = openai_client.embeddings.create
+    calls = []
+
+    async def counting_create(*args, **kwargs):
+        calls.append(kwargs["input"])
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(openai_client.embeddings, "create", counting_create)
+    chat_approach.embedding_cache = TTLCache(max_entries=10, ttl=60)
+
+    first = await chat_approach.compute_text_embedding("test query")
+    second = await chat_approach.compute_text_embedding("  test   query ")
+    third = await chat_approach.compute_text_embedding("another query")
+
+    assert calls == ["test query", "another query"]
+    assert first.vector == second.vector == third.vector
+    assert first is not second
+    assert chat_approach.embedding_cache.stats() == {"entries": 2, "hits": 1, "misses": 2}
+
+
+@pytest.mark.asyncio
+async def test_compute_query_vectors_concurrently(chat_approach, monkeypatch):
+    in_flight = set()
+    overlapped = []
+
+    async def compute_text_embedding(q, priority):
+        in_flight.add("text")
+        await asyncio.sleep(0.05)
+        in_flight.discard("text")
+        return VectorizedQuery(vector=[0.1], k_nearest_neighbors=50, fields="embedding3")
+
+    async def compute_image_embedding(q):
+        overlapped.append("text" in in_flight)
+        await asyncio.sleep(0.05)
+        return VectorizedQuery(vector=[0.2], k_nearest_neighbors=50, fields="imageEmbedding")
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", compute_image_embedding)
+    timings = start_stage_timings()
+
+    vectors = await chat_approach.compute_query_vectors("test query", "textAndImageEmbeddings", 0)
+
+    assert [vector.fields for vector in vectors] == ["embedding3", "imageEmbedding"]
+    # Both embeddings were computed in about the time of one
+    assert 0.05 <= timings.durations["query_vectors"] < 0.09
+
+    vectors = await chat_approach.compute_query_vectors("test query", "imageEmbeddingOnly", 0)
+    assert [vector.fields for vector in vectors] == ["imageEmbedding"]
+    assert overlapped == [True, False]
+
+
+@pytest.mark.asyncio
+async def test_compute_query_vectors_failure_cancels_other(chat_approach, monkeypatch):
+    cancelled = []
+
+    async def compute_text_embedding(q, priority):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append("text")
+            raise
+
+    async def compute_image_embedding(q):
+        raise ValueError("Vision endpoint failed")
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", compute_image_embedding)
+
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(chat_approach.compute_query_vectors("test query", "textAndImageEmbeddings", 0), 0.5)
+    assert cancelled == ["text"]
@@ -1,4 +1,7 @@
+import base64
+import datetime
 import os
+from urllib.parse import parse_qs, unquote, urlparse
 
 import aiohttp
 import azure.storage.blob.aio
@@ -10,9 +13,11 @@ from azure.core.pipeline.transport import (
     AsyncHttpTransport,
     HttpRequest,
 )
+from azure.storage.blob import UserDelegationKey
 from azure.storage.blob.aio import BlobServiceClient
 
 import app
+from core.sas import UserDelegationSasGenerator
 
 from .mocks import MockAzureCredential, MockBlob
 
@@ -97,6 +102,130 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         assert await response.get_data() == b"test content"
 
 
+class MockAiohttpClientResponseWithStatus(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, status, headers=None):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "Mock"
+        self._url = url
+
+
+class MockRangeTransport(AsyncHttpTransport):
+    """Serves a blob like storage does, honoring range and conditional request headers"""
+
+    content = b"0123456789abcdefghij"
+    etag = '"0x8DC0000000000"'
+    last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+    def __init__(self):
+        self.requests: list[HttpRequest] = []
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        headers = {
+            "Content-Type": "application/pdf",
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified,
+        }
+        if request.headers.get("If-None-Match") == self.etag or request.headers.get("If-Modified-Since"):
+            return AioHttpTransportResponse(
+                request, MockAiohttpClientResponseWithStatus(request.url, b"", 304, headers)
+            )
+        start, end = request.headers["x-ms-range"].removeprefix("bytes=").split("-")
+        start = int(start)
+        if start >= len(self.content):
+            return AioHttpTransportResponse(
+                request, MockAiohttpClientResponseWithStatus(request.url, b"", 416, headers)
+            )
+        end = min(int(end), len(self.content) - 1)
+        body = self.content[start : end + 1]
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(self.content)}"
+        headers["Content-Length"] = str(len(body))
+        return AioHttpTransportResponse(request, MockAiohttpClientResponseWithStatus(request.url, body, 206, headers))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_and_conditional(monkeypatch, mock_env, mock_acs_search):
+    transport = MockRangeTransport()
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+        client = test_app.test_client()
+
+        response = await client.get("/content/benefits.pdf")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/pdf"
+        assert response.headers["Content-Length"] == "20"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["ETag"] == MockRangeTransport.etag
+        assert response.headers["Last-Modified"] == MockRangeTransport.last_modified
+        assert await response.get_data() == MockRangeTransport.content
+
+        # PDF viewers request ranges to jump to pages
+        response = await client.get("/content/benefits.pdf", headers={"Range": "bytes=5-9"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-9/20"
+        assert response.headers["Content-Length"] == "5"
+        assert await response.get_data() == b"56789"
+        assert transport.requests[-1].headers["x-ms-range"] == "bytes=5-9"
+
+        response = await client.get("/content/benefits.pdf", headers={"Range": "bytes=15-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 15-19/20"
+        assert await response.get_data() == b"fghij"
+
+        response = await client.get("/content/benefits.pdf", headers={"Range": "bytes=5-100"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-19/20"
+        assert await response.get_data() == b"56789abcdefghij"
+
+        response = await client.get("/content/benefits.pdf", headers={"Range": "bytes=50-60"})
+        assert response.status_code == 416
+
+        # Suffix ranges and multiple ranges are answered with the complete file
+        response = await client.get("/content/benefits.pdf", headers={"Range": "bytes=-5"})
+        assert response.status_code == 200
+        assert await response.get_data() == MockRangeTransport.content
+
+        # Unchanged files are revalidated without downloading them
+        response = await client.get("/content/benefits.pdf", headers={"If-None-Match": MockRangeTransport.etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == MockRangeTransport.etag
+        assert await response.get_data() == b""
+
+        response = await client.get(
+            "/content/benefits.pdf", headers={"If-Modified-Since": MockRangeTransport.last_modified}
+        )
+        assert response.status_code == 304
+        assert "If-Modified-Since" in transport.requests[-1].headers
+
+        response = await client.get("/content/benefits.pdf", headers={"If-None-Match": '"0x8DCFFFFFFFFFFFF"'})
+        assert response.status_code == 200
+        assert await response.get_data() == MockRangeTransport.content
+
+
 @pytest.mark.asyncio
 async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_blob_container_client):
 
@@ -139,3 +268,114 @@ async def test_content_file_useruploaded_notfound(monkeypatch, auth_client, mock
 
     response = await auth_client.get("/content/userdoc.pdf", headers={"Authorization": "Bearer test"})
     assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_content_file_useruploaded_range(monkeypatch, auth_client, mock_blob_container_client):
+
+    class MockBlobClient:
+        async def download_blob(self, **kwargs):
+            raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
+
+    monkeypatch.setattr(
+        azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
+    )
+
+    download_options = []
+
+    async def mock_download_file(self, **kwargs):
+        download_options.append(kwargs)
+        return MockBlob()
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
+
+    response = await auth_client.get(
+        "/content/userdoc.pdf", headers={"Authorization": "Bearer test", "Range": "bytes=0-3"}
+    )
+    assert response.status_code == 206
+    assert await response.get_data() == b"test"
+    assert download_options == [{"offset": 0, "length": 4}]
+
+
+def create_mock_user_delegation_key():
+    key = UserDelegationKey()
+    key.signed_oid = "OID"
+    key.signed_tid = "TID"
+    key.signed_start = "2024-01-01T00:00:00Z"
+    key.signed_expiry = "2024-01-02T00:00:00Z"
+    key.signed_service = "b"
+    key.signed_version = "2024-05-04"
+    key.value = base64.b64encode(b"mock delegation key").decode()
+    return key
+
+
+@pytest.mark.asyncio
+async def test_content_file_sas_redirect(monkeypatch, mock_env, mock_acs_search):
+    key_requests = []
+
+    async def mock_get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+        key_requests.append((key_start_time, key_expiry_time))
+        return create_mock_user_delegation_key()
+
+    monkeypatch.setattr(BlobServiceClient, "get_user_delegation_key", mock_get_user_delegation_key)
+    monkeypatch.setenv("USE_CONTENT_SAS_REDIRECT", "true")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        client = test_app.test_client()
+        for path in ["Benefit_Options.pdf", "Benefit_Options.pdf#page=2", "Role Library.pdf"]:
+            response = await client.get(f"/content/{path}")
+            assert response.status_code == 302
+            location = urlparse(response.headers["Location"])
+            assert location.netloc == "test-storage-account.blob.core.windows.net"
+            assert location.path.startswith("/test-storage-container/")
+            sas = parse_qs(location.query)
+            assert sas["sp"] == ["r"]
+            assert sas["rsct"] == ["application/pdf"]
+            assert sas["rscd"] == ["inline"]
+            assert sas["skoid"] == ["OID"]
+        assert unquote(location.path) == "/test-storage-container/Role Library.pdf"
+
+    # The user delegation key is reused for every redirect
+    assert len(key_requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_user_delegation_key_renewed():
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    key_requests = []
+
+    class MockBlobServiceClient(BlobServiceClient):
+        async def get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+            key_requests.append(key_expiry_time)
+            return create_mock_user_delegation_key()
+
+    sas_generator = UserDelegationSasGenerator(
+        MockBlobServiceClient("https://account.blob.core.windows.net", credential=MockAzureCredential()),
+        "container",
+        sas_expiry=datetime.timedelta(minutes=5),
+        key_expiry=datetime.timedelta(hours=1),
+        clock=lambda: now,
+    )
+    url = await sas_generator.generate_blob_url("a.pdf")
+    assert url.startswith("https://account.blob.core.windows.net/container/a.pdf?")
+    assert "se=2024-01-01T00%3A05%3A00Z" in url
+
+    # A key that expires before a new SAS would is renewed
+    now += datetime.timedelta(minutes=54)
+    await sas_generator.generate_blob_url("a.pdf")
+    assert len(key_requests) == 1
+    now += datetime.timedelta(minutes=2)
+    await sas_generator.generate_blob_url("a.pdf")
+    assert len(key_requests) == 2
+    await sas_generator.close()
+
+
+def test_sas_expiry_shorter_than_key_expiry():
+    with pytest.raises(ValueError):
+        UserDelegationSasGenerator(
+            BlobServiceClient("https://account.blob.core.windows.net", credential=MockAzureCredential()),
+            "container",
+            sas_expiry=datetime.timedelta(hours=1),
+            key_expiry=datetime.timedelta(hours=1),
+        )
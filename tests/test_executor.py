@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+
+from core.executor import BlockingExecutor
+
+
+@pytest.mark.asyncio
+async def test_run_on_thread():
+    executor = BlockingExecutor(max_workers=2)
+    thread_name = await executor.run(lambda: threading.current_thread().name)
+    assert thread_name.startswith("blocking")
+    assert await executor.run(pow, 2, exp=3) == 8
+    assert executor.stats()["completed"] == 2
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_exception():
+    executor = BlockingExecutor(max_workers=1)
+
+    def fail():
+        raise ValueError("SDK error")
+
+    with pytest.raises(ValueError):
+        await executor.run(fail)
+    stats = executor.stats()
+    assert stats["completed"] == 1
+    assert stats["active"] == 0
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_and_wait_time():
+    executor = BlockingExecutor(max_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=5)
+        return "blocked"
+
+    first = asyncio.create_task(executor.run(block))
+    await asyncio.to_thread(started.wait, 5)
+    second = asyncio.create_task(executor.run(lambda: "queued"))
+    third = asyncio.create_task(executor.run(lambda: "cancelled"))
+    await asyncio.sleep(0)
+
+    stats = executor.stats()
+    assert stats["active"] == 1
+    assert stats["queue_depth"] == 2
+
+    # A call cancelled while waiting for a thread leaves the queue without running
+    third.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await third
+    assert executor.stats()["queue_depth"] == 1
+
+    release.set()
+    assert await first == "blocked"
+    assert await second == "queued"
+    stats = executor.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["active"] == 0
+    assert stats["completed"] == 2
+    assert stats["max_wait_time"] > 0
+    assert 0 < stats["average_wait_time"] <= stats["max_wait_time"]
+    executor.shutdown()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_queue_metrics():
+    executor = BlockingExecutor(max_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    waits_before = sample("app_blocking_call_wait_seconds_count")
+
+    def block():
+        started.set()
+        release.wait(timeout=5)
+
+    first = asyncio.create_task(executor.run(block))
+    await asyncio.to_thread(started.wait, 5)
+    second = asyncio.create_task(executor.run(lambda: None))
+    await asyncio.sleep(0)
+    assert sample("app_blocking_calls_active") == 1
+    assert sample("app_blocking_calls_queued") == 1
+
+    release.set()
+    await first
+    await second
+    assert sample("app_blocking_calls_active") == 0
+    assert sample("app_blocking_calls_queued") == 0
+    assert sample("app_blocking_call_wait_seconds_count") == waits_before + 2
+    executor.shutdown()
+
+
+def test_invalid_max_workers():
+    with pytest.raises(ValueError):
+        BlockingExecutor(max_workers=0)
@@ -1,17 +1,28 @@
+import asyncio
+import base64
+import io
 import os
 
 import aiohttp
 import pytest
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.core.pipeline.transport import (
     AioHttpTransportResponse,
     AsyncHttpTransport,
     HttpRequest,
 )
 from azure.storage.blob.aio import BlobServiceClient
+from PIL import Image
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core.imageshelper import (
+    ImageCache,
+    ImagePreparer,
+    download_blob_as_base64,
+    estimate_image_tokens,
+    fetch_image,
+    fetch_images,
+)
 
 from .mocks import MockAzureCredential
 
@@ -95,3 +106,199 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+class MockBlobProperties:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class MockBlobDownloader:
+    def __init__(self, content, etag):
+        self.content = content
+        self.properties = MockBlobProperties(etag)
+
+    async def readall(self):
+        return self.content
+
+
+class MockImageContainerClient:
+    """Serves blobs from a dict of name to (content, etag), answering conditional downloads like storage does"""
+
+    def __init__(self, blobs, delay=0):
+        self.blobs = blobs
+        self.delay = delay
+        self.downloads = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_blob_client(self, name):
+        container = self
+
+        class MockBlobClient:
+            async def download_blob(self, etag=None, match_condition=None):
+                container.in_flight += 1
+                container.max_in_flight = max(container.max_in_flight, container.in_flight)
+                try:
+                    await asyncio.sleep(container.delay)
+                finally:
+                    container.in_flight -= 1
+                content, current_etag = container.blobs[name]
+                if etag is not None and etag == current_etag:
+                    container.downloads.append((name, "not modified"))
+                    raise HttpResponseError(response=MockNotModifiedResponse())
+                container.downloads.append((name, "downloaded"))
+                return MockBlobDownloader(content, current_etag)
+
+        return MockBlobClient()
+
+
+class MockNotModifiedResponse:
+    status_code = 304
+    reason = "Not Modified"
+    headers: dict = {}
+
+    def text(self):
+        return ""
+
+
+def make_document(sourcepage):
+    return Document(id=sourcepage, content="", sourcepage=sourcepage)
+
+
+@pytest.mark.asyncio
+async def test_image_cache_hit_and_revalidation():
+    now = 0.0
+    container = MockImageContainerClient({"a.png": (b"page a", '"1"')})
+    image_cache = ImageCache(max_bytes=1000, revalidate_after=60, timer=lambda: now)
+
+    first = await download_blob_as_base64(container, "a.pdf#page=1", image_cache)
+    second = await download_blob_as_base64(container, "a.pdf#page=1", image_cache)
+    assert first == second == "data:image/png;base64,cGFnZSBh"
+    assert container.downloads == [("a.png", "downloaded")]
+
+    # Once the ETag is older than revalidate_after, storage is asked whether the blob changed
+    now = 61.0
+    assert await download_blob_as_base64(container, "a.pdf#page=1", image_cache) == first
+    assert container.downloads[-1] == ("a.png", "not modified")
+
+    now = 122.0
+    container.blobs["a.png"] = (b"page a v2", '"2"')
+    assert await download_blob_as_base64(container, "a.pdf#page=1", image_cache) == "data:image/png;base64,cGFnZSBhIHYy"
+    assert container.downloads[-1] == ("a.png", "downloaded")
+    assert image_cache.stats() == {"entries": 1, "bytes": 34, "hits": 1, "revalidated_hits": 1, "misses": 2}
+
+
+@pytest.mark.asyncio
+async def test_image_cache_limited_by_bytes():
+    container = MockImageContainerClient({f"{name}.png": (b"x" * 30, '"1"') for name in "abc"})
+    image_cache = ImageCache(max_bytes=150)
+
+    for name in "abc":
+        await download_blob_as_base64(container, f"{name}.pdf", image_cache)
+    # Each data URL takes 62 bytes, so the least recently used image was evicted
+    assert image_cache.stats()["entries"] == 2
+    await download_blob_as_base64(container, "a.pdf", image_cache)
+    assert [name for name, _ in container.downloads] == ["a.png", "b.png", "c.png", "a.png"]
+
+
+def test_image_cache_invalid_settings():
+    with pytest.raises(ValueError):
+        ImageCache(max_bytes=1000, revalidate_after=0)
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_concurrently():
+    container = MockImageContainerClient({f"{name}.png": (name.encode(), '"1"') for name in "abcd"}, delay=0.01)
+    results = [make_document(sourcepage) for sourcepage in ["a.pdf", "b.pdf", "a.pdf", "", "c.pdf", "d.pdf"]]
+
+    images = await fetch_images(container, results, max_concurrency=2)
+
+    assert images == [f"data:image/png;base64,{encoded}" for encoded in ["YQ==", "Yg==", "YQ==", "Yw==", "ZA=="]]
+    # Results from the same page share a download, and no more than max_concurrency downloads run at once
+    assert len(container.downloads) == 4
+    assert container.max_in_flight == 2
+
+
+def make_png(width, height):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(output, format="PNG")
+    return output.getvalue()
+
+
+def decode_data_url(data_url):
+    header, encoded = data_url.split(",", 1)
+    return header, Image.open(io.BytesIO(base64.b64decode(encoded)))
+
+
+def test_image_preparer_downscales_and_reencodes():
+    preparer = ImagePreparer(max_long_edge=512, image_format="jpeg", quality=70)
+    prepared, mime_type = preparer.prepare(make_png(612, 832))
+    assert mime_type == "image/jpeg"
+    with Image.open(io.BytesIO(prepared)) as image:
+        assert image.format == "JPEG"
+        # The aspect ratio is kept
+        assert image.size == (377, 512)
+
+
+def test_image_preparer_keeps_unchanged_png():
+    original = make_png(400, 300)
+    assert ImagePreparer(max_long_edge=512).prepare(original) == (original, "image/png")
+
+
+def test_image_preparer_invalid_settings():
+    with pytest.raises(ValueError):
+        ImagePreparer(image_format="gif")
+    with pytest.raises(ValueError):
+        ImagePreparer(quality=0)
+    with pytest.raises(ValueError):
+        ImagePreparer(detail="medium")
+
+
+def test_image_preparer_sets_detail():
+    messages = [
+        {"role": "system", "content": "You are an assistant"},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What is covered?"},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,YQ=="}},
+            ],
+        },
+    ]
+    assert ImagePreparer().set_detail(messages)[1]["content"][1]["image_url"] == {"url": "data:image/png;base64,YQ=="}
+    ImagePreparer(detail="low").set_detail(messages)
+    assert messages[1]["content"][1]["image_url"] == {"url": "data:image/png;base64,YQ==", "detail": "low"}
+    assert messages[0]["content"] == "You are an assistant"
+
+
+def test_estimate_image_tokens():
+    assert estimate_image_tokens(612, 832, "low") == 85
+    # A page rendered at 72 DPI takes 2x2 tiles, and one that fits in 512px takes a single tile
+    assert estimate_image_tokens(612, 832) == 765
+    assert estimate_image_tokens(377, 512) == 255
+    # Large images are scaled to fit in 2048x2048, then to a shortest side of 768
+    assert estimate_image_tokens(4096, 8192) == 85 + 170 * 2 * 3
+
+
+@pytest.mark.asyncio
+async def test_image_cache_stores_prepared_images():
+    container = MockImageContainerClient({"a.png": (make_png(612, 832), '"1"')})
+    image_cache = ImageCache(max_bytes=1_000_000)
+    preparer = ImagePreparer(max_long_edge=512, image_format="webp")
+    prepare_calls = []
+    prepare = preparer.prepare
+
+    def counting_prepare(image):
+        prepare_calls.append(image)
+        return prepare(image)
+
+    preparer.prepare = counting_prepare
+
+    first = await download_blob_as_base64(container, "a.pdf#page=1", image_cache, preparer)
+    second = await download_blob_as_base64(container, "a.pdf#page=1", image_cache, preparer)
+    assert first == second
+    assert len(prepare_calls) == 1
+    header, image = decode_data_url(first)
+    assert header == "data:image/webp;base64"
+    assert image.size == (377, 512)
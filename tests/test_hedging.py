@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from core.hedging import HedgingPolicy
+
+
+async def warm_up(policy, key="search", latency=0.001, count=5):
+    async def call():
+        await asyncio.sleep(latency)
+        return "warm-up"
+
+    for _ in range(count):
+        await policy.run(key, call)
+
+
+@pytest.mark.asyncio
+async def test_hedging_not_used_until_enough_samples():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=1)
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    assert await policy.run("search", call) == "result"
+    assert calls == 1
+    assert policy.threshold("search") is None
+    assert policy.stats()["search"]["hedged"] == 0
+
+
+@pytest.mark.asyncio
+async def test_hedged_call_wins_over_slow_call():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=1)
+    await warm_up(policy)
+    cancelled = []
+    latencies = [1, 0.001]
+
+    async def call():
+        latency = latencies.pop(0)
+        try:
+            await asyncio.sleep(latency)
+        except asyncio.CancelledError:
+            cancelled.append(latency)
+            raise
+        return latency
+
+    assert await asyncio.wait_for(policy.run("search", call), timeout=0.5) == 0.001
+    await asyncio.sleep(0)
+    assert cancelled == [1]
+    stats = policy.stats()["search"]
+    assert stats["calls"] == 6
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 1
+    assert stats["threshold_ms"] is not None
+
+
+@pytest.mark.asyncio
+async def test_hedging_limited_by_budget():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=0.05)
+    await warm_up(policy, count=19)
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        return "result"
+
+    # 20 calls earn a single duplicate
+    assert await policy.run("search", call) == "result"
+    assert await policy.run("search", call) == "result"
+    assert calls == 3
+    assert policy.stats()["search"]["hedged"] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedging_ignores_failure_of_one_call():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=1)
+    await warm_up(policy)
+    outcomes = ["slow failure", "success"]
+
+    async def call():
+        outcome = outcomes.pop(0)
+        if outcome == "slow failure":
+            await asyncio.sleep(0.02)
+            raise ValueError("Slow replica failed")
+        await asyncio.sleep(0.04)
+        return outcome
+
+    assert await policy.run("search", call) == "success"
+
+
+@pytest.mark.asyncio
+async def test_hedging_raises_when_both_calls_fail():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=1)
+    await warm_up(policy)
+
+    async def call():
+        await asyncio.sleep(0.01)
+        raise ValueError("Search failed")
+
+    with pytest.raises(ValueError):
+        await policy.run("search", call)
+
+
+@pytest.mark.asyncio
+async def test_hedging_metrics():
+    policy = HedgingPolicy(min_samples=5, max_extra_ratio=1)
+    await warm_up(policy, key="metrics")
+    latencies = [1, 0.001]
+
+    async def call():
+        await asyncio.sleep(latencies.pop(0))
+        return "result"
+
+    await asyncio.wait_for(policy.run("metrics", call), timeout=0.5)
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"operation": "metrics"})
+
+    assert sample("app_hedging_calls_total") == 6
+    assert sample("app_hedging_hedged_total") == 1
+    assert sample("app_hedging_wins_total") == 1
+    # The threshold used by the last call, from the latencies of the warm-up calls
+    assert 0 < sample("app_hedging_threshold_seconds") < 0.5
+
+
+def test_hedging_invalid_settings():
+    with pytest.raises(ValueError):
+        HedgingPolicy(percentile=100)
+    with pytest.raises(ValueError):
+        HedgingPolicy(max_extra_ratio=0)
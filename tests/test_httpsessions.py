@@ -0,0 +1,46 @@
+import pytest
+
+from core.httpsessions import HTTPSessionRegistry, http_session
+
+
+@pytest.mark.asyncio
+async def test_registry_shares_session_per_host():
+    registry = HTTPSessionRegistry(limit_per_host=10, keepalive_timeout=15, dns_cache_ttl=60)
+    vision = registry.get("https://vision.cognitiveservices.azure.com/computervision/retrieval:vectorizeText")
+    assert registry.get("https://VISION.cognitiveservices.azure.com/other") is vision
+    graph = registry.get("https://graph.microsoft.com/v1.0/me/transitiveMemberOf")
+    assert graph is not vision
+    assert vision.connector.limit_per_host == 10
+    assert registry.stats() == {"sessions": 2, "created": 2, "reused": 1}
+
+    await registry.close()
+    assert vision.closed and graph.closed
+    assert registry.stats()["sessions"] == 0
+
+
+@pytest.mark.asyncio
+async def test_registry_replaces_closed_session():
+    registry = HTTPSessionRegistry()
+    session = registry.get("https://graph.microsoft.com/v1.0/me")
+    await session.close()
+    replacement = registry.get("https://graph.microsoft.com/v1.0/me")
+    assert replacement is not session
+    assert not replacement.closed
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_http_session_without_registry_is_closed_after_call():
+    async with http_session(None, "https://graph.microsoft.com/v1.0/me") as session:
+        assert not session.closed
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_http_session_with_registry_stays_open():
+    registry = HTTPSessionRegistry()
+    async with http_session(registry, "https://graph.microsoft.com/v1.0/me") as session:
+        pass
+    assert not session.closed
+    assert registry.get("https://graph.microsoft.com/v1.0/me") is session
+    await registry.close()
@@ -0,0 +1,58 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from core.metrics import (
+    CacheStatsExporter,
+    measure_upstream,
+    record_token_usage,
+    render_metrics,
+)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_measure_upstream():
+    calls = sample("app_upstream_duration_seconds_count", upstream="test-upstream", outcome="success")
+    async with measure_upstream("test-upstream"):
+        pass
+    assert sample("app_upstream_duration_seconds_count", upstream="test-upstream", outcome="success") == calls + 1
+
+
+@pytest.mark.asyncio
+async def test_measure_upstream_error():
+    errors = sample("app_upstream_errors_total", upstream="test-upstream", error="ValueError")
+    with pytest.raises(ValueError):
+        async with measure_upstream("test-upstream"):
+            raise ValueError("Upstream failed")
+    assert sample("app_upstream_errors_total", upstream="test-upstream", error="ValueError") == errors + 1
+    assert sample("app_upstream_duration_seconds_count", upstream="test-upstream", outcome="error") >= 1
+
+
+def test_record_token_usage():
+    record_token_usage("test-model", prompt_tokens=100, completion_tokens=20, reasoning_tokens=None)
+    record_token_usage("test-model", prompt_tokens=50, completion_tokens=10, reasoning_tokens=5)
+    assert sample("app_openai_tokens_total", model="test-model", type="prompt") == 150
+    assert sample("app_openai_tokens_total", model="test-model", type="completion") == 30
+    assert sample("app_openai_tokens_total", model="test-model", type="reasoning") == 5
+
+
+def test_cache_stats_exporter():
+    exporter = CacheStatsExporter()
+    exporter.export("test-cache", {"entries": 10, "hits": 3, "misses": 1})
+    exporter.export("test-cache", {"entries": 12, "hits": 5, "misses": 1})
+    assert sample("app_cache_lookups_total", cache="test-cache", result="hits") == 5
+    assert sample("app_cache_lookups_total", cache="test-cache", result="misses") == 1
+    # Only the hits and misses are exported
+    assert sample("app_cache_lookups_total", cache="test-cache", result="entries") == 0
+    # A cache that starts counting again is counted from zero
+    exporter.export("test-cache", {"entries": 0, "hits": 2, "misses": 0})
+    assert sample("app_cache_lookups_total", cache="test-cache", result="hits") == 7
+
+
+def test_render_metrics():
+    content, content_type = render_metrics()
+    assert content_type.startswith("text/plain")
+    assert b"app_request_duration_seconds" in content
@@ -0,0 +1,186 @@
+import time
+
+import httpx
+import openai
+import pytest
+from prometheus_client import REGISTRY
+
+from core.openairouter import OPERATION_EMBEDDINGS, OpenAIEndpoint, OpenAIRouter
+
+
+class MockTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def rate_limit_error(headers=None):
+    request = httpx.Request("POST", "https://test.openai.azure.com/openai/deployments/chat/chat/completions")
+    response = httpx.Response(429, request=request, headers=headers or {})
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def create_router(timer, count=2):
+    endpoints = [OpenAIEndpoint(f"endpoint-{index}", client=f"client-{index}", timer=timer) for index in range(count)]
+    return OpenAIRouter(endpoints, timer=timer)
+
+
+@pytest.mark.asyncio
+async def test_router_prefers_lowest_latency():
+    timer = MockTimer()
+    router = create_router(timer)
+    latencies = {"client-0": 2.0, "client-1": 0.5}
+
+    async def call(client):
+        timer.now += latencies[client]
+        return client
+
+    # Every endpoint is measured first, then the fastest endpoint is used
+    assert [await router.call(call) for _ in range(4)] == ["client-0", "client-1", "client-1", "client-1"]
+    stats = router.stats()
+    assert stats["endpoints"][0]["latency_ewma_ms"] == {"chat": 2000}
+    assert stats["endpoints"][1]["latency_ewma_ms"] == {"chat": 500}
+    assert stats["endpoints"][1]["calls"] == 3
+
+
+@pytest.mark.asyncio
+async def test_router_ranks_by_latency_of_operation():
+    timer = MockTimer()
+    router = create_router(timer)
+    router.endpoints[0].latency_ewma = {"chat": 2.0, "embeddings": 0.02}
+    router.endpoints[1].latency_ewma = {"chat": 1.0, "embeddings": 0.05}
+
+    async def call(client):
+        timer.now += 0.03
+        return client
+
+    assert await router.call(call) == "client-1"
+    assert await router.call(call, OPERATION_EMBEDDINGS) == "client-0"
+    # Fast embeddings don't lower the chat latency of the endpoint
+    assert router.endpoints[0].latency_ewma["chat"] == 2.0
+    assert router.stats()["endpoints"][0]["latency_ewma_ms"] == {"chat": 2000, "embeddings": 23}
+
+
+@pytest.mark.asyncio
+async def test_router_fails_over_on_rate_limit():
+    timer = MockTimer()
+    router = create_router(timer)
+    calls = []
+
+    async def call(client):
+        calls.append(client)
+        if client == "client-0":
+            raise rate_limit_error({"retry-after-ms": "5000"})
+        return "ok"
+
+    assert await router.call(call) == "ok"
+    assert calls == ["client-0", "client-1"]
+    assert router.failovers == 1
+    assert router.stats()["endpoints"][0]["rate_limited"] == 1
+    assert router.stats()["endpoints"][0]["cooling_down"]
+
+    # The rate limited endpoint is only tried again once the retry-after time has passed
+    router.endpoints[1].latency_ewma = {"chat": 10}
+    assert router.rank()[0].name == "endpoint-1"
+    timer.now += 5
+    assert router.rank()[0].name == "endpoint-0"
+
+
+@pytest.mark.asyncio
+async def test_router_raises_when_all_endpoints_fail():
+    timer = MockTimer()
+    router = create_router(timer)
+
+    async def call(client):
+        raise rate_limit_error()
+
+    with pytest.raises(openai.RateLimitError):
+        await router.call(call)
+    assert all(endpoint["failures"] == 1 for endpoint in router.stats()["endpoints"])
+
+
+@pytest.mark.asyncio
+async def test_router_calls_last_endpoint_with_last_resort_client():
+    timer = MockTimer()
+    endpoints = [
+        OpenAIEndpoint(
+            f"endpoint-{index}", client=f"client-{index}", timer=timer, last_resort_client=f"retrying-{index}"
+        )
+        for index in range(2)
+    ]
+    router = OpenAIRouter(endpoints, timer=timer)
+    calls = []
+
+    async def call(client):
+        calls.append(client)
+        if client == "client-0":
+            raise rate_limit_error()
+        return "ok"
+
+    # Only the endpoint that has no other endpoint to fail over to retries failed calls
+    assert await router.call(call) == "ok"
+    assert calls == ["client-0", "retrying-1"]
+
+
+@pytest.mark.asyncio
+async def test_router_does_not_fail_over_on_request_errors():
+    timer = MockTimer()
+    router = create_router(timer)
+    calls = []
+
+    async def call(client):
+        calls.append(client)
+        raise ValueError("Invalid request")
+
+    with pytest.raises(ValueError):
+        await router.call(call)
+    assert calls == ["client-0"]
+
+
+@pytest.mark.asyncio
+async def test_router_avoids_endpoints_low_on_tokens():
+    timer = MockTimer()
+    router = create_router(timer)
+    await router.endpoints[0].observe_response(httpx.Response(200, headers={"x-ratelimit-remaining-tokens": "200"}))
+    router.endpoints[1].latency_ewma = {"chat": 10}
+    assert router.rank()[0].name == "endpoint-1"
+    # The remaining quota is only reported for the current minute
+    timer.now += 60
+    assert router.rank()[0].name == "endpoint-0"
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_router_metrics():
+    timer = MockTimer()
+    endpoints = [OpenAIEndpoint(name, client=name, timer=timer) for name in ["metrics-0", "metrics-1"]]
+    router = OpenAIRouter(endpoints, timer=timer)
+    failovers_before = sample("app_openai_failovers_total")
+
+    async def call(client):
+        timer.now += 0.5
+        if client == "metrics-0":
+            raise rate_limit_error({"retry-after": "30"})
+        return "ok"
+
+    assert await router.call(call) == "ok"
+    assert sample("app_openai_endpoint_calls_total", endpoint="metrics-0") == 1
+    assert sample("app_openai_endpoint_failures_total", endpoint="metrics-0") == 1
+    assert sample("app_openai_endpoint_rate_limited_total", endpoint="metrics-0") == 1
+    assert sample("app_openai_endpoint_calls_total", endpoint="metrics-1") == 1
+    assert sample("app_openai_endpoint_failures_total", endpoint="metrics-1") == 0
+    assert sample("app_openai_endpoint_in_flight", endpoint="metrics-1") == 0
+    assert sample("app_openai_endpoint_latency_ewma_seconds", endpoint="metrics-1", operation="chat") == 0.5
+    assert sample("app_openai_failovers_total") == failovers_before + 1
+    cooldown_until = sample("app_openai_endpoint_cooldown_until_seconds", endpoint="metrics-0")
+    assert time.time() + 25 < cooldown_until <= time.time() + 30
+
+
+def test_router_requires_endpoints():
+    with pytest.raises(ValueError):
+        OpenAIRouter([])
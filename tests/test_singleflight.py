@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_do_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    first = asyncio.ensure_future(single_flight.do("key", fetch))
+    await asyncio.sleep(0)
+    assert single_flight.is_in_flight("key")
+    assert not single_flight.is_in_flight("other")
+    results = await asyncio.gather(first, *(single_flight.do("key", fetch) for _ in range(4)))
+    assert results == [1, 1, 1, 1, 1]
+    assert not single_flight.is_in_flight("key")
+    assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 4}
+    # Nothing is kept once the call has finished
+    assert await single_flight.do("key", fetch) == 2
+
+
+@pytest.mark.asyncio
+async def test_do_runs_different_keys_separately():
+    single_flight = SingleFlight()
+
+    async def echo(value):
+        await asyncio.sleep(0)
+        return value
+
+    results = await asyncio.gather(single_flight.do("a", lambda: echo("a")), single_flight.do("b", lambda: echo("b")))
+    assert results == ["a", "b"]
+    assert single_flight.coalesced == 0
+
+
+@pytest.mark.asyncio
+async def test_do_shares_exceptions():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    results = await asyncio.gather(single_flight.do("key", fail), single_flight.do("key", fail), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_do_cancels_call_without_waiters():
+    single_flight = SingleFlight()
+    started = asyncio.Event()
+    cancelled = False
+
+    async def slow():
+        nonlocal cancelled
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    first = asyncio.create_task(single_flight.do("key", slow))
+    second = asyncio.create_task(single_flight.do("key", slow))
+    await started.wait()
+    first.cancel()
+    await asyncio.sleep(0)
+    # Another caller still waits for the call, so it keeps running
+    assert not cancelled
+    second.cancel()
+    await asyncio.gather(first, second, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert cancelled
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_items():
+    single_flight = SingleFlight()
+    streams = 0
+
+    async def produce():
+        nonlocal streams
+        streams += 1
+        for item in ["a", "b", "c"]:
+            await asyncio.sleep(0.001)
+            yield item
+
+    async def consume():
+        return [item async for item in single_flight.stream("key", produce)]
+
+    first = asyncio.create_task(consume())
+    await asyncio.sleep(0.0015)
+    # Subscribers that join late still receive the items that were already produced
+    second = asyncio.create_task(consume())
+    assert await first == ["a", "b", "c"]
+    assert await second == ["a", "b", "c"]
+    assert streams == 1
+    assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 1}
+
+
+@pytest.mark.asyncio
+async def test_stream_shares_exceptions():
+    single_flight = SingleFlight()
+
+    async def produce():
+        yield "a"
+        await asyncio.sleep(0.001)
+        raise ValueError("upstream failed")
+
+    async def consume(items):
+        async for item in single_flight.stream("key", produce):
+            items.append(item)
+
+    first_items: list[str] = []
+    second_items: list[str] = []
+    results = await asyncio.gather(consume(first_items), consume(second_items), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert first_items == second_items == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_stream_restarts_after_last_subscriber_leaves():
+    single_flight = SingleFlight()
+    streams = 0
+
+    async def produce():
+        nonlocal streams
+        streams += 1
+        for item in range(3):
+            yield item
+            await asyncio.sleep(0.001)
+
+    first = single_flight.stream("key", produce)
+    assert await first.__anext__() == 0
+    await first.aclose()
+    # A subscriber that arrives while the cancelled stream is winding down gets a complete new stream
+    assert [item async for item in single_flight.stream("key", produce)] == [0, 1, 2]
+    assert streams == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_cancelled_upstream_is_an_error():
+    single_flight = SingleFlight()
+    started = asyncio.Event()
+
+    async def produce():
+        yield "a"
+        started.set()
+        await asyncio.sleep(10)
+        yield "b"
+
+    async def consume(items):
+        async for item in single_flight.stream("key", produce):
+            items.append(item)
+
+    items: list[str] = []
+    consumer = asyncio.create_task(consume(items))
+    await started.wait()
+    single_flight._streams["key"].task.cancel()
+    with pytest.raises(RuntimeError, match="cancelled"):
+        await consumer
+    assert items == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_do_restarts_after_last_waiter_is_cancelled():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    first = asyncio.create_task(single_flight.do("key", call))
+    await asyncio.sleep(0)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    # The cancelled call is forgotten right away, so the next caller doesn't join it
+    assert await single_flight.do("key", call) == 2
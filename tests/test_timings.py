@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from core.timings import (
+    STAGE_SEARCH,
+    StageTimings,
+    get_stage_timings,
+    measure_stage,
+    start_stage_timings,
+)
+
+
+class MockTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_stage_timings_add_up_repeated_stages():
+    timer = MockTimer()
+    timings = StageTimings(timer=timer)
+    with timings.measure("search"):
+        timer.now += 0.25
+    with timings.measure("search"):
+        timer.now += 0.5
+    timings.record("generation", 1.25)
+    timings.record_total()
+    assert timings.as_props() == {"search_ms": 750.0, "generation_ms": 1250.0, "total_ms": 750.0}
+    assert timings.server_timing() == "search;dur=750.0, generation;dur=1250.0, total;dur=750.0"
+
+
+def test_stage_timings_measure_failed_stage():
+    timer = MockTimer()
+    timings = StageTimings(timer=timer)
+    with pytest.raises(ValueError):
+        with timings.measure("search"):
+            timer.now += 0.1
+            raise ValueError("Search failed")
+    assert timings.as_props() == {"search_ms": 100.0}
+
+
+def test_stage_timings_measure_yields_duration():
+    timer = MockTimer()
+    timings = StageTimings(timer=timer)
+    with timings.measure("search") as measurement:
+        timer.now += 0.25
+    assert measurement.duration == 0.25
+    assert timings.durations == {"search": 0.25}
+
+
+def test_measure_stage_without_timings():
+    with measure_stage(STAGE_SEARCH) as measurement:
+        pass
+    assert get_stage_timings() is None
+    # The duration is still measured for the callers that report it elsewhere
+    assert measurement.duration >= 0
+
+
+@pytest.mark.asyncio
+async def test_measure_stage_in_tasks():
+    async def handle_request():
+        timings = start_stage_timings()
+
+        async def search():
+            with measure_stage(STAGE_SEARCH):
+                await asyncio.sleep(0)
+
+        # Tasks started by the request record their stages in the timings of the request
+        await asyncio.gather(asyncio.create_task(search()), asyncio.create_task(search()))
+        return timings
+
+    timings, other_timings = await asyncio.gather(handle_request(), handle_request())
+    assert timings is not other_timings
+    assert list(timings.as_props()) == ["search_ms"]
+    assert list(other_timings.as_props()) == ["search_ms"]
@@ -0,0 +1,184 @@
+import asyncio
+import time
+
+import pytest
+
+from core import tokenbudget
+from core.tokenbudget import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    TokenBudgetScheduler,
+    estimate_messages_tokens,
+    pack_sources,
+    trim_messages,
+)
+
+
+class MockEncoding:
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_schedules_within_budget():
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=60)
+    await scheduler.acquire(1000)
+    await scheduler.acquire(1000)
+    stats = scheduler.stats()
+    assert stats["scheduled"] == 2
+    assert stats["delayed"] == 0
+    assert 3999 <= stats["tokens_available"] <= 4001
+    assert stats["requests_available"] == 58
+
+
+@pytest.mark.asyncio
+async def test_scheduler_paces_when_budget_is_used():
+    # 6000 tokens per minute refill 100 tokens per second
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=600)
+    await scheduler.acquire(6000)
+    started = time.monotonic()
+    await scheduler.acquire(5)
+    assert time.monotonic() - started >= 0.04
+    stats = scheduler.stats()
+    assert stats["delayed"] == 1
+    assert stats["wait_time_max_ms"] >= 40
+
+
+@pytest.mark.asyncio
+async def test_scheduler_schedules_interactive_calls_first():
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=600)
+    await scheduler.acquire(6000)
+    order = []
+
+    async def call(name, priority):
+        await scheduler.acquire(5, priority)
+        order.append(name)
+
+    await asyncio.gather(
+        call("batch-1", PRIORITY_BATCH),
+        call("batch-2", PRIORITY_BATCH),
+        call("interactive", PRIORITY_INTERACTIVE),
+    )
+    assert order == ["interactive", "batch-1", "batch-2"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_skips_cancelled_calls():
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=600)
+    await scheduler.acquire(6000)
+    cancelled = asyncio.create_task(scheduler.acquire(3000))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.gather(cancelled, return_exceptions=True)
+    await asyncio.wait_for(scheduler.acquire(5), timeout=1)
+    assert scheduler.stats()["waiting"] == 0
+
+
+def test_scheduler_updated_from_headers():
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=60)
+    scheduler.update_from_headers({"x-ratelimit-remaining-tokens": "1200", "x-ratelimit-remaining-requests": "5"})
+    stats = scheduler.stats()
+    assert 1200 <= stats["tokens_available"] <= 1201
+    assert stats["requests_available"] == 5
+    # The remaining quota never raises the budget above what was already used
+    scheduler.update_from_headers({"x-ratelimit-remaining-tokens": "6000", "x-ratelimit-remaining-requests": "invalid"})
+    assert scheduler.stats()["tokens_available"] < 1300
+
+
+@pytest.mark.asyncio
+async def test_scheduler_paused_after_rate_limit():
+    scheduler = TokenBudgetScheduler("chat", tokens_per_minute=6000, requests_per_minute=600)
+    scheduler.record_rate_limit({"retry-after-ms": "50"})
+    started = time.monotonic()
+    await scheduler.acquire(5)
+    assert time.monotonic() - started >= 0.04
+    assert scheduler.stats()["rate_limited"] == 1
+
+
+def test_scheduler_invalid_quota():
+    with pytest.raises(ValueError):
+        TokenBudgetScheduler("chat", tokens_per_minute=0, requests_per_minute=60)
+
+
+def test_estimate_messages_tokens(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant"},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What is in this image?"},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,"}},
+            ],
+        },
+    ]
+    # 3 for the reply, 3 + 1 for each message, 5 words of system prompt, 5 words of question and 85 for the image
+    assert estimate_messages_tokens("gpt-4o", messages) == 3 + 4 + 5 + 4 + 5 + 85
+
+
+def test_pack_sources_within_budget(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    sources = ["a.pdf#page=1: Dental is covered.", "b.pdf#page=2: Vision is covered."]
+    packed, stats = pack_sources("gpt-4o", sources, token_budget=100)
+    assert packed == sources
+    assert stats == {
+        "token_budget": 100,
+        "packed_tokens": 8,
+        "dropped_tokens": 0,
+        "packed_sources": 2,
+        "truncated_sources": 0,
+        "dropped_sources": 0,
+    }
+
+
+def test_pack_sources_truncates_at_sentence_boundary(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    sources = [
+        "a.pdf#page=1: Dental is covered.",
+        "b.pdf#page=2: Vision is covered. Exams are yearly. Frames are covered every two years.",
+        "c.pdf#page=3: Hearing is covered.",
+    ]
+    packed, stats = pack_sources("gpt-4o", sources, token_budget=15)
+    # The second source is cut after its last complete sentence within the 11 tokens left, the third one is dropped
+    assert packed == [sources[0], "b.pdf#page=2: Vision is covered. Exams are yearly."]
+    assert stats["packed_tokens"] == 11
+    assert stats["dropped_tokens"] == 6 + 4
+    assert (stats["packed_sources"], stats["truncated_sources"], stats["dropped_sources"]) == (2, 1, 1)
+
+
+def test_pack_sources_drops_source_without_complete_sentence(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    sources = ["a.pdf#page=1: Dental is covered.", "b.pdf#page=2: <table><tr><td>Plan</td></tr></table>"]
+    packed, stats = pack_sources("gpt-4o", sources, token_budget=5)
+    assert packed == [sources[0]]
+    assert (stats["truncated_sources"], stats["dropped_sources"]) == (0, 1)
+
+
+def test_trim_messages_keeps_newest_messages(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    messages = [
+        {"role": "user", "content": "What plans are there?"},
+        {"role": "assistant", "content": "Standard and Plus."},
+        {"role": "user", "content": "Is dental covered?"},
+        {"role": "assistant", "content": "Yes, in Plus."},
+    ]
+    # Each message takes 3 + 1 tokens for its role and its words
+    kept, dropped = trim_messages("gpt-4o", messages, token_budget=21)
+    assert kept == messages[2:]
+    assert dropped == messages[:2]
+
+
+def test_trim_messages_drops_answer_without_question(monkeypatch):
+    monkeypatch.setattr(tokenbudget, "get_encoding", lambda model: MockEncoding())
+    messages = [
+        {"role": "user", "content": "What plans are there?"},
+        {"role": "assistant", "content": "Standard and Plus."},
+        {"role": "user", "content": "Is dental covered?"},
+    ]
+    kept, dropped = trim_messages("gpt-4o", messages, token_budget=15)
+    assert kept == messages[2:]
+    assert dropped == messages[:2]
+    assert trim_messages("gpt-4o", messages, token_budget=0) == ([], messages)